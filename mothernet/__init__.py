@@ -1,3 +1,9 @@
-from mothernet.prediction.tabpfn import TabPFNClassifier
-
 __all__ = ["TabPFNClassifier"]
+
+
+def __getattr__(name):
+    # imported on first use, so that numpy-only modules like mothernet.artifact can be imported without torch
+    if name == "TabPFNClassifier":
+        from mothernet.prediction.tabpfn import TabPFNClassifier
+        return TabPFNClassifier
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,291 @@
+"""
+Standalone predictors for fitted MotherNet and additive models, and their export to and from .npz files.
+
+Once a MotherNet or additive model has been extracted, prediction only needs a few small arrays. This module only
+depends on numpy, so that artifacts written with MotherNetClassifier.save_artifact or
+MotherNetAdditiveClassifier.save_artifact can be loaded and used with load_artifact without torch, the model
+checkpoint or the training data.
+"""
+import threading
+import warnings
+
+import numpy as np
+
+ARTIFACT_VERSION = 1
+
+
+def softmax(x, axis=-1):
+    e = np.exp(x - x.max(axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def standardize(X, mean, std, out=None):
+    """
+    Returns (X - mean) / std in float64, clipped to [-100, 100], with NaNs in X treated as zero, as in
+    predict_with_mlp_model.
+    """
+    if out is None:
+        out = np.empty(np.shape(X), dtype=np.float64)
+    np.copyto(out, X, casting='unsafe')
+    np.nan_to_num(out, copy=False, nan=0.)
+    out -= mean
+    out /= std
+    return np.clip(out, -100, 100, out=out)
+
+
+class MLPPredictor:
+    """
+    Compiled form of an extracted MLP for fast repeated prediction on cpu.
+
+    Inputs are standardized with the training mean and std and clipped to [-100, 100] as in predict_with_mlp_model.
+    The standardization is done in float64 on each block of inputs rather than folded into the first layer, which
+    would lose all precision for constant or large-offset training columns. Weights are stored as contiguous float32
+    arrays, and inputs are processed in blocks of block_size rows, reusing the same buffers, so prediction is a chain
+    of matrix multiplications into preallocated memory. Buffers are kept per thread.
+    """
+
+    def __init__(self, layers, mean=None, std=None, block_size=4096):
+        weights = [w for _, w in layers]
+        biases = [b for b, _ in layers]
+        n_features = np.shape(weights[0])[0]
+        if mean is None:
+            mean, std = np.zeros(n_features), np.ones(n_features)
+        self._set_arrays(weights, biases, mean, std)
+        self.block_size = block_size
+
+    def _set_arrays(self, weights, biases, mean, std):
+        self.mean_, self.std_ = np.asarray(mean, dtype=np.float64), np.asarray(std, dtype=np.float64)
+        self.weights_ = [np.ascontiguousarray(w, dtype=np.float32) for w in weights]
+        self.biases_ = [np.ascontiguousarray(b, dtype=np.float32) for b in biases]
+        self._buffers = threading.local()
+
+    @classmethod
+    def from_training_data(cls, X_train, layers, scale=True, **kwargs):
+        if not scale:
+            return cls(layers, **kwargs)
+        with warnings.catch_warnings():
+            # all-missing features
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            mean = np.nanmean(X_train, axis=0)
+            std = np.nanstd(X_train, axis=0, ddof=1) + .000001
+        # missing values are replaced by 0 before scaling, as in predict_with_mlp_model
+        mean[np.isnan(mean)] = 0
+        std[np.isnan(std)] = 1
+        return cls(layers, mean=mean, std=std, **kwargs)
+
+    @classmethod
+    def from_arrays(cls, weights, biases, mean, std, block_size=4096):
+        """
+        Creates a predictor from the weights, biases and standardization of another predictor.
+        """
+        predictor = cls.__new__(cls)
+        predictor._set_arrays(weights, biases, mean, std)
+        predictor.block_size = block_size
+        return predictor
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_buffers']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._buffers = threading.local()
+
+    def _get_buffers(self, n_rows):
+        buffers = getattr(self._buffers, 'arrays', None)
+        if buffers is None or buffers[0].shape[0] < n_rows:
+            buffers = [np.empty((n_rows, self.weights_[0].shape[0]), dtype=np.float64),
+                       np.empty((n_rows, self.weights_[0].shape[0]), dtype=np.float32)]
+            buffers += [np.empty((n_rows, w.shape[1]), dtype=np.float32) for w in self.weights_]
+            self._buffers.arrays = buffers
+        return [buffer[:n_rows] for buffer in buffers]
+
+    def decision_function(self, X):
+        """
+        Returns the logits of the MLP for X, which can contain NaNs, which are treated as zero.
+        """
+        X = np.asarray(X)
+        result = np.empty((X.shape[0], self.weights_[-1].shape[1]), dtype=np.float32)
+        for start in range(0, X.shape[0], self.block_size):
+            stop = min(start + self.block_size, X.shape[0])
+            scaled, out, *activations = self._get_buffers(stop - start)
+            standardize(X[start:stop], self.mean_, self.std_, out=scaled)
+            np.copyto(out, scaled, casting='same_kind')
+            for i, (w, b, activation) in enumerate(zip(self.weights_, self.biases_, activations)):
+                np.dot(out, w, out=activation)
+                activation += b
+                if i != len(self.weights_) - 1:
+                    np.maximum(activation, 0, out=activation)
+                out = activation
+            result[start:stop] = out
+        return result
+
+    def predict_proba(self, X):
+        logits = self.decision_function(X).astype(np.float64)
+        return softmax(logits / .8, axis=1)
+
+
+def pad_bin_edges(bin_edges):
+    """
+    Returns the bin edges of all features as one float64 matrix, padding features with fewer edges with inf, which
+    does not change the bin any value falls into.
+    """
+    if not isinstance(bin_edges, list):
+        return np.asarray(bin_edges, dtype=np.float64)
+    n_edges = max(len(edges) for edges in bin_edges)
+    padded = np.full((len(bin_edges), n_edges), np.inf)
+    for row, edges in zip(padded, bin_edges):
+        row[:len(edges)] = edges
+    return padded
+
+
+class AdditivePredictor:
+    """
+    Prediction with an extracted additive model: each feature is binned with its bin edges, and the logits are the
+    sum of the per-feature lookup tables at the bins, plus the biases.
+
+    Inputs are processed in blocks of block_size rows. The bins of a block are turned into offsets into one
+    (n_features * n_bins, n_classes) lookup table, which is gathered and summed over features in one operation.
+    """
+
+    def __init__(self, weights, biases, bin_edges, block_size=4096):
+        self.weights_ = np.asarray(weights)
+        self.biases_ = np.asarray(biases)
+        self.bin_edges_ = pad_bin_edges(bin_edges)
+        self.block_size = block_size
+        n_features, n_bins, n_classes = self.weights_.shape
+        self.table_ = self.weights_.reshape(n_features * n_bins, n_classes).astype(np.float64)
+        self.offsets_ = np.arange(n_features)[:, np.newaxis] * n_bins
+
+    def decision_function(self, X):
+        """
+        Returns the logits of the additive model for X, which can contain NaNs, which are treated as zero.
+        """
+        # features x samples, so that each feature is contiguous for binning
+        # missing values are binned as zero, as the network does when it produces the tables (see bin_data_indices)
+        X_T = np.nan_to_num(np.asarray(X, dtype=np.float64).T, nan=0)
+        out = np.empty((X_T.shape[1], self.biases_.shape[0]))
+        binned = np.empty((X_T.shape[0], min(self.block_size, X_T.shape[1])), dtype=np.intp)
+        for start in range(0, X_T.shape[1], self.block_size):
+            block = X_T[:, start:start + self.block_size]
+            block_binned = binned[:, :block.shape[1]]
+            for feature, edges in enumerate(self.bin_edges_):
+                block_binned[feature] = np.searchsorted(edges, block[feature])
+            out[start:start + block.shape[1]] = self._binned_decision_function(block_binned)
+        out += self.biases_
+        return out
+
+    def _binned_decision_function(self, binned):
+        # binned is features x samples, and is overwritten
+        binned += self.offsets_
+        return np.take(self.table_, binned, axis=0).sum(axis=0)
+
+    def predict_proba(self, X):
+        return softmax(self.decision_function(X) / .8, axis=1)
+
+
+class LowRankAdditivePredictor(AdditivePredictor):
+    """
+    Prediction with an additive model whose lookup tables are products of per-feature coefficients and a basis of
+    shape functions shared by all features, as produced by a factorized additive decoder.
+
+    The basis is gathered at the bins and contracted with the coefficients in rank space, without creating the
+    (n_features, n_bins, n_classes) lookup table. coefficients are features x rank x classes with a basis of
+    rank x bins, or features x rank with a basis of rank x bins x classes.
+    """
+
+    def __init__(self, coefficients, basis, biases, bin_edges, block_size=4096):
+        self.coefficients_ = np.asarray(coefficients)
+        self.basis_ = np.asarray(basis)
+        self.biases_ = np.asarray(biases)
+        self.bin_edges_ = pad_bin_edges(bin_edges)
+        self.block_size = block_size
+        n_features, rank = self.coefficients_.shape[:2]
+        # bins first, so that gathering bins gives contiguous rows
+        self.basis_table_ = np.ascontiguousarray(np.moveaxis(self.basis_, 0, 1), dtype=np.float64)
+        if self.coefficients_.ndim == 3:
+            self.coefficient_matrix_ = self.coefficients_.reshape(n_features * rank, -1).astype(np.float64)
+        else:
+            self.coefficient_matrix_ = self.coefficients_.astype(np.float64)
+
+    def _binned_decision_function(self, binned):
+        # features x samples x rank, or features x samples x rank x classes
+        gathered = np.take(self.basis_table_, binned, axis=0)
+        if self.coefficients_.ndim == 3:
+            return gathered.transpose(1, 0, 2).reshape(binned.shape[1], -1) @ self.coefficient_matrix_
+        return np.einsum('knro,kr->no', gathered, self.coefficient_matrix_, optimize=True)
+
+
+class ArtifactClassifier:
+    """
+    Classifier loaded from an artifact, with the prediction interface of the estimator it was saved from.
+    """
+
+    def __init__(self, predictor, classes):
+        self.predictor = predictor
+        self.classes_ = classes
+
+    def decision_function(self, X):
+        return self.predictor.decision_function(X)
+
+    def predict_proba(self, X):
+        return self.predictor.predict_proba(X)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+def _classes_array(classes):
+    classes = np.asarray(classes)
+    if classes.dtype == object:
+        # for example string labels from pandas, which are stored as a unicode array so that loading needs no pickle
+        classes = np.asarray(classes.tolist())
+    if classes.dtype == object:
+        raise ValueError("Artifacts can only store numeric or string class labels.")
+    return classes
+
+
+def save_artifact(path, predictor, classes):
+    """
+    Writes an MLPPredictor, AdditivePredictor or LowRankAdditivePredictor and the class labels to a compressed .npz
+    file at path.
+    """
+    arrays = dict(version=np.array(ARTIFACT_VERSION), classes=_classes_array(classes))
+    if isinstance(predictor, MLPPredictor):
+        arrays.update(kind=np.array("mlp"), mean=predictor.mean_, std=predictor.std_,
+                      n_layers=np.array(len(predictor.weights_)))
+        for i, (w, b) in enumerate(zip(predictor.weights_, predictor.biases_)):
+            arrays[f"weight_{i}"] = w
+            arrays[f"bias_{i}"] = b
+    elif isinstance(predictor, LowRankAdditivePredictor):
+        arrays.update(kind=np.array("low_rank_additive"), coefficients=predictor.coefficients_, basis=predictor.basis_,
+                      biases=predictor.biases_, bin_edges=predictor.bin_edges_)
+    elif isinstance(predictor, AdditivePredictor):
+        arrays.update(kind=np.array("additive"), weights=predictor.weights_, biases=predictor.biases_,
+                      bin_edges=predictor.bin_edges_)
+    else:
+        raise TypeError(f"Cannot save predictor of type {type(predictor).__name__}")
+    np.savez_compressed(path, **arrays)
+
+
+def load_artifact(path):
+    """
+    Loads an artifact written by save_artifact, returning an ArtifactClassifier.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        version = int(data["version"])
+        if version != ARTIFACT_VERSION:
+            raise ValueError(f"Unsupported artifact version {version}, expected {ARTIFACT_VERSION}")
+        kind = str(data["kind"])
+        if kind == "mlp":
+            n_layers = int(data["n_layers"])
+            predictor = MLPPredictor.from_arrays([data[f"weight_{i}"] for i in range(n_layers)],
+                                                 [data[f"bias_{i}"] for i in range(n_layers)], data["mean"], data["std"])
+        elif kind == "additive":
+            predictor = AdditivePredictor(data["weights"], data["biases"], data["bin_edges"])
+        elif kind == "low_rank_additive":
+            predictor = LowRankAdditivePredictor(data["coefficients"], data["basis"], data["biases"], data["bin_edges"])
+        else:
+            raise ValueError(f"Unknown artifact kind: {kind}")
+        return ArtifactClassifier(predictor, data["classes"])
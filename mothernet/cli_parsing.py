@@ -53,6 +53,7 @@ def argparser_from_config(description="Train Mothernet"):
     dataloader = parser.add_argument_group('dataloader')
     dataloader.add_argument('-b', '--batch-size', type=int, help='physical batch size', default=8)
     dataloader.add_argument('-n', '--num-steps', type=int, help='number of steps per epoch')
+    dataloader.add_argument('--num-workers', type=int, help='number of processes generating prior batches, 0 to generate them in the training loop', default=0)
 
     transformer = parser.add_argument_group('transformer')
     transformer.add_argument('-e', '--em-size', type=int, help='embedding size', default=512, dest='emsize')
@@ -1,4 +1,9 @@
+import queue
+import random
+
 import numpy as np
+import torch
+import torch.multiprocessing as mp
 from torch.utils.data import DataLoader
 
 import mothernet.priors as priors
@@ -6,7 +11,18 @@ from mothernet.priors import ClassificationAdapterPrior, BagPrior, BooleanConjun
 
 
 class PriorDataLoader(DataLoader):
-    def __init__(self, prior, num_steps, batch_size, min_eval_pos, max_eval_pos, n_samples, device, num_features):
+    """
+    Samples num_steps batches per epoch from prior.
+
+    With num_workers > 0, batches are generated on cpu in num_workers processes, each with its own seed stream
+    derived from seed (or from numpy's global random state if seed is None) and the epoch. Worker i generates steps
+    i, i + num_workers, ..., so the sequence of batches does not depend on timing. Each worker keeps up to
+    prefetch_factor batches in a queue, passing tensors through shared memory, and batches are moved to device
+    when they are consumed.
+    """
+
+    def __init__(self, prior, num_steps, batch_size, min_eval_pos, max_eval_pos, n_samples, device, num_features,
+                 num_workers=0, prefetch_factor=2, seed=None):
         self.prior = prior
         self.num_steps = num_steps
         self.batch_size = batch_size
@@ -15,17 +31,17 @@ class PriorDataLoader(DataLoader):
         self.n_samples = n_samples
         self.device = device
         self.num_features = num_features
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.seed = seed
         self.epoch_count = 0
 
-    def gbm(self, epoch=None):
-        # Actually can only sample up to max_eval_pos-1 but that's how it was in the original code
-        single_eval_pos = np.random.randint(self.min_eval_pos, self.max_eval_pos)
-        batch = self.prior.get_batch(batch_size=self.batch_size, n_samples=self.n_samples, num_features=self.num_features, device=self.device,
-                                     epoch=epoch,
-                                     single_eval_pos=single_eval_pos)
-        # we return sampled hyperparameters from get_batch for testing but we don't want to use them as style.
-        x, y, target_y, _ = batch if len(batch) == 4 else (batch[0], batch[1], batch[2], None)
-        return (None, x, y), target_y, single_eval_pos
+    def gbm(self, epoch=None, device=None):
+        return _sample_batch(self.prior.get_batch, epoch=epoch, device=device or self.device, **self._get_batch_kwargs())
+
+    def _get_batch_kwargs(self):
+        return dict(batch_size=self.batch_size, n_samples=self.n_samples, num_features=self.num_features,
+                    min_eval_pos=self.min_eval_pos, max_eval_pos=self.max_eval_pos)
 
     def __len__(self):
         return self.num_steps
@@ -35,7 +51,75 @@ class PriorDataLoader(DataLoader):
 
     def __iter__(self):
         self.epoch_count += 1
-        return iter(self.gbm(epoch=self.epoch_count - 1) for _ in range(self.num_steps))
+        if self.num_workers == 0:
+            return iter(self.gbm(epoch=self.epoch_count - 1) for _ in range(self.num_steps))
+        return self._iter_prefetching(epoch=self.epoch_count - 1)
+
+    def _iter_prefetching(self, epoch):
+        seed = np.random.randint(2 ** 31) if self.seed is None else self.seed
+        seeds = np.random.SeedSequence([seed, epoch]).spawn(self.num_workers)
+        context = mp.get_context()
+        queues = [context.Queue(maxsize=self.prefetch_factor) for _ in range(self.num_workers)]
+        done = context.Event()
+        # only the prior is sent to the workers, not the whole dataloader
+        workers = [context.Process(target=_prior_worker, daemon=True,
+                                   args=(self.prior.get_batch, self._get_batch_kwargs(), epoch, range(i, self.num_steps, self.num_workers),
+                                         seeds[i], queues[i], done))
+                   for i in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            for step in range(self.num_steps):
+                (style, x, y), target_y, single_eval_pos = _get_batch(queues[step % self.num_workers], workers[step % self.num_workers])
+                yield (style, x.to(self.device), y.to(self.device)), target_y.to(self.device), single_eval_pos
+        finally:
+            done.set()
+            for worker in workers:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    # blocked on a full queue if the iteration was stopped early
+                    worker.terminate()
+                    worker.join()
+
+
+def _sample_batch(get_batch, min_eval_pos, max_eval_pos, epoch=None, device="cpu", **kwargs):
+    # Actually can only sample up to max_eval_pos-1 but that's how it was in the original code
+    single_eval_pos = np.random.randint(min_eval_pos, max_eval_pos)
+    batch = get_batch(device=device, epoch=epoch, single_eval_pos=single_eval_pos, **kwargs)
+    # we return sampled hyperparameters from get_batch for testing but we don't want to use them as style.
+    x, y, target_y, _ = batch if len(batch) == 4 else (batch[0], batch[1], batch[2], None)
+    return (None, x, y), target_y, single_eval_pos
+
+
+def _prior_worker(get_batch, batch_kwargs, epoch, steps, seed_sequence, batch_queue, done):
+    # each worker is single-threaded, parallelism comes from the number of workers
+    torch.set_num_threads(1)
+    # independent seeds for the three random number generators
+    numpy_seed, torch_seed, random_seed = seed_sequence.generate_state(3)
+    np.random.seed(numpy_seed)
+    torch.manual_seed(int(torch_seed))
+    random.seed(int(random_seed))
+    try:
+        for _ in steps:
+            batch_queue.put(_sample_batch(get_batch, epoch=epoch, device="cpu", **batch_kwargs))
+    except Exception as e:
+        batch_queue.put(RuntimeError(f"Prior worker failed: {e!r}"))
+        raise
+    # shared memory of the batches is passed through this process, so it needs to stay alive until they are received
+    done.wait()
+
+
+def _get_batch(batch_queue, worker, timeout=5):
+    while True:
+        try:
+            batch = batch_queue.get(timeout=timeout)
+        except queue.Empty:
+            if not worker.is_alive():
+                raise RuntimeError(f"Prior worker exited unexpectedly with exit code {worker.exitcode}")
+            continue
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
 
 
 def get_dataloader(prior_config, dataloader_config, device):
@@ -60,4 +144,4 @@ def get_dataloader(prior_config, dataloader_config, device):
     return PriorDataLoader(prior=prior, num_steps=dataloader_config['num_steps'], batch_size=dataloader_config['batch_size'],
                            n_samples=prior_config['n_samples'], min_eval_pos=dataloader_config['min_eval_pos'],
                            max_eval_pos=dataloader_config['max_eval_pos'], device=device,
-                           num_features=prior_config['num_features'])
+                           num_features=prior_config['num_features'], num_workers=dataloader_config.get('num_workers', 0))
@@ -0,0 +1,49 @@
+import time
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.datasets import load_breast_cancer, load_digits, load_iris, load_wine
+from sklearn.model_selection import train_test_split
+
+
+def get_bundled_datasets(max_train_samples=512, random_state=0):
+    """
+    Returns a list of (name, X_train, X_test, y_train, y_test) for the small classification datasets that ship with
+    scikit-learn, so that the comparison does not need to download anything.
+    """
+    datasets = []
+    for name, loader in [('iris', load_iris), ('wine', load_wine), ('breast_cancer', load_breast_cancer), ('digits', load_digits)]:
+        X, y = loader(return_X_y=True)
+        X_train, X_test, y_train, y_test = train_test_split(X, y, train_size=min(max_train_samples, len(X) // 2), stratify=y,
+                                                            random_state=random_state)
+        datasets.append((name, X_train, X_test, y_train, y_test))
+    return datasets
+
+
+def low_precision_report(estimator, modes=('int8', 'bf16'), datasets=None):
+    """
+    Compares the predictions of an estimator with a low_precision parameter, such as TabPFNClassifier or
+    MotherNetClassifier, in float32 and in each of the low precision modes.
+
+    Returns a list with a dict per dataset and mode, containing the accuracy, the change in accuracy with respect to
+    float32, the largest absolute difference of the predicted probabilities, the fraction of test points with a
+    different predicted class and the time for fit and predict_proba. It can be passed to pandas.DataFrame.
+    """
+    if datasets is None:
+        datasets = get_bundled_datasets()
+    rows = []
+    for name, X_train, X_test, y_train, y_test in datasets:
+        reference = None
+        for mode in (None,) + tuple(modes):
+            start = time.time()
+            classifier = clone(estimator).set_params(low_precision=mode).fit(X_train, y_train)
+            proba = classifier.predict_proba(X_test)
+            elapsed = time.time() - start
+            prediction = classifier.classes_[proba.argmax(axis=1)]
+            accuracy = np.mean(prediction == y_test)
+            if reference is None:
+                reference = proba, prediction, accuracy
+            rows.append(dict(dataset=name, low_precision=mode or 'float32', accuracy=accuracy, accuracy_delta=accuracy - reference[2],
+                             max_proba_delta=np.abs(proba - reference[0]).max(), prediction_changes=np.mean(prediction != reference[1]),
+                             time=elapsed))
+    return rows
@@ -0,0 +1,32 @@
+import time
+
+import numpy as np
+from sklearn.base import clone
+
+from mothernet.evaluation.low_precision import get_bundled_datasets
+
+
+def prototype_accuracy_curve(estimator, n_prototypes=(4, 16, 64, 256), datasets=None):
+    """
+    Measures the accuracy of TabPFNClassifier with a training context compressed to different numbers of k-means
+    prototypes per class, compared to using all training points.
+
+    Returns a list with a dict per dataset and number of prototypes (None for the full training set), containing the
+    size of the training context, the accuracy, the change in accuracy with respect to the full training set and the
+    time for fit and predict_proba. It can be passed to pandas.DataFrame.
+    """
+    if datasets is None:
+        datasets = get_bundled_datasets()
+    rows = []
+    for name, X_train, X_test, y_train, y_test in datasets:
+        reference_accuracy = None
+        for m in (None,) + tuple(n_prototypes):
+            start = time.time()
+            classifier = clone(estimator).set_params(n_prototypes=m).fit(X_train, y_train)
+            accuracy = np.mean(classifier.predict(X_test) == y_test)
+            elapsed = time.time() - start
+            if reference_accuracy is None:
+                reference_accuracy = accuracy
+            rows.append(dict(dataset=name, n_prototypes=m, context_size=classifier.X_.shape[0], accuracy=accuracy,
+                             accuracy_delta=accuracy - reference_accuracy, time=elapsed))
+    return rows
@@ -0,0 +1,106 @@
+"""
+A flat file format for inference-only checkpoints.
+
+The file starts with a magic string and the length of a JSON header, followed by the header and the raw tensor data.
+The header contains the model config and the dtype, shape and offset of every tensor. Tensors are aligned, so they can
+be used directly from a memory map without unpickling or copying, and processes loading the same file share the
+pages in the page cache. See model_builder.convert_checkpoint for creating these files from training checkpoints.
+"""
+import importlib
+import json
+import struct
+
+import numpy as np
+import torch
+
+MAGIC = b"MNINFER1"
+ALIGNMENT = 64
+
+# numpy has no bfloat16, so these are stored and mapped as integers of the same size
+_VIEW_DTYPES = {torch.bfloat16: torch.int16}
+
+
+def is_inference_checkpoint(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _encode_config(value):
+    # configs contain a few classes (e.g. activations of the MLP prior), which are stored by name
+    if isinstance(value, dict):
+        return {k: _encode_config(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_config(v) for v in value]
+    if isinstance(value, type):
+        return {"__type__": f"{value.__module__}:{value.__qualname__}"}
+    if isinstance(value, (np.generic, torch.Tensor)):
+        return value.item()
+    return value
+
+
+def _decode_config(value):
+    if isinstance(value, dict):
+        if set(value) == {"__type__"}:
+            module, name = value["__type__"].split(":")
+            return getattr(importlib.import_module(module), name)
+        return {k: _decode_config(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode_config(v) for v in value]
+    return value
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_inference_checkpoint(path, tensors, config):
+    """
+    Writes a dict of tensors and a config dict to path in the inference checkpoint format.
+    """
+    tensors = {name: tensor.detach().cpu().contiguous() for name, tensor in tensors.items()}
+    index = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        index[name] = dict(dtype=str(tensor.dtype).replace("torch.", ""), shape=list(tensor.shape), offset=offset, nbytes=nbytes)
+        offset = _align(offset + nbytes)
+    header = json.dumps(dict(config=_encode_config(config), tensors=index)).encode("utf-8")
+    # pad the header so that the data starts at an aligned position
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    header += b" " * (data_start - len(MAGIC) - 8 - len(header))
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, tensor in tensors.items():
+            f.seek(data_start + index[name]["offset"])
+            view_dtype = _VIEW_DTYPES.get(tensor.dtype)
+            f.write((tensor.view(view_dtype) if view_dtype is not None else tensor).numpy().tobytes())
+        # make sure the file covers the padding of the last tensor
+        f.truncate(data_start + offset)
+
+
+def load_inference_checkpoint(path):
+    """
+    Opens an inference checkpoint, returning a dict of tensors and the config.
+
+    The tensors are copy-on-write views of a memory map of the file, so nothing is read until a tensor is used.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an inference checkpoint.")
+        header_length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = len(MAGIC) + 8 + header_length
+
+    tensors = {}
+    if header["tensors"]:
+        data = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start)
+        for name, info in header["tensors"].items():
+            dtype = getattr(torch, info["dtype"])
+            view_dtype = _VIEW_DTYPES.get(dtype, dtype)
+            buffer = data[info["offset"]:info["offset"] + info["nbytes"]]
+            tensor = torch.from_numpy(buffer).view(view_dtype).view(dtype).reshape(info["shape"])
+            tensors[name] = tensor
+    return tensors, _decode_config(header["config"])
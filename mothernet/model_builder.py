@@ -13,13 +13,10 @@ from mothernet.models.mothernet_additive import MotherNetAdditive
 from mothernet.models.perceiver import TabPerceiver
 from mothernet.models.tabpfn import TabPFN
 from mothernet.models.mothernet import MotherNet
-
-
-try:
-    from functools import cache
-except ImportError:
-    from functools import lru_cache
-    cache = lru_cache(maxsize=None)
+from mothernet.model_registry import model_registry
+from mothernet.quantization import quantize_model
+from mothernet.inference_checkpoint import is_inference_checkpoint, load_inference_checkpoint, save_inference_checkpoint
+from mothernet.utils import NOP
 
 
 def get_criterion(max_num_classes):
@@ -45,16 +42,46 @@ def get_gpu_memory():
     return memory_free_info
 
 
-@cache
-def load_model(path, device, verbose=False):
+def load_model(path, device, verbose=False, low_precision=None):
+    """
+    Loads a model checkpoint for inference, returning (model, config).
+
+    Models are shared through mothernet.model_registry.model_registry, so loading the same path on the same device again
+    returns the same model object as long as it has not been evicted.
+    low_precision can be 'int8' or 'bf16' to load a copy with low-precision linear layers for CPU inference,
+    see mothernet.quantization.quantize_model.
+    """
+    if low_precision is not None:
+        def load_quantized():
+            model, config = load_model(path, device, verbose=verbose)
+            return quantize_model(model, low_precision), config
+        return model_registry.get((str(path), str(device), low_precision), load_quantized)
+    return model_registry.get((str(path), str(device)), lambda: _load_model(path, device, verbose=verbose))
+
+
+def _load_model(path, device, verbose=False):
+    if is_inference_checkpoint(path):
+        return _load_inference_model(path, device)
+    model_state, config_sample = load_checkpoint_state(path)
+    _, model, *_ = get_model(config_sample, device=device, should_train=False, verbose=verbose)
+    model.load_state_dict(model_state)
+    model.to(device)
+    model.eval()
+
+    return model, config_sample
+
+
+def load_checkpoint_state(path):
+    """
+    Reads a training checkpoint and returns the model state, with keys of older versions renamed, and the config.
+    """
     states = torch.load(path, map_location='cpu')
     model_state = states[0]
     config_sample = states[-1]
-    if 'y_encoder' not in config_sample and 'onehot' in path:
+    if 'y_encoder' not in config_sample and 'onehot' in str(path):
         # workaround for the single model that was saved without y_encoder
         # that happens to be my reference model.
         config_sample['y_encoder'] = 'one_hot'
-    _, model, *_ = get_model(config_sample, device=device, should_train=False, verbose=verbose)
     module_prefix = 'module.'
     model_state = {k.replace(module_prefix, ''): v for k, v in model_state.items()}
     model_state.pop("criterion.weight", None)
@@ -70,11 +97,42 @@ def load_model(path, device, verbose=False):
         model_state['encoder.1.weight'] = model_state.pop("encoder.weight")
         model_state['encoder.1.bias'] = model_state.pop("encoder.bias")
 
-    model.load_state_dict(model_state)
-    model.to(device)
+    return model_state, config_sample
+
+
+def convert_checkpoint(path, output_path):
+    """
+    Converts a training checkpoint written by save_model into an inference checkpoint.
+
+    Only the model weights and the normalized config are kept, the optimizer and scheduler state are dropped.
+    load_model recognizes the result and builds the model directly on the memory-mapped weights.
+    """
+    model_state, config_sample = load_checkpoint_state(path)
+    config = get_full_config(config_sample)
+    # check that the weights fit the config before writing them
+    build_model(config, device='meta').load_state_dict(model_state)
+    save_inference_checkpoint(output_path, model_state, config)
+
+
+def _load_inference_model(path, device):
+    model_state, config = load_inference_checkpoint(path)
+    # the model is created without allocating or initializing weights, which are then replaced by the stored tensors
+    model = build_model(config, device='meta')
+    missing = set(model.state_dict()) - set(model_state)
+    unexpected = set(model_state) - set(model.state_dict())
+    if missing or unexpected:
+        raise RuntimeError(f"Inference checkpoint {path} does not match the model. Missing keys: {sorted(missing)}, "
+                           f"unexpected keys: {sorted(unexpected)}.")
+    for name, tensor in model_state.items():
+        module_name, _, tensor_name = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        tensor = tensor.to(device)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[tensor_name] = tensor
     model.eval()
-
-    return model, config_sample
+    return model, config
 
 
 def get_encoder(config):
@@ -157,18 +215,16 @@ def old_config_to_new(old_config, new_config):
     return new_config
 
 
-def get_model(config, device, should_train=True, verbose=False, model_state=None, optimizer_state=None,
-              scheduler=None, epoch_callback=None, load_model_strict=True):
+def get_full_config(config):
+    """
+    Returns the complete config for a config stored with a model, filling in defaults and converting old formats.
+    """
     # copy config. Maybe should be a deepcopy?
     passed_config = config.copy()
     config = get_base_config()
     if 'optimizer' not in passed_config:
         passed_config = old_config_to_new(passed_config, config)
     config.update(passed_config)
-    verbose_train, verbose_prior = verbose >= 1, verbose >= 2
-    config['verbose'] = verbose_prior
-
-    criterion = get_criterion(config['prior']['classification']['max_num_classes'])
 
     # backwards compatibility for cases where absence of parameter doesn't correspond to current default
     if 'n_samples' not in passed_config['prior']:
@@ -180,40 +236,59 @@ def get_model(config, device, should_train=True, verbose=False, model_state=None
             config['model_type'] = config['model_maker']
         else:
             config['model_type'] = 'tabpfn'
+    return config
 
-    dl = get_dataloader(prior_config=config['prior'], dataloader_config=config['dataloader'], device=device)
 
-    y_encoder = get_y_encoder(config)
+def build_model(config, device=None):
+    """
+    Creates an untrained model from a complete config, see get_full_config.
+    """
+    with torch.device(device) if device is not None else NOP():
+        y_encoder = get_y_encoder(config)
 
-    encoder = get_encoder(config)
+        encoder = get_encoder(config)
 
-    if config['prior']['classification']['max_num_classes'] > 2:
-        n_out = config['prior']['classification']['max_num_classes']
-    else:
-        n_out = 1
-
-    model_type = config['model_type']
-
-    if model_type in ["mothernet", "mlp"]:
-        model = MotherNet(
-            encoder, n_out=n_out,
-            y_encoder_layer=y_encoder, **config['transformer'], **config['mothernet']
-        )
-    elif model_type == 'perceiver':
-        model = TabPerceiver(
-            encoder_layer=encoder, n_out=n_out,
-            y_encoder_layer=y_encoder, **config['transformer'], **config['mothernet'], **config['perceiver']
-        )
-    elif model_type == "additive":
-        model = MotherNetAdditive(
-            n_out=n_out, n_features=config['prior']['num_features'],
-            y_encoder_layer=y_encoder, **config['transformer'], **config['mothernet'], **config['additive'])
-    elif model_type == "tabpfn":
-        model = TabPFN(
-            encoder, n_out=n_out, y_encoder_layer=y_encoder, **config['transformer']
-        )
-    else:
-        raise ValueError(f"Unknown model type {model_type}.")
+        if config['prior']['classification']['max_num_classes'] > 2:
+            n_out = config['prior']['classification']['max_num_classes']
+        else:
+            n_out = 1
+
+        model_type = config['model_type']
+
+        if model_type in ["mothernet", "mlp"]:
+            model = MotherNet(
+                encoder, n_out=n_out,
+                y_encoder_layer=y_encoder, **config['transformer'], **config['mothernet']
+            )
+        elif model_type == 'perceiver':
+            model = TabPerceiver(
+                encoder_layer=encoder, n_out=n_out,
+                y_encoder_layer=y_encoder, **config['transformer'], **config['mothernet'], **config['perceiver']
+            )
+        elif model_type == "additive":
+            model = MotherNetAdditive(
+                n_out=n_out, n_features=config['prior']['num_features'],
+                y_encoder_layer=y_encoder, **config['transformer'], **config['mothernet'], **config['additive'])
+        elif model_type == "tabpfn":
+            model = TabPFN(
+                encoder, n_out=n_out, y_encoder_layer=y_encoder, **config['transformer']
+            )
+        else:
+            raise ValueError(f"Unknown model type {model_type}.")
+    return model
+
+
+def get_model(config, device, should_train=True, verbose=False, model_state=None, optimizer_state=None,
+              scheduler=None, epoch_callback=None, load_model_strict=True):
+    config = get_full_config(config)
+    verbose_train, verbose_prior = verbose >= 1, verbose >= 2
+    config['verbose'] = verbose_prior
+
+    criterion = get_criterion(config['prior']['classification']['max_num_classes'])
+
+    dl = get_dataloader(prior_config=config['prior'], dataloader_config=config['dataloader'], device=device)
+
+    model = build_model(config)
 
     if model_state is not None:
         if not load_model_strict:
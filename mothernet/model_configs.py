@@ -54,7 +54,8 @@ def get_general_config(max_features, n_samples):
         "batch_size": 8,
         "num_steps": 8192,
         'min_eval_pos': 2,
-        'max_eval_pos': 1000}
+        'max_eval_pos': 1000,
+        'num_workers': 0}
 
     optimizer = {
         "aggregate_k_gradients": 1,
@@ -0,0 +1,154 @@
+import threading
+from collections import OrderedDict
+
+from torch import nn
+
+
+def get_nbytes(value):
+    """
+    Returns the number of bytes of the parameters and buffers of all modules in value, which can be a module or a
+    tuple or list containing modules, like the (model, config) pairs returned by load_model.
+    """
+    modules = [value] if isinstance(value, nn.Module) else [v for v in value if isinstance(v, nn.Module)] \
+        if isinstance(value, (tuple, list)) else []
+    seen = set()
+    nbytes = 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            # tied weights are only counted once
+            if tensor.data_ptr() not in seen:
+                seen.add(tensor.data_ptr())
+                nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+class ModelRegistry:
+    """
+    Thread-safe least-recently-used cache for loaded models, bounded by the memory of their weights.
+
+    get(key, loader) returns the cached value for key, or calls loader and caches the result. When the total size of
+    the cached models exceeds max_bytes, or there are more than max_models entries, the least recently used models are
+    evicted, apart from the one that was just requested. A model that is larger than max_bytes is returned but not cached.
+    Concurrent requests for the same key load the model only once.
+
+    Estimators keep references to the models they use, so evicting a model only releases its memory once no fitted
+    estimator uses it any more.
+    """
+
+    def __init__(self, max_bytes=None, max_models=None):
+        self._max_bytes = max_bytes
+        self._max_models = max_models
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def max_models(self):
+        return self._max_models
+
+    @max_models.setter
+    def max_models(self, max_models):
+        with self._lock:
+            self._max_models = max_models
+            self._evict()
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, n_models=len(self._entries),
+                        nbytes=self.nbytes, max_bytes=self._max_bytes, max_models=self._max_models)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, loader):
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                # another thread might have loaded the model while we were waiting
+                value = self._lookup(key)
+                if value is not None:
+                    return value
+                self.misses += 1
+            try:
+                value = loader()
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+            self.put(key, value)
+            return value
+
+    def put(self, key, value):
+        nbytes = get_nbytes(value)
+        with self._lock:
+            if self._max_bytes is not None and nbytes > self._max_bytes:
+                self.evictions += 1
+                return
+            self._entries[key] = (value, nbytes)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def pop(self, key):
+        with self._lock:
+            value, _ = self._entries.pop(key)
+            return value
+
+    def evict_model(self, model):
+        """
+        Removes the entries whose value is model, or a tuple or list containing it, and returns how many were removed.
+        """
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items()
+                    if value is model or (isinstance(value, (tuple, list)) and any(v is model for v in value))]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _lookup(self, key):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+        return None
+
+    def _evict(self):
+        # the most recently used entry is always kept
+        while len(self._entries) > 1 and ((self._max_models is not None and len(self._entries) > self._max_models)
+                                          or (self._max_bytes is not None and self.nbytes > self._max_bytes)):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+# shared by load_model and all estimators; resize with model_registry.max_bytes = ...
+model_registry = ModelRegistry(max_bytes=4 * 2 ** 30)
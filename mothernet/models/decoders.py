@@ -132,6 +132,36 @@ class FactorizedAdditiveModelDecoder(nn.Module):
             out = torch.einsum('bkr, rdo -> bkdo', res, self.output_weights)
         return out, self.output_biases
 
+    def low_rank_forward(self, x, y_src):
+        """
+        Same as forward, but without expanding the shape functions to all bins. Returns per-feature coefficients, the
+        basis of shape functions shared across features, and the biases, where the output of forward is the product of
+        coefficients and basis over the rank dimension.
+
+        For class_tokens and class_average, coefficients are batch x features x rank x outputs and the basis is
+        rank x bins, otherwise coefficients are batch x features x rank and the basis is rank x bins x outputs.
+        With shape attention, the rank is the number of shape functions and the coefficients are attention weights.
+        """
+        res = self.mlp(self.summary_layer(x, y_src))
+        if self.decoder_type not in ["class_tokens", "class_average"]:
+            return res.reshape(x.shape[1], self.n_features, self.rank), self.output_weights, self.output_biases
+        res = res.reshape(-1, self.n_out, self.n_features, self.rank)
+        if not self.shape_attention:
+            coefficients, basis = res, self.output_weights
+        elif self.shape_attention_heads == 1:
+            coefficients, basis = _attention_weights(res, self.shape_function_keys), self.shape_functions
+        else:
+            heads = zip(self.shape_function_keys, self.feature_heads, self.head_weights)
+            coefficients = sum(weight * _attention_weights(res @ head, key) for key, head, weight in heads)
+            basis = self.shape_functions
+        # batch, outputs, features, rank to batch, features, rank, outputs
+        return coefficients.permute(0, 2, 3, 1), basis, self.output_biases
+
+
+def _attention_weights(query, key):
+    # the attention weights in scaled_dot_product_attention
+    return torch.softmax(query @ key.T / query.shape[-1] ** 0.5, dim=-1)
+
 
 class SummaryLayer(nn.Module):
     def __init__(self, emsize=512, embed_dim=2048, n_out=10, decoder_type='output_attention', nhead=4):
@@ -58,6 +58,17 @@ class BinEmbeddingEncoder(nn.Module):
         out = torch.einsum('nbkr,kre->nbe', embedded, self.weights)
         return out
 
+    def bin_table(self):
+        # The contribution of each bin of each feature to the output, as features x (n_bins + 1) x emsize, where the
+        # last bin is for a feature with an all-zero one-hot vector. forward is the sum of these over features.
+        embedding = torch.cat([self.embedding, torch.zeros_like(self.embedding[:1])])
+        embedded = embedding.unsqueeze(0)
+        if self.nonlinear:
+            embedded = torch.nn.functional.relu(embedded + self.bias[0, 0].unsqueeze(1))
+        else:
+            embedded = embedded.expand(self.num_features, -1, -1)
+        return torch.einsum('kdr,kre->kde', embedded, self.weights)
+
 
 class OneHotAndLinear(nn.Linear):
     def __init__(self, num_classes, emsize):
@@ -1,4 +1,5 @@
-from functools import partial
+import threading
+from contextlib import contextmanager
 
 import torch
 from torch.nn.modules.transformer import (Dropout, LayerNorm, Linear, Module, MultiheadAttention, Optional, Tensor,
@@ -6,6 +7,44 @@ from torch.nn.modules.transformer import (Dropout, LayerNorm, Linear, Module, Mu
 from torch.utils.checkpoint import checkpoint
 
 
+def _merge_masks(attn_mask, key_padding_mask, dtype):
+    # Combines a queries x keys attention mask and a batch x keys padding mask, in the conventions of
+    # nn.MultiheadAttention, into one additive mask for scaled_dot_product_attention.
+    def to_additive(mask):
+        if mask.dtype == torch.bool:
+            return torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill_(mask, float("-inf"))
+        return mask.to(dtype)
+    mask = to_additive(attn_mask) if attn_mask is not None else None
+    if key_padding_mask is not None:
+        padding_mask = to_additive(key_padding_mask)[:, None, None, :]
+        mask = padding_mask if mask is None else mask + padding_mask
+    return mask
+
+
+@contextmanager
+def chunked_attention(model, block_size):
+    """
+    Context manager that makes all TransformerEncoderLayers in model attend with blocks of at most block_size queries
+    of one batch element at a time, so that the attention weights take memory linear instead of quadratic in the
+    number of tokens, and independent of the batch size. The results are the same as without blocks. block_size=None
+    disables blocking.
+
+    The block size only applies to the current thread, as models are shared between estimators through the model
+    registry, and the layers themselves are not modified.
+    """
+    previous = getattr(_attention_block_sizes, "sizes", {})
+    _attention_block_sizes.sizes = {**previous, **{id(module): block_size for module in model.modules()
+                                                   if isinstance(module, TransformerEncoderLayer)}}
+    try:
+        yield model
+    finally:
+        _attention_block_sizes.sizes = previous
+
+
+# the block sizes set by chunked_attention in each thread, by id of the layer
+_attention_block_sizes = threading.local()
+
+
 class TransformerEncoderLayer(Module):
     r"""TransformerEncoderLayer is made up of self-attn and feedforward network.
     This standard encoder layer is based on the paper "Attention Is All You Need".
@@ -57,13 +96,19 @@ class TransformerEncoderLayer(Module):
 
         self.activation = _get_activation_fn(activation)
 
+    @property
+    def attention_block_size(self):
+        # maximum number of queries per call of scaled_dot_product_attention in the current thread, see chunked_attention
+        return getattr(_attention_block_sizes, "sizes", {}).get(id(self))
+
     def forward(self, src: Tensor, src_mask: Optional[Tensor] = None, src_key_padding_mask: Optional[Tensor] = None) -> Tensor:
         r"""Pass the input through the encoder layer.
 
         Args:
             src: the sequence to the encoder layer (required).
             src_mask: the mask for the src sequence (optional).
-            src_key_padding_mask: the mask for the src keys per batch (optional).
+            src_key_padding_mask: the mask for the src keys per batch (optional). As in nn.MultiheadAttention, a
+                float mask is added to the attention logits, which can be used as a per-key bias.
 
         Shape:
             see the docs in Transformer class.
@@ -72,42 +117,47 @@ class TransformerEncoderLayer(Module):
             src_ = self.norm1(src)
         else:
             src_ = src
+        # recomputing only saves memory for the backward pass; the eval position path was never recomputed
+        if self.recompute_attn and torch.is_grad_enabled() and not isinstance(src_mask, int):
+            src2 = checkpoint(self._self_attention, src_, src_mask, src_key_padding_mask)
+        else:
+            src2 = self._self_attention(src_, src_mask, src_key_padding_mask)
+        return self._residual_and_feedforward(src, src2)
+
+    def _self_attention(self, src_, src_mask, src_key_padding_mask):
+        # The parameters of self_attn are used directly, so that the keys and values of every token are projected only
+        # once, even if they are attended to from several groups of queries.
+        assert not self.self_attn.batch_first
         if isinstance(src_mask, tuple):
             # global attention setup
-            assert not self.self_attn.batch_first
             assert src_key_padding_mask is None
 
             global_src_mask, trainset_src_mask, valset_src_mask = src_mask
 
             num_global_tokens = global_src_mask.shape[0]
             num_train_tokens = trainset_src_mask.shape[0]
+            num_global_and_train_tokens = num_global_tokens + num_train_tokens
 
-            global_tokens_src = src_[:num_global_tokens]
-            train_tokens_src = src_[num_global_tokens:num_global_tokens+num_train_tokens]
-            global_and_train_tokens_src = src_[:num_global_tokens+num_train_tokens]
-            eval_tokens_src = src_[num_global_tokens+num_train_tokens:]
+            q, k, v = self._in_projection(src_, 0, 3)
+            global_tokens_src2 = self._attend(q[:num_global_tokens], k[:num_global_and_train_tokens], v[:num_global_and_train_tokens],
+                                              attn_mask=global_src_mask)
+            train_tokens_src2 = self._attend(q[num_global_tokens:num_global_and_train_tokens], k[:num_global_tokens], v[:num_global_tokens],
+                                             attn_mask=trainset_src_mask)
+            eval_tokens_src2 = self._attend(q[num_global_and_train_tokens:], k, v, attn_mask=valset_src_mask)
+            return torch.cat([global_tokens_src2, train_tokens_src2, eval_tokens_src2], dim=0)
 
-            attn = partial(checkpoint, self.self_attn) if self.recompute_attn else self.self_attn
-
-            global_tokens_src2 = attn(global_tokens_src, global_and_train_tokens_src, global_and_train_tokens_src, None, True, global_src_mask)[0]
-            train_tokens_src2 = attn(train_tokens_src, global_tokens_src, global_tokens_src, None, True, trainset_src_mask)[0]
-            eval_tokens_src2 = attn(eval_tokens_src, src_, src_,
-                                    None, True, valset_src_mask)[0]
+        if isinstance(src_mask, int):
+            single_eval_position = src_mask
+            # all tokens attend to the training tokens only, so only their padding matters
+            train_padding_mask = src_key_padding_mask[:, :single_eval_position] if src_key_padding_mask is not None else None
+            q_train, k, v = self._in_projection(src_[:single_eval_position], 0, 3)
+            q = torch.cat([q_train, self._in_projection(src_[single_eval_position:], 0)], dim=0)
+            return self._attend(q, k, v, key_padding_mask=train_padding_mask)
 
-            src2 = torch.cat([global_tokens_src2, train_tokens_src2, eval_tokens_src2], dim=0)
+        q, k, v = self._in_projection(src_, 0, 3)
+        return self._attend(q, k, v, attn_mask=src_mask, key_padding_mask=src_key_padding_mask)
 
-        elif isinstance(src_mask, int):
-            assert src_key_padding_mask is None
-            single_eval_position = src_mask
-            src_left = self.self_attn(src_[:single_eval_position], src_[:single_eval_position], src_[:single_eval_position])[0]
-            src_right = self.self_attn(src_[single_eval_position:], src_[:single_eval_position], src_[:single_eval_position])[0]
-            src2 = torch.cat([src_left, src_right], dim=0)
-        else:
-            if self.recompute_attn:
-                src2 = checkpoint(self.self_attn, src_, src_, src_, src_key_padding_mask, True, src_mask)[0]
-            else:
-                src2 = self.self_attn(src_, src_, src_, attn_mask=src_mask,
-                                      key_padding_mask=src_key_padding_mask)[0]
+    def _residual_and_feedforward(self, src, src2):
         src = src + self.dropout1(src2)
         if not self.pre_norm:
             src = self.norm1(src)
@@ -122,3 +172,71 @@ class TransformerEncoderLayer(Module):
         if not self.pre_norm:
             src = self.norm2(src)
         return src
+
+    def _in_projection(self, x, start, stop=None):
+        # projects x with the parts start to stop of the packed input projection, where 0, 1, 2 are the query, key and
+        # value parts, returning a tuple if there is more than one part
+        stop = start + 1 if stop is None else stop
+        embed_dim = self.self_attn.embed_dim
+        weight = self.self_attn.in_proj_weight[start * embed_dim:stop * embed_dim]
+        bias = self.self_attn.in_proj_bias[start * embed_dim:stop * embed_dim]
+        projected = torch.nn.functional.linear(x, weight, bias)
+        return projected.chunk(stop - start, dim=-1) if stop - start > 1 else projected
+
+    def _attend(self, q, k, v, attn_mask=None, key_padding_mask=None):
+        # q is queries x batch x emsize, k and v are keys x batch x emsize, all already projected.
+        # Masks follow nn.MultiheadAttention: boolean masks are True where attention is not allowed, float masks are added.
+        nhead = self.self_attn.num_heads
+        head_dim = self.self_attn.head_dim
+        n_queries, batch_size, emsize = q.shape
+        q = q.reshape(n_queries, batch_size, nhead, head_dim).permute(1, 2, 0, 3)
+        k = k.reshape(k.shape[0], batch_size, nhead, head_dim).permute(1, 2, 0, 3)
+        v = v.reshape(v.shape[0], batch_size, nhead, head_dim).permute(1, 2, 0, 3)
+        mask = _merge_masks(attn_mask, key_padding_mask, q.dtype)
+        dropout_p = self.self_attn.dropout if self.training else 0.0
+        block_size = self.attention_block_size
+        if block_size is None or (n_queries <= block_size and batch_size == 1):
+            attn_output = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p)
+        else:
+            # Queries are independent given the keys and values, so they can be processed in blocks, one batch element
+            # at a time, which keeps the attention weights of each call small. Keys and values are made contiguous once
+            # instead of in every call.
+            k, v = k.contiguous(), v.contiguous()
+            outputs = []
+            for b in range(batch_size):
+                batch_mask = mask[b:b + 1] if mask is not None and mask.dim() == 4 and mask.shape[0] == batch_size else mask
+                blocks = []
+                for start in range(0, n_queries, block_size):
+                    block_mask = batch_mask
+                    if batch_mask is not None and batch_mask.shape[-2] == n_queries:
+                        block_mask = batch_mask[..., start:start + block_size, :]
+                    blocks.append(torch.nn.functional.scaled_dot_product_attention(
+                        q[b:b + 1, :, start:start + block_size], k[b:b + 1], v[b:b + 1], attn_mask=block_mask, dropout_p=dropout_p))
+                outputs.append(torch.cat(blocks, dim=2))
+            attn_output = torch.cat(outputs, dim=0)
+        attn_output = attn_output.permute(2, 0, 1, 3).reshape(n_queries, batch_size, emsize)
+        return self.self_attn.out_proj(attn_output)
+
+    def encode_context(self, src: Tensor) -> tuple:
+        r"""Pass training tokens through the layer and return the attention keys and values they provide.
+
+        Training tokens only attend to each other, so the returned keys and values can be reused
+        with ``forward_with_context`` for any number of test tokens.
+
+        Returns:
+            the layer output for the training tokens and a tuple (keys, values).
+        """
+        src_ = self.norm1(src) if self.pre_norm else src
+        q, k, v = self._in_projection(src_, 0, 3)
+        src2 = self._attend(q, k, v)
+        return self._residual_and_feedforward(src, src2), (k, v)
+
+    def forward_with_context(self, src: Tensor, context: tuple) -> Tensor:
+        r"""Pass test tokens through the layer, attending to keys and values from ``encode_context``.
+
+        This is equivalent to the test part of ``forward`` with an integer ``src_mask``.
+        """
+        src_ = self.norm1(src) if self.pre_norm else src
+        k, v = context
+        src2 = self._attend(self._in_projection(src_, 0), k, v)
+        return self._residual_and_feedforward(src, src2)
@@ -80,16 +80,34 @@ class MotherNetAdditive(nn.Module):
                     nn.init.zeros_(attn.out_proj.weight)
                     nn.init.zeros_(attn.out_proj.bias)
 
+    def encode_bins(self, X_binned, zero_padding):
+        """
+        Same as self.encoder applied to the one-hot encoding of bin_data, computed from the bin indices and padding
+        mask of bin_data_indices with a sum over a per-bin lookup table, without the dense one-hot tensor.
+        """
+        if isinstance(self.encoder, BinEmbeddingEncoder):
+            table, bias = self.encoder.bin_table(), None
+        else:
+            # flatten and linear layer on the features x bins one-hot encoding
+            linear = self.encoder[1]
+            table = linear.weight.T.reshape(-1, self.n_bins, linear.weight.shape[0])
+            table, bias = nn.functional.pad(table, (0, 0, 0, 1)), linear.bias
+        # the table is shared by all batch elements, so it is not repeated over the batch
+        out = sum_bins(X_binned, zero_padding, table)
+        return out if bias is None else out + bias
+
     def forward(self, src, single_eval_pos=None):
         assert isinstance(src, tuple), 'inputs (src) have to be given as (x,y) or (style,x,y) tuple'
 
         _, x_src_org, y_src_org = src
-        X_onehot, _ = bin_data(x_src_org, n_bins=self.n_bins,
-                               single_eval_pos=single_eval_pos)
-        X_onehot = X_onehot.float()
         if self.input_layer_norm:
-            X_onehot = self.input_norm(X_onehot)
-        x_src = self.encoder(X_onehot)
+            # the layer norm needs the dense one-hot encoding
+            X_onehot, _ = bin_data(x_src_org, n_bins=self.n_bins, single_eval_pos=single_eval_pos)
+            X_onehot = self.input_norm(X_onehot.float())
+            x_src = self.encoder(X_onehot)
+        else:
+            X_binned, zero_padding, _ = bin_data_indices(x_src_org, n_bins=self.n_bins, single_eval_pos=single_eval_pos)
+            x_src = self.encode_bins(X_binned, zero_padding)
         y_src = self.y_encoder(y_src_org.unsqueeze(-1) if len(y_src_org.shape) < len(x_src.shape) else y_src_org)
         enc_train = x_src[:single_eval_pos] + y_src[:single_eval_pos]
 
@@ -104,8 +122,11 @@ class MotherNetAdditive(nn.Module):
 
         output = self.transformer_encoder(enc_train)
         weights, biases = self.decoder(output, y_src_org[:single_eval_pos])
-        # n samples, b batch, k feature, d bins, o outputs
-        h = torch.einsum("nbkd,bkdo->nbo", X_onehot[single_eval_pos:], weights)
+        if self.input_layer_norm:
+            # n samples, b batch, k feature, d bins, o outputs
+            h = torch.einsum("nbkd,bkdo->nbo", X_onehot[single_eval_pos:], weights)
+        else:
+            h = sum_bins(X_binned[single_eval_pos:], zero_padding, nn.functional.pad(weights, (0, 0, 0, 1)))
         h = h + biases
 
         if h.isnan().all():
@@ -115,21 +136,90 @@ class MotherNetAdditive(nn.Module):
         return h
 
 
-def bin_data(data, n_bins, single_eval_pos=None):
-    # data is samples x batch x features
+def quantile_bin_edges(data, n_bins):
+    """
+    Returns the n_bins - 1 inner quantiles of data along the first dimension, the same as torch.quantile with linear
+    interpolation.
+
+    Each column is sorted once and the quantiles are read off the sorted data, in the layout of data, so there is no
+    limit on the number of samples as in torch.quantile.
+    """
+    sorted_data = torch.sort(data, dim=0).values
+    quantiles = torch.arange(1, n_bins, device=data.device, dtype=data.dtype) / n_bins
+    ranks = quantiles * (data.shape[0] - 1)
+    below = ranks.long()
+    above = ranks.ceil().long()
+    weights = (ranks - below).reshape((-1,) + (1,) * (data.dim() - 1))
+    return torch.lerp(sorted_data[below], sorted_data[above], weights)
+
+
+def searchsorted_columns(sorted_sequence, values, block_size=2 ** 17):
+    """
+    torch.searchsorted along the first dimension: for sorted_sequence of shape m x ... sorted along the first dimension
+    and values of shape n x ..., returns for every value the number of entries of its column in sorted_sequence that
+    are smaller than the value.
+
+    This is a branchless binary search with gathers in the layout of the inputs, so neither needs to be transposed.
+    Values are processed in blocks of rows with about block_size entries, so that the search state stays in cache.
+    """
+    n_steps = sorted_sequence.shape[0].bit_length()
+    # pad to 2 ** n_steps - 1 entries with inf, which are never smaller than a value
+    padding = sorted_sequence.new_full((2 ** n_steps - 1 - sorted_sequence.shape[0],) + sorted_sequence.shape[1:], float('inf'))
+    sorted_sequence = torch.cat([sorted_sequence, padding])
+    position = torch.zeros(values.shape, dtype=torch.long, device=values.device)
+    block_rows = max(1, block_size // max(1, values[:1].numel()))
+    for start in range(0, values.shape[0], block_rows):
+        block, block_position = values[start:start + block_rows], position[start:start + block_rows]
+        for step in reversed(range(n_steps)):
+            block_position.add_(torch.gather(sorted_sequence, 0, block_position + (2 ** step - 1)) < block, alpha=2 ** step)
+    return position
+
+
+def bin_data_indices(data, n_bins, single_eval_pos=None):
+    """
+    Bins data of shape samples x batch x features into n_bins quantile bins per feature.
+
+    Returns the bin index of every entry as an integer tensor of the shape of data, a batch x features boolean tensor
+    that is True for features that are zero for all samples, which are padding, and the bin edges.
+    """
     # FIXME treat NaN as separate bin
     data_nona = torch.nan_to_num(data, nan=0)
-    quantiles = torch.arange(n_bins + 1, device=data.device) / n_bins
-    if single_eval_pos is None:
-        bin_edges = torch.quantile(data_nona, quantiles[1:-1], dim=0)
-    else:
-        bin_edges = torch.quantile(data_nona[:single_eval_pos], quantiles[1:-1], dim=0)
+    bin_edges = quantile_bin_edges(data_nona if single_eval_pos is None else data_nona[:single_eval_pos], n_bins)
     zero_padding = (data_nona == 0).all(axis=0)
-    # FIXME extra data copy
-    bin_edges = bin_edges.transpose(0, -1).contiguous()
-    data_nona = data_nona.transpose(0, -1).contiguous()
-    X_binned = torch.searchsorted(bin_edges, data_nona)
-    X_onehot = nn.functional.one_hot(X_binned.transpose(0, -1), num_classes=n_bins)
+    X_binned = searchsorted_columns(bin_edges, data_nona)
+    return X_binned, zero_padding, bin_edges.transpose(0, -1)
+
+
+def bin_data(data, n_bins, single_eval_pos=None):
+    # data is samples x batch x features
+    X_binned, zero_padding, bin_edges = bin_data_indices(data, n_bins, single_eval_pos=single_eval_pos)
+    X_onehot = nn.functional.one_hot(X_binned, num_classes=n_bins)
     # mask zero padding data
     X_onehot[:, zero_padding, :] = 0
     return X_onehot, bin_edges
+
+
+def sum_bins(X_binned, zero_padding, table):
+    """
+    Sums table over features at the bins of X_binned, which is the same as contracting the one-hot encoding of the
+    bins with table, without creating the one-hot encoding.
+
+    Args:
+        X_binned: samples x batch x features bin indices from bin_data_indices.
+        zero_padding: batch x features mask of padding features, which select the last bin of table.
+        table: batch x features x (n_bins + 1) x outputs, or features x (n_bins + 1) x outputs for a table that is
+            shared by all batch elements.
+
+    Returns:
+        samples x batch x outputs.
+    """
+    n_samples, batch_size, n_features = X_binned.shape
+    n_table_bins, n_outputs = table.shape[-2:]
+    X_binned = X_binned.masked_fill(zero_padding, n_table_bins - 1)
+    if table.dim() == 3:
+        offsets = torch.arange(n_features, device=X_binned.device) * n_table_bins
+    else:
+        offsets = torch.arange(batch_size * n_features, device=X_binned.device).reshape(batch_size, n_features) * n_table_bins
+    flat = (X_binned + offsets).reshape(n_samples * batch_size, n_features)
+    out = nn.functional.embedding_bag(flat, table.reshape(-1, n_outputs), mode='sum')
+    return out.reshape(n_samples, batch_size, n_outputs)
@@ -113,6 +113,32 @@ class Attention(nn.Module):
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
 
+    def forward_streaming(self, x, contexts):
+        # Same as forward(x, context) without mask or dropout, where context is the concatenation of the iterable
+        # contexts along the sequence dimension. The softmax is accumulated one context block at a time with a running
+        # maximum and sum of the attention logits, so memory does not depend on the total context length.
+        h = self.heads
+        q = rearrange(self.to_q(x), 'b n (h d) -> (b h) n d', h=h)
+        running_max = torch.full((*q.shape[:2], 1), float('-inf'), dtype=q.dtype, device=q.device)
+        running_sum = torch.zeros_like(running_max)
+        out = None
+        for context in contexts:
+            k, v = self.to_kv(context).chunk(2, dim=-1)
+            k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (k, v))
+            sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
+            new_max = torch.maximum(running_max, sim.amax(dim=-1, keepdim=True))
+            # rescales what was accumulated with the previous maximum, which is zero for the first block
+            correction = torch.exp(running_max - new_max)
+            weights = torch.exp(sim - new_max)
+            running_sum = running_sum * correction + weights.sum(dim=-1, keepdim=True)
+            block_out = einsum('b i j, b j d -> b i d', weights, v)
+            out = block_out if out is None else out * correction + block_out
+            running_max = new_max
+        if out is None:
+            raise ValueError("Empty context")
+        out = rearrange(out / running_sum, '(b h) n d -> b n (h d)', h=h)
+        return self.to_out(out)
+
 # main class
 
 
@@ -364,3 +390,28 @@ class TabPerceiver(MLPModelPredictor):
 
         x = rearrange(x, 'b n d -> n b d')
         return x
+
+    def inner_forward_streaming(self, make_chunks, batch_size=1):
+        """
+        Same as inner_forward for the concatenation of the chunks along the first dimension, without keeping more than
+        one chunk in memory.
+
+        Args:
+            make_chunks: function without arguments that returns an iterable of encoded training chunks of shape
+                n_chunk x batch_size x emsize. It is called once per layer, as each cross attention needs a pass over
+                the data.
+            batch_size: the batch dimension of the chunks.
+        """
+        x = repeat(self.latents, 'n d -> b n d', b=batch_size)
+        for layer in self.layers:
+            norm_context = layer.cross_attn.norm_context
+            contexts = (norm_context(rearrange(chunk, 'n b d -> b n d')) for chunk in make_chunks())
+            x = layer.cross_attn.fn.forward_streaming(layer.cross_attn.norm(x), contexts) + x
+            x = layer.cross_ff(x) + x
+
+            for latent in layer.latents:
+                x = latent.latent_attn(x) + x
+                x = latent.latent_ff(x) + x
+
+        x = rearrange(x, 'b n d -> n b d')
+        return x
@@ -5,6 +5,7 @@ import torch.nn as nn
 from torch import Tensor
 from torch.nn import Module, TransformerEncoder
 
+from mothernet.models.encoders import NanHandlingEncoder
 from mothernet.models.layer import TransformerEncoderLayer
 from mothernet.utils import SeqBN, get_init_method
 
@@ -45,7 +46,9 @@ class TabPFN(nn.Module):
                     nn.init.zeros_(attn.out_proj.weight)
                     nn.init.zeros_(attn.out_proj.bias)
 
-    def forward(self, src, src_mask=None, single_eval_pos=None):
+    def forward(self, src, src_mask=None, single_eval_pos=None, src_key_padding_mask=None):
+        # src_key_padding_mask is batch x sequence and True for padding tokens, which are not attended to. A float mask is
+        # added to the attention logits of each key instead, e.g. the log multiplicity of a training point.
         assert isinstance(src, tuple), 'inputs (src) have to be given as (x,y) or (style,x,y) tuple'
 
         if len(src) == 3:  # style is given
@@ -68,10 +71,45 @@ class TabPFN(nn.Module):
         if self.input_ln is not None:
             src = self.input_ln(src)
 
-        output = self.transformer_encoder(src, src_mask)
+        output = self.transformer_encoder(src, src_mask, src_key_padding_mask=src_key_padding_mask)
         output = self.decoder(output)
         return output[single_eval_pos:]
 
+    def context_is_cacheable(self, x):
+        # NanHandlingEncoder normalizes the missing value indicators over the whole sequence,
+        # so the training tokens only stay independent of the test tokens if there is nothing to indicate.
+        if isinstance(self.encoder, NanHandlingEncoder) and self.encoder.keep_nans:
+            return bool(torch.isfinite(x).all())
+        return True
+
+    def encode_context(self, x_train, y_train):
+        """Compute the attention keys and values of the training tokens for each layer.
+
+        With efficient eval masking, training tokens never attend to test tokens, so the result can be
+        passed to ``forward_with_context`` to predict any number of test points without recomputing it.
+        """
+        x_src = self.encoder(x_train)
+        y_src = self.y_encoder(y_train.unsqueeze(-1) if len(y_train.shape) < len(x_src.shape) else y_train)
+        src = x_src + y_src
+        if self.input_ln is not None:
+            src = self.input_ln(src)
+        context = []
+        for layer in self.transformer_encoder.layers:
+            src, layer_context = layer.encode_context(src)
+            context.append(layer_context)
+        return context
+
+    def forward_with_context(self, x_test, context):
+        """Predict the test tokens x_test using the training context computed by ``encode_context``."""
+        src = self.encoder(x_test)
+        if self.input_ln is not None:
+            src = self.input_ln(src)
+        for layer, layer_context in zip(self.transformer_encoder.layers, context):
+            src = layer.forward_with_context(src, layer_context)
+        if self.transformer_encoder.norm is not None:
+            src = self.transformer_encoder.norm(src)
+        return self.decoder(src)
+
 
 class TransformerEncoderDiffInit(Module):
     r"""TransformerEncoder is a stack of N encoder layers
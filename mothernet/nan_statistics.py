@@ -0,0 +1,66 @@
+"""
+Vectorized statistics of tensors with missing values.
+
+All functions reduce along one dimension and ignore NaNs (or, if a mask is given, the elements where the mask is False).
+They work on all columns at once and only create temporaries of the size of the input, without Python loops over
+columns.
+"""
+from typing import NamedTuple
+
+import torch
+
+
+class NanStatistics(NamedTuple):
+    count: torch.Tensor
+    mean: torch.Tensor
+    var: torch.Tensor
+    min: torch.Tensor
+    max: torch.Tensor
+
+
+def _valid(x, mask):
+    return ~torch.isnan(x) if mask is None else mask
+
+
+def _masked_count_mean_var(x, mask, dim):
+    # the squared deviations are computed from the mean in a second reduction, which is numerically safer than summing
+    # squares, and gives the same results as the masked mean and std helpers in mothernet.utils always did
+    zero = torch.zeros((), dtype=x.dtype, device=x.device)
+    count = mask.sum(dim=dim).to(x.dtype)
+    mean = torch.where(mask, x, zero).sum(dim=dim) / count
+    var = torch.square(torch.where(mask, x - mean.unsqueeze(dim), zero)).sum(dim=dim) / (count - 1)
+    return count, mean, var
+
+
+def nan_statistics(x, dim=0, mask=None):
+    """
+    Returns the count of valid values, mean, unbiased variance, minimum and maximum of x along dim.
+
+    Reductions over no valid values give NaN for the mean, variance, minimum and maximum.
+    """
+    mask = _valid(x, mask)
+    count, mean, var = _masked_count_mean_var(x, mask, dim)
+    minimum = torch.where(mask, x, torch.full((), float('inf'), dtype=x.dtype, device=x.device)).amin(dim=dim)
+    maximum = torch.where(mask, x, torch.full((), float('-inf'), dtype=x.dtype, device=x.device)).amax(dim=dim)
+    empty = count == 0
+    return NanStatistics(count, mean, var.masked_fill(empty, float('nan')), minimum.masked_fill(empty, float('nan')),
+                         maximum.masked_fill(empty, float('nan')))
+
+
+def nan_mean_std(x, dim=0, mask=None):
+    """
+    Returns the mean and unbiased standard deviation of x along dim, ignoring NaNs or the elements where mask is False.
+    """
+    _, mean, var = _masked_count_mean_var(x, _valid(x, mask), dim)
+    return mean, torch.sqrt(var)
+
+
+def constant_columns(x, dim=0):
+    """
+    Returns a boolean tensor that is True where x has at most one distinct non-NaN value along dim.
+    """
+    mask = ~torch.isnan(x)
+    minimum = torch.where(mask, x, torch.full((), float('inf'), dtype=x.dtype, device=x.device)).amin(dim=dim)
+    maximum = torch.where(mask, x, torch.full((), float('-inf'), dtype=x.dtype, device=x.device)).amax(dim=dim)
+    # no valid values give minimum inf and maximum -inf
+    return ~(maximum > minimum)
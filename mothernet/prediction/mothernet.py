@@ -3,18 +3,22 @@ import random
 
 import numpy as np
 import torch
-from einops import rearrange, repeat
+from scipy.special import softmax
 from sklearn.base import BaseEstimator, ClassifierMixin, clone
 from sklearn.ensemble import VotingClassifier
 from sklearn.feature_selection import VarianceThreshold
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import LabelEncoder, PowerTransformer, StandardScaler
 
+from mothernet.artifact import MLPPredictor, save_artifact, standardize
 from mothernet.model_builder import load_model
+from mothernet.models.layer import chunked_attention
+from mothernet.models.perceiver import TabPerceiver
 from mothernet.utils import normalize_by_used_features_f, normalize_data
 
 
-def extract_linear_model(model, X_train, y_train, device="cpu"):
+@torch.inference_mode()
+def extract_linear_model(model, X_train, y_train, device="cpu", attention_block_size=None):
     max_features = 100
     eval_position = X_train.shape[0]
     n_classes = len(np.unique(y_train))
@@ -32,7 +36,8 @@ def extract_linear_model(model, X_train, y_train, device="cpu"):
     x_src = model.encoder(x_all_torch.unsqueeze(1)[:len(X_train)])
     y_src = model.y_encoder(ys.unsqueeze(1).unsqueeze(-1))
     train_x = x_src + y_src
-    output = model.transformer_encoder(train_x)
+    with chunked_attention(model, attention_block_size):
+        output = model.transformer_encoder(train_x)
     linear_model_coefs = model.decoder(output)
     encoder_weight = model.encoder.get_parameter("weight")
     encoder_bias = model.encoder.get_parameter("bias")
@@ -42,76 +47,151 @@ def extract_linear_model(model, X_train, y_train, device="cpu"):
     return total_weights.detach().cpu().numpy() / (n_features / max_features), total_biases.detach().cpu().numpy()
 
 
-def extract_mlp_model(model, X_train, y_train, device="cpu", inference_device="cpu", scale=True):
-    if "cuda" in inference_device and device == "cpu":
-        raise ValueError("Cannot run inference on cuda when model is on cpu")
+def _encode_training_data(model, xs, ys):
+    # xs are the standardized or clipped training features, ys the encoded labels
     max_features = 100
-    eval_position = X_train.shape[0]
-    n_classes = len(np.unique(y_train))
-    n_features = X_train.shape[1]
+    if xs.shape[1] > max_features:
+        raise ValueError("Cannot run inference on data with more than 100 features")
+    eval_xs = normalize_by_used_features_f(xs, xs.shape[-1], max_features)
+    x_all_torch = torch.concat([eval_xs, torch.zeros((xs.shape[0], max_features - xs.shape[1]), device=xs.device)], axis=1)
+    x_src = model.encoder(x_all_torch.unsqueeze(1))
+    y_src = model.y_encoder(ys.unsqueeze(1).unsqueeze(-1))
+    return x_src + y_src
 
-    ys = torch.Tensor(y_train).to(device)
-    xs = torch.Tensor(X_train).to(device)
-    if scale:
-        eval_xs_ = normalize_data(xs, eval_position)
-    else:
-        eval_xs_ = torch.clip(xs, min=-100, max=100)
 
-    eval_xs = normalize_by_used_features_f(
-        eval_xs_, X_train.shape[-1], max_features)
-    if X_train.shape[1] > 100:
-        raise ValueError("Cannot run inference on data with more than 100 features")
-    x_all_torch = torch.concat([eval_xs, torch.zeros((X_train.shape[0], 100 - X_train.shape[1]), device=device)], axis=1)
+def _mlp_layers_from_output(model, output, ys, n_features, n_classes, inference_device="cpu"):
+    # returns the layers of the MLP for each element of the batch, where n_features has the number of features of each
+    max_features = 100
+    (b1, w1), *layers = model.decoder(output, ys)
+    shared_weights = model.decoder.shared_weights if model.decoder.weight_embedding_rank is not None else None
 
-    x_src = model.encoder(x_all_torch.unsqueeze(1)[:len(X_train)])
-    y_src = model.y_encoder(ys.unsqueeze(1).unsqueeze(-1))
-    train_x = x_src + y_src
-    if hasattr(model, "transformer_encoder"):
-        # tabpfn mlp model maker
-        output = model.transformer_encoder(train_x)
+    if inference_device == "cpu":
+        def detach(x):
+            return x.detach().cpu().numpy()
     else:
-        # perceiver
-        data = rearrange(train_x, 'n b d -> b n d')
-        x = repeat(model.latents, 'n d -> b n d', b=data.shape[0])
+        def detach(x):
+            return x.detach()
 
-        # layers
-        for cross_attn, cross_ff, self_attns in model.layers:
-            x = cross_attn(x, context=data) + x
-            x = cross_ff(x) + x
+    result = []
+    for i, n in enumerate(n_features):
+        w1_data_space = w1[i, :n, :] / (n / max_features)
+        if shared_weights is not None:
+            w1_data_space = torch.matmul(w1_data_space, shared_weights[0])
 
-            for self_attn, self_ff in self_attns:
-                x = self_attn(x) + x
-                x = self_ff(x) + x
+        layers_result = [(b1[i], w1_data_space)]
 
-        output = rearrange(x, 'b n d -> n b d')
-    (b1, w1), *layers = model.decoder(output, ys)
+        for j, (b, w) in enumerate(layers[:-1]):
+            w = w[i]
+            if shared_weights is not None:
+                w = torch.matmul(w, shared_weights[j + 1])
+            layers_result.append((b[i], w))
 
-    w1_data_space_prenorm = w1.squeeze()[:n_features, :]
-    b1_data_space = b1.squeeze()
+        # remove extra classes on output layer
+        layers_result.append((layers[-1][0][i, :n_classes], layers[-1][1][i, :, :n_classes]))
+        result.append([(detach(b), detach(w)) for (b, w) in layers_result])
+    return result
 
-    w1_data_space = w1_data_space_prenorm / (n_features / max_features)
 
-    if model.decoder.weight_embedding_rank is not None:
-        w1_data_space = torch.matmul(w1_data_space, model.decoder.shared_weights[0])
+def extract_mlp_model(model, X_train, y_train, device="cpu", inference_device="cpu", scale=True, attention_block_size=None):
+    return extract_mlp_models(model, [X_train], [y_train], device=device, inference_device=inference_device, scale=scale,
+                              attention_block_size=attention_block_size)[0]
 
-    layers_result = [(b1_data_space, w1_data_space)]
 
-    for i, (b, w) in enumerate(layers[:-1]):
-        if model.decoder.weight_embedding_rank is not None:
-            w = torch.matmul(w, model.decoder.shared_weights[i + 1])
-        layers_result.append((b.squeeze(), w.squeeze()))
+@torch.inference_mode()
+def extract_mlp_models(model, X_trains, y_trains, device="cpu", inference_device="cpu", scale=True, attention_block_size=None):
+    """
+    Same as extract_mlp_model for several training sets with the same number of samples and classes, which are stacked
+    along the batch dimension of the model and processed in a single forward pass. Returns a list with the layers of
+    the MLP for each training set.
 
-    # remove extra classes on output layer
-    layers_result.append((layers[-1][0].squeeze()[:n_classes], layers[-1][1].squeeze()[:, :n_classes]))
+    The attention processes attention_block_size queries of one training set at a time, so its memory does not grow
+    with the number of training sets.
+    """
+    if "cuda" in inference_device and device == "cpu":
+        raise ValueError("Cannot run inference on cuda when model is on cpu")
+    n_classes = len(np.unique(y_trains[0]))
+    n_features = [X_train.shape[1] for X_train in X_trains]
 
-    if inference_device == "cpu":
-        def detach(x):
-            return x.detach().cpu().numpy()
+    train_xs, ys_list = [], []
+    for X_train, y_train in zip(X_trains, y_trains):
+        ys = torch.Tensor(y_train).to(device)
+        xs = torch.Tensor(X_train).to(device)
+        if scale:
+            eval_xs_ = normalize_data(xs, X_train.shape[0])
+        else:
+            eval_xs_ = torch.clip(xs, min=-100, max=100)
+        train_xs.append(_encode_training_data(model, eval_xs_, ys))
+        ys_list.append(ys)
+    train_x = torch.cat(train_xs, dim=1)
+    ys = torch.stack(ys_list, dim=1)
+
+    if hasattr(model, "transformer_encoder"):
+        # tabpfn mlp model maker
+        with chunked_attention(model, attention_block_size):
+            output = model.transformer_encoder(train_x)
     else:
-        def detach(x):
-            return x.detach()
+        # perceiver
+        output = model.inner_forward(train_x)
+    return _mlp_layers_from_output(model, output, ys, n_features, n_classes, inference_device=inference_device)
 
-    return [(detach(b), detach(w)) for (b, w) in layers_result]
+
+@torch.inference_mode()
+def extract_mlp_model_streaming(model, make_chunks, n_features, n_classes, mean=None, std=None, device="cpu", inference_device="cpu"):
+    """
+    Same as extract_mlp_model for a TabPerceiver, with the training data given in chunks, of which only one is in
+    memory at a time.
+
+    make_chunks is a function without arguments returning an iterable of (X, y) chunks, with y label encoded. It is
+    called once for each layer of the model. mean and std are the statistics of the features used for standardization
+    as in normalize_data, if they are None, the features are only clipped as for scale=False.
+    """
+    if "cuda" in inference_device and device == "cpu":
+        raise ValueError("Cannot run inference on cuda when model is on cpu")
+    if mean is not None:
+        mean = torch.Tensor(mean).to(device)
+        std = torch.Tensor(std).to(device)
+
+    def encoded_chunks():
+        for X_chunk, y_chunk in make_chunks():
+            xs = torch.Tensor(np.asarray(X_chunk)).to(device)
+            if mean is not None:
+                xs = (xs - mean) / (std + .000001)
+            yield _encode_training_data(model, torch.clip(xs, min=-100, max=100), torch.Tensor(np.asarray(y_chunk)).to(device))
+
+    output = model.inner_forward_streaming(encoded_chunks)
+    # the output_attention decoder of the perceiver does not use the labels
+    return _mlp_layers_from_output(model, output, None, [n_features], n_classes, inference_device=inference_device)[0]
+
+
+def scan_training_chunks(chunks):
+    """
+    Returns the per-feature mean and unbiased standard deviation ignoring NaNs, as nan_mean_std, and the sorted unique
+    labels of an iterable of (X, y) chunks, in a single pass. Chunk statistics are merged with the parallel variance
+    formula in float64.
+    """
+    count = mean = m2 = None
+    classes = np.array([])
+    for X_chunk, y_chunk in chunks:
+        X_chunk = np.asarray(X_chunk, dtype=np.float64)
+        classes = np.union1d(classes, np.unique(y_chunk)) if len(classes) else np.unique(y_chunk)
+        valid = ~np.isnan(X_chunk)
+        chunk_count = valid.sum(axis=0)
+        chunk_mean = np.where(valid, X_chunk, 0).sum(axis=0) / np.maximum(chunk_count, 1)
+        chunk_m2 = np.square(np.where(valid, X_chunk - chunk_mean, 0)).sum(axis=0)
+        if count is None:
+            count, mean, m2 = chunk_count, chunk_mean, chunk_m2
+            continue
+        total = count + chunk_count
+        delta = chunk_mean - mean
+        mean = mean + delta * chunk_count / np.maximum(total, 1)
+        m2 = m2 + chunk_m2 + np.square(delta) * count * chunk_count / np.maximum(total, 1)
+        count = total
+    if count is None:
+        raise ValueError("No training data")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, mean, np.nan)
+        std = np.sqrt(np.where(count > 1, m2 / (count - 1), np.nan))
+    return mean, std, classes
 
 
 def predict_with_linear_model(X_train, X_test, weights, biases):
@@ -150,27 +230,7 @@ class ForwardLinearModel(ClassifierMixin, BaseEstimator):
 
 def predict_with_mlp_model(X_train, X_test, layers, scale=True, inference_device="cpu"):
     if inference_device == "cpu":
-        mean = np.nanmean(X_train, axis=0)
-        std = np.nanstd(X_train, axis=0, ddof=1) + .000001
-        # FIXME replacing nan with 0 as in TabPFN
-        X_train = np.nan_to_num(X_train, 0)
-        X_test = np.nan_to_num(X_test, 0)
-        if scale:
-            std[np.isnan(std)] = 1
-            X_test_scaled = (X_test - mean) / std
-        else:
-            X_test_scaled = X_test
-        out = np.clip(X_test_scaled, a_min=-100, a_max=100)
-        for i, (b, w) in enumerate(layers):
-            out = np.dot(out, w) + b
-            if i != len(layers) - 1:
-                out = np.maximum(out, 0)
-        if np.isnan(out).any():
-            print("NAN")
-            import pdb
-            pdb.set_trace()
-        from scipy.special import softmax
-        return softmax(out / .8, axis=1)
+        return MLPPredictor.from_training_data(X_train, layers, scale=scale).predict_proba(X_test)
     elif "cuda" in inference_device:
         mean = torch.Tensor(np.nanmean(X_train, axis=0)).to(inference_device)
         std = torch.Tensor(np.nanstd(X_train, axis=0, ddof=1) + .000001).to(inference_device)
@@ -193,41 +253,113 @@ def predict_with_mlp_model(X_train, X_test, layers, scale=True, inference_device
 
 
 class MotherNetClassifier(ClassifierMixin, BaseEstimator):
-    def __init__(self, path=None, device="cpu", label_offset=0, scale=True, inference_device="cpu"):
+    def __init__(self, path=None, device="cpu", label_offset=0, scale=True, inference_device="cpu", low_precision=None,
+                 attention_block_size=1024):
         self.path = path
         self.device = device
         self.label_offset = label_offset
         self.inference_device = inference_device
         self.scale = scale
-
-    def fit(self, X, y):
-        self.X_train_ = X
-        le = LabelEncoder()
-        y = le.fit_transform(y)
-        model, config = load_model(self.path, device=self.device)
+        # 'int8' or 'bf16' to run the transformer and decoder of the model with low precision weights for extraction
+        self.low_precision = low_precision
+        # number of training points attending at once during extraction, which bounds the memory of the attention to
+        # attention_block_size x n_samples; None attends with all points at once
+        self.attention_block_size = attention_block_size
+
+    def _load_model(self):
+        model, config = load_model(self.path, device=self.device, low_precision=self.low_precision)
         if "model_type" not in config:
             config['model_type'] = config.get("model_maker", 'tabpfn')
-        if config['model_type'] not in ["mlp", "mothernet"]:
+        if config['model_type'] not in ["mlp", "mothernet", "perceiver"]:
             raise ValueError(f"Incompatible model_type: {config['model_type']}")
-        model.to(self.device)
-        n_classes = len(le.classes_)
-        indices = np.mod(np.arange(n_classes) + self.label_offset, n_classes)
-        layers = extract_mlp_model(model, X, np.mod(y + self.label_offset, n_classes), device=self.device,
-                                   inference_device=self.inference_device, scale=self.scale)
+        return model.to(self.device)
+
+    def _set_parameters(self, layers, n_classes):
+        # the model was applied to labels shifted by label_offset, undo the shift on the output layer
         if self.label_offset == 0:
             self.parameters_ = layers
         else:
-            *lower_layers, b_last, w_last = layers
+            indices = np.mod(np.arange(n_classes) + self.label_offset, n_classes)
+            *lower_layers, (b_last, w_last) = layers
             self.parameters_ = (*lower_layers, (b_last[indices], w_last[:, indices]))
+
+    def fit(self, X, y):
+        self.X_train_ = X
+        le = LabelEncoder()
+        y = le.fit_transform(y)
+        model = self._load_model()
+        n_classes = len(le.classes_)
+        layers = extract_mlp_model(model, X, np.mod(y + self.label_offset, n_classes), device=self.device,
+                                   inference_device=self.inference_device, scale=self.scale,
+                                   attention_block_size=self.attention_block_size)
+        self._set_parameters(layers, n_classes)
+        self.predictor_ = MLPPredictor.from_training_data(X, self.parameters_, scale=self.scale) if self.inference_device == "cpu" else None
         self.classes_ = le.classes_
         return self
 
+    def fit_streaming(self, X, y=None, chunk_size=8192):
+        """
+        Fits a perceiver checkpoint without holding the training data in memory.
+
+        X and y can be arrays or np.memmap, which are read chunk_size rows at a time. Alternatively, X can be a
+        function without arguments returning an iterable of (X_chunk, y_chunk) pairs, such as a generator function,
+        with y=None. The data is read once for the feature statistics and the classes and once for each layer of the
+        model. The result is the same as fit(X, y) up to floating point rounding. Only inference_device="cpu" is
+        supported.
+        """
+        if callable(X):
+            if y is not None:
+                raise ValueError("y must be None if X is a function returning chunks")
+            make_chunks = X
+        else:
+            def make_chunks():
+                for start in range(0, X.shape[0], chunk_size):
+                    yield X[start:start + chunk_size], y[start:start + chunk_size]
+        if self.inference_device != "cpu":
+            raise ValueError("fit_streaming only supports inference_device='cpu'")
+        model = self._load_model()
+        if not isinstance(model, TabPerceiver):
+            raise ValueError("fit_streaming requires a perceiver model, as self-attention needs all training points at once")
+        mean, std, classes = scan_training_chunks(make_chunks())
+        n_classes = len(classes)
+
+        def encoded_label_chunks():
+            for X_chunk, y_chunk in make_chunks():
+                yield X_chunk, np.mod(np.searchsorted(classes, y_chunk) + self.label_offset, n_classes)
+
+        layers = extract_mlp_model_streaming(model, encoded_label_chunks, n_features=len(mean), n_classes=n_classes,
+                                             mean=mean if self.scale else None, std=std if self.scale else None,
+                                             device=self.device, inference_device=self.inference_device)
+        self._set_parameters(layers, n_classes)
+        if self.scale:
+            # the same statistics as MLPPredictor.from_training_data
+            self.predictor_ = MLPPredictor(self.parameters_, mean=np.nan_to_num(mean, nan=0),
+                                           std=np.nan_to_num(std + .000001, nan=1))
+        else:
+            self.predictor_ = MLPPredictor(self.parameters_)
+        self.X_train_ = None
+        self.classes_ = classes
+        return self
+
     def predict_proba(self, X):
+        if self.predictor_ is not None:
+            return self.predictor_.predict_proba(X)
         return predict_with_mlp_model(self.X_train_, X, self.parameters_, scale=self.scale, inference_device=self.inference_device)
 
     def predict(self, X):
         return self.classes_[self.predict_proba(X).argmax(axis=1)]
 
+    def save_artifact(self, path):
+        """
+        Writes the extracted MLP and the classes to an .npz file at path, which mothernet.artifact.load_artifact loads
+        into a classifier that only needs numpy.
+        """
+        predictor = self.predictor_
+        if predictor is None:
+            layers = [(torch.as_tensor(b).cpu().numpy(), torch.as_tensor(w).cpu().numpy()) for b, w in self.parameters_]
+            predictor = MLPPredictor.from_training_data(self.X_train_, layers, scale=self.scale)
+        save_artifact(path, predictor, self.classes_)
+
 
 class PermutationsMeta(ClassifierMixin, BaseEstimator):
     def __init__(self, base_estimator):
@@ -253,6 +385,12 @@ class PermutationsMeta(ClassifierMixin, BaseEstimator):
         return self.vc_.classes_
 
 
+def shift_features(X, feature_shift):
+    # moves the first feature_shift features to the end, or does nothing if feature_shift is not smaller than the
+    # number of features
+    return np.concatenate([X[:, feature_shift:], X[:, :feature_shift]], axis=1)
+
+
 class ShiftClassifier(ClassifierMixin, BaseEstimator):
     def __init__(self, base_estimator, feature_shift=0, label_shift=0, transformer=None):
         self.base_estimator = base_estimator
@@ -261,7 +399,7 @@ class ShiftClassifier(ClassifierMixin, BaseEstimator):
         self.transformer = transformer
 
     def _feature_shift(self, X):
-        return np.concatenate([X[:, self.feature_shift:], X[:, :self.feature_shift]], axis=1)
+        return shift_features(X, self.feature_shift)
 
     def fit(self, X, y):
         if self.transformer is not None:
@@ -287,8 +425,110 @@ class ShiftClassifier(ClassifierMixin, BaseEstimator):
         return self.predict_proba(X).argmax(axis=1)
 
 
+def _make_power_transformer():
+    # remove zero-variance features to avoid division by zero
+    return Pipeline([('variance_threshold', VarianceThreshold()), ('scale', StandardScaler()), ('power_transformer', PowerTransformer())])
+
+
+class FusedMLPEnsemble:
+    """
+    Soft voting over MLPs extracted for the members of an EnsembleMeta in one batched forward pass.
+
+    Feature and label shifts are folded into the weights of the first and last layer of each MLP, so all members
+    that use the power transform, and all members that don't, see the same input.
+    """
+
+    def __init__(self, members, transformer, classes):
+        # members is a list of (use_power_transformer, MLPPredictor) pairs
+        self.members = members
+        self.transformer = transformer
+        self.classes_ = classes
+
+    def predict_proba(self, X):
+        inputs = {False: X}
+        if self.transformer is not None:
+            inputs[True] = self.transformer.transform(X)
+        return np.mean([predictor.predict_proba(inputs[use_power_transformer]) for use_power_transformer, predictor in self.members], axis=0)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+def _unshift_predictor(predictor, feature_shift, class_indices):
+    # folds the feature shift and label shift of a ShiftClassifier into the first and last layer of its predictor
+    n_features = predictor.weights_[0].shape[0]
+    shift = feature_shift if feature_shift < n_features else 0
+    weights = [np.roll(predictor.weights_[0], shift, axis=0), *predictor.weights_[1:-1], predictor.weights_[-1][:, class_indices]]
+    biases = [*predictor.biases_[:-1], predictor.biases_[-1][class_indices]]
+    return MLPPredictor.from_arrays(weights, biases, np.roll(predictor.mean_, shift), np.roll(predictor.std_, shift),
+                                    block_size=predictor.block_size)
+
+
+class MergedMLPEnsemble:
+    """
+    The MLPs of the members of an ensemble merged into one wide network that averages their logits.
+
+    The first layers of all members that see the same input (raw or power transformed features) are concatenated into
+    one matrix, the hidden layers are applied as one batched matrix product, which is the block-diagonal matrix of the
+    member layers without its zero blocks, and the output layers are stacked and averaged. This is exactly the softmax
+    of the average logits of the members; EnsembleMeta instead averages their probabilities, so predictions can differ
+    slightly.
+    """
+
+    def __init__(self, members, transformer, classes, block_size=4096):
+        # members is a list of (use_power_transformer, MLPPredictor) pairs with shifts folded in
+        self.transformer = transformer
+        self.classes_ = classes
+        self.block_size = block_size
+        predictors = {use_power: [predictor for use, predictor in members if use == use_power] for use_power in [False, True]}
+        # members are ordered by input, which the concatenated first layer has to match
+        ordered = predictors[False] + predictors[True]
+        self.first_layers_ = {}
+        for use_power, group in predictors.items():
+            if not group:
+                continue
+            mean, std = group[0].mean_, group[0].std_
+            if not all(np.array_equal(p.mean_, mean) and np.array_equal(p.std_, std) for p in group):
+                raise ValueError("Members with the same input need to be fitted on the same training data")
+            self.first_layers_[use_power] = (mean, std, np.concatenate([p.weights_[0] for p in group], axis=1),
+                                             np.concatenate([p.biases_[0] for p in group]))
+        self.n_members_ = len(ordered)
+        n_layers = len(ordered[0].weights_)
+        self.hidden_weights_ = [np.stack([p.weights_[i] for p in ordered]) for i in range(1, n_layers - 1)]
+        self.hidden_biases_ = [np.stack([p.biases_[i] for p in ordered])[:, np.newaxis, :] for i in range(1, n_layers - 1)]
+        self.output_weight_ = np.concatenate([p.weights_[-1] for p in ordered], axis=0) / self.n_members_
+        self.output_bias_ = np.mean([p.biases_[-1] for p in ordered], axis=0)
+
+    def decision_function(self, X):
+        X = np.asarray(X)
+        inputs = {False: X}
+        if True in self.first_layers_:
+            inputs[True] = self.transformer.transform(X)
+        result = np.empty((X.shape[0], self.output_bias_.shape[0]), dtype=np.float32)
+        for start in range(0, X.shape[0], self.block_size):
+            stop = min(start + self.block_size, X.shape[0])
+            hidden = []
+            for use_power, (mean, std, weight, bias) in self.first_layers_.items():
+                x = standardize(inputs[use_power][start:stop], mean, std).astype(np.float32)
+                hidden.append(x @ weight + bias)
+            h = np.maximum(np.concatenate(hidden, axis=1), 0)
+            # members x rows x hidden units
+            h = h.reshape(stop - start, self.n_members_, -1).transpose(1, 0, 2)
+            for weight, bias in zip(self.hidden_weights_, self.hidden_biases_):
+                h = np.maximum(np.matmul(h, weight) + bias, 0)
+            result[start:stop] = h.transpose(1, 0, 2).reshape(stop - start, -1) @ self.output_weight_ + self.output_bias_
+        return result
+
+    def predict_proba(self, X):
+        return softmax(self.decision_function(X).astype(np.float64) / .8, axis=1)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
 class EnsembleMeta(ClassifierMixin, BaseEstimator):
-    def __init__(self, base_estimator, n_estimators=32, random_state=None, power=True, label_shift=True, feature_shift=True, n_jobs=-1):
+    def __init__(self, base_estimator, n_estimators=32, random_state=None, power=True, label_shift=True, feature_shift=True, n_jobs=-1,
+                 fused=False):
         self.base_estimator = base_estimator
         self.n_estimators = n_estimators
         self.random_state = random_state
@@ -296,6 +536,9 @@ class EnsembleMeta(ClassifierMixin, BaseEstimator):
         self.label_shift = label_shift
         self.feature_shift = feature_shift
         self.n_jobs = n_jobs
+        # extract all members at once with a single MotherNetClassifier model, instead of fitting clones in a
+        # VotingClassifier
+        self.fused = fused
 
     def fit(self, X, y):
         X = np.array(X)
@@ -307,20 +550,76 @@ class EnsembleMeta(ClassifierMixin, BaseEstimator):
         shifts = list(itertools.product(label_shifts, feature_shifts, use_power_transformer))
         rng = random.Random(self.random_state)
         shifts = rng.sample(shifts, min(len(shifts), self.n_estimators))
+        if self.fused:
+            self.vc_ = self._fit_fused(X, y, shifts)
+            return self
         estimators = []
         n_jobs = self.n_jobs if X.shape[0] > 1000 else 1
 
         for label_shift, feature_shift, use_power_transformer in shifts:
             estimator = ShiftClassifier(self.base_estimator, feature_shift=feature_shift, label_shift=label_shift)
             if use_power_transformer:
-                # remove zero-variance features to avoid division by zero
-                estimator = Pipeline([('variance_threshold', VarianceThreshold()), ('scale', StandardScaler()),
-                                     ('power_transformer', PowerTransformer()), ('shift_classifier', estimator)])
+                estimator = Pipeline(_make_power_transformer().steps + [('shift_classifier', estimator)])
             estimators.append((str((label_shift, feature_shift, use_power_transformer)), estimator))
         self.vc_ = VotingClassifier(estimators, voting='soft', n_jobs=n_jobs)
         self.vc_.fit(X, y)
         return self
 
+    def _fit_fused(self, X, y, shifts):
+        base = self.base_estimator
+        if not isinstance(base, MotherNetClassifier):
+            raise ValueError("fused=True requires a MotherNetClassifier as base_estimator")
+        if base.inference_device != "cpu":
+            raise ValueError("fused=True only supports inference_device='cpu'")
+        le = LabelEncoder()
+        y = le.fit_transform(y)
+        # the power transform is deterministic, so all members that use it can share one
+        transformer = _make_power_transformer().fit(X) if any(use_power for _, _, use_power in shifts) else None
+        inputs = {False: X, True: transformer.transform(X) if transformer is not None else None}
+        X_trains = [shift_features(inputs[use_power], feature_shift) for _, feature_shift, use_power in shifts]
+        y_trains = [np.mod(y + label_shift + base.label_offset, self.n_classes_) for label_shift, _, _ in shifts]
+        model = base._load_model()
+        all_layers = extract_mlp_models(model, X_trains, y_trains, device=base.device, inference_device=base.inference_device,
+                                        scale=base.scale, attention_block_size=base.attention_block_size)
+        members = []
+        for (label_shift, feature_shift, use_power), layers in zip(shifts, all_layers):
+            (b_first, w_first), *hidden_layers, (b_last, w_last) = layers
+            # rows of the first layer in the order of the unshifted features
+            n_features = inputs[use_power].shape[1]
+            w_first = np.roll(w_first, feature_shift if feature_shift < n_features else 0, axis=0)
+            class_indices = np.mod(np.arange(self.n_classes_) + label_shift + base.label_offset, self.n_classes_)
+            layers = [(b_first, w_first), *hidden_layers, (b_last[class_indices], w_last[:, class_indices])]
+            members.append((use_power, MLPPredictor.from_training_data(inputs[use_power], layers, scale=base.scale)))
+        return FusedMLPEnsemble(members, transformer, le.classes_)
+
+    def _mlp_members(self):
+        # the fitted members as (use_power_transformer, MLPPredictor) pairs with their shifts folded in, and the power
+        # transform
+        if isinstance(self.vc_, FusedMLPEnsemble):
+            return self.vc_.members, self.vc_.transformer
+        members, transformer = [], None
+        for estimator in self.vc_.estimators_:
+            use_power = isinstance(estimator, Pipeline)
+            if use_power:
+                if transformer is None:
+                    # all power transforms are fitted on the same data, so they are the same
+                    transformer = estimator[:-1]
+                estimator = estimator[-1]
+            predictor = getattr(estimator.base_estimator_, "predictor_", None)
+            if predictor is None:
+                raise ValueError("Only ensembles of MotherNetClassifier with inference_device='cpu' can be merged")
+            members.append((use_power, _unshift_predictor(predictor, estimator.feature_shift, estimator.class_indices_)))
+        return members, transformer
+
+    def merge_members(self):
+        """
+        Returns a MergedMLPEnsemble with the MLPs of all members of the fitted ensemble merged into one network, which
+        computes the power transform once and predicts with a few large matrix products. It averages logits instead of
+        probabilities.
+        """
+        members, transformer = self._mlp_members()
+        return MergedMLPEnsemble(members, transformer, self.classes_)
+
     @property
     def device(self):
         return self.base_estimator.device
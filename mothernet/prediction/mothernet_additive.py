@@ -3,105 +3,167 @@ import torch
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.preprocessing import LabelEncoder
 
+from mothernet.artifact import AdditivePredictor, LowRankAdditivePredictor, pad_bin_edges, save_artifact
 from mothernet.model_builder import load_model
-from mothernet.models.mothernet_additive import bin_data
+from mothernet.models.decoders import FactorizedAdditiveModelDecoder
+from mothernet.models.layer import chunked_attention
+from mothernet.models.mothernet_additive import bin_data, bin_data_indices
 
 
-def extract_additive_model(model, X_train, y_train, device="cpu", inference_device="cpu"):
-    if "cuda" in inference_device and device == "cpu":
-        raise ValueError("Cannot run inference on cuda when model is on cpu")
-    n_classes = len(np.unique(y_train))
-    n_features = X_train.shape[1]
-
+def _encode_training_data(model, X_train, y_train, device, attention_block_size):
+    # runs the transformer on the training data, returning its output, the labels and the bin edges
     ys = torch.Tensor(y_train).to(device)
     xs = torch.Tensor(X_train).to(device)
 
     if X_train.shape[1] > 100:
         raise ValueError("Cannot run inference on data with more than 100 features")
     x_all_torch = torch.concat([xs, torch.zeros((X_train.shape[0], 100 - X_train.shape[1]), device=device)], axis=1)
-    X_onehot, bin_edges = bin_data(x_all_torch, n_bins=model.n_bins)
-    # why need :len?
-    x_src = model.encoder(X_onehot.unsqueeze(1)[:len(X_train)].float())
+    if model.input_layer_norm:
+        X_onehot, bin_edges = bin_data(x_all_torch, n_bins=model.n_bins)
+        # why need :len?
+        x_src = model.encoder(X_onehot.unsqueeze(1)[:len(X_train)].float())
+    else:
+        X_binned, zero_padding, bin_edges = bin_data_indices(x_all_torch.unsqueeze(1), n_bins=model.n_bins)
+        x_src = model.encode_bins(X_binned, zero_padding)
+        bin_edges = bin_edges.squeeze(1)
     y_src = model.y_encoder(ys.unsqueeze(1).unsqueeze(-1))
     train_x = x_src + y_src
-    output = model.transformer_encoder(train_x)
+    with chunked_attention(model, attention_block_size):
+        output = model.transformer_encoder(train_x)
+    return output, ys, bin_edges
+
+
+def _detach(x, inference_device):
+    if inference_device == "cpu":
+        return x.detach().cpu().numpy()
+    return x.detach()
+
+
+@torch.inference_mode()
+def extract_additive_model(model, X_train, y_train, device="cpu", inference_device="cpu", attention_block_size=None):
+    if "cuda" in inference_device and device == "cpu":
+        raise ValueError("Cannot run inference on cuda when model is on cpu")
+    n_classes = len(np.unique(y_train))
+    n_features = X_train.shape[1]
+
+    output, ys, bin_edges = _encode_training_data(model, X_train, y_train, device, attention_block_size)
     weights, biases = model.decoder(output, ys)
     w = weights.squeeze()[:n_features, :, :n_classes]
     b = biases.squeeze()[:n_classes]
     bins_data_space = bin_edges[:n_features]
     # remove extra classes on output layer
-    if inference_device == "cpu":
-        def detach(x):
-            return x.detach().cpu().numpy()
+    return _detach(w, inference_device), _detach(b, inference_device), _detach(bins_data_space, inference_device)
+
+
+@torch.inference_mode()
+def extract_low_rank_additive_model(model, X_train, y_train, device="cpu", attention_block_size=None):
+    """
+    Extracts the additive model of a checkpoint with factorized output in the low-rank form of the decoder, see
+    FactorizedAdditiveModelDecoder.low_rank_forward.
+
+    Returns numpy arrays of coefficients, basis, biases and bin edges for LowRankAdditivePredictor, restricted to the
+    features and classes of the training data.
+    """
+    if not isinstance(model.decoder, FactorizedAdditiveModelDecoder):
+        raise ValueError("Low-rank extraction needs a model with factorized output")
+    n_classes = len(np.unique(y_train))
+    n_features = X_train.shape[1]
+
+    output, ys, bin_edges = _encode_training_data(model, X_train, y_train, device, attention_block_size)
+    coefficients, basis, biases = model.decoder.low_rank_forward(output, ys)
+    coefficients = coefficients[0, :n_features]
+    # classes are the last dimension of either the coefficients or the basis
+    if coefficients.dim() == 3:
+        coefficients = coefficients[..., :n_classes]
     else:
-        def detach(x):
-            return x.detach()
+        basis = basis[..., :n_classes]
+    return tuple(_detach(x, "cpu") for x in (coefficients, basis, biases[:n_classes], bin_edges[:n_features]))
+
+
+def torch_additive_decision_function(X, weights, biases, bin_edges, device="cpu", block_size=4096):
+    """
+    Torch version of AdditivePredictor.decision_function, with the same results, for prediction on gpu.
 
-    return detach(w), detach(b), detach(bins_data_space)
+    All features are binned at once with a batched torch.searchsorted, and the bins are turned into offsets into one
+    (n_features * n_bins, n_classes) lookup table, which is gathered and summed over features.
+    """
+    weights = torch.as_tensor(weights, device=device)
+    n_features, n_bins, n_classes = weights.shape
+    # comparisons and sums in float64 as in the numpy version
+    table = weights.reshape(n_features * n_bins, n_classes).double()
+    edges = torch.as_tensor(pad_bin_edges(bin_edges) if isinstance(bin_edges, list) else bin_edges, device=device).double().contiguous()
+    offsets = torch.arange(n_features, device=device) * n_bins
+    # missing values are binned as zero, as in AdditivePredictor
+    X = torch.nan_to_num(torch.as_tensor(X, device=device).double(), nan=0)
+    out = torch.empty((X.shape[0], n_classes), dtype=torch.float64, device=device)
+    for start in range(0, X.shape[0], block_size):
+        binned = torch.searchsorted(edges, X[start:start + block_size].T.contiguous()).T
+        out[start:start + block_size] = table[binned + offsets].sum(dim=1)
+    return out + torch.as_tensor(biases, device=device).double()
 
 
-def predict_with_additive_model(X_train, X_test, weights, biases, bin_edges, inference_device="cpu", n_bins=64):
+def predict_with_additive_model(X_train, X_test, weights, biases, bin_edges, inference_device="cpu", n_bins=64, block_size=4096):
     if inference_device == "cpu":
-        # FIXME replacing nan with 0 as in TabPFN
-        X_test = np.nan_to_num(X_test, 0)
-        out = np.zeros((X_test.shape[0], weights.shape[-1]))
-        for col, bins, w in zip(X_test.T, bin_edges, weights):
-            binned = np.searchsorted(bins, col)
-            out += w[binned]
-        out += biases
-        if np.isnan(out).any():
-            print("NAN")
-            import pdb
-            pdb.set_trace()
-        from scipy.special import softmax
-        return softmax(out / .8, axis=1)
+        return AdditivePredictor(weights, biases, bin_edges, block_size=block_size).predict_proba(X_test)
     elif "cuda" in inference_device:
-        mean = torch.Tensor(np.nanmean(X_train, axis=0)).to(inference_device)
-        std = torch.Tensor(np.nanstd(X_train, axis=0, ddof=1) + .000001).to(inference_device)
-        # FIXME replacing nan with 0 as in TabPFN
-        X_train = np.nan_to_num(X_train, 0)
-        X_test = np.nan_to_num(X_test, 0)
-        std[torch.isnan(std)] = 1
-        X_test_scaled = (torch.Tensor(X_test).to(inference_device) - mean) / std
-        out = torch.clamp(X_test_scaled, min=-100, max=100)
-        import pdb
-        pdb.set_trace()
-        raise NotImplementedError
-        layers = None
-        for i, (b, w) in enumerate(layers):
-            out = torch.matmul(out, w) + b
-            if i != len(layers) - 1:
-                out = torch.relu(out)
+        out = torch_additive_decision_function(X_test, weights, biases, bin_edges, device=inference_device, block_size=block_size)
         return torch.nn.functional.softmax(out / .8, dim=1).cpu().numpy()
     else:
         raise ValueError(f"Unknown inference_device: {inference_device}")
 
 
 class MotherNetAdditiveClassifier(ClassifierMixin, BaseEstimator):
-    def __init__(self, path=None, device="cpu", inference_device="cpu"):
+    def __init__(self, path=None, device="cpu", inference_device="cpu", attention_block_size=1024, low_rank=False,
+                 low_precision=None):
         self.path = path
         self.device = device
         self.inference_device = inference_device
+        # 'int8' or 'bf16' to extract with low-precision linear layers in the transformer and decoder, see load_model
+        self.low_precision = low_precision
+        # number of training points attending at once during extraction, see MotherNetClassifier
+        self.attention_block_size = attention_block_size
+        # keep the factors of models with factorized output instead of the dense lookup tables; the artifact is
+        # smaller by about a factor of n_bins / rank, prediction is done on cpu in rank space.
+        self.low_rank = low_rank
 
     def fit(self, X, y):
         self.X_train_ = X
         le = LabelEncoder()
         y = le.fit_transform(y)
-        model, config = load_model(self.path, device=self.device)
+        model, config = load_model(self.path, device=self.device, low_precision=self.low_precision)
         if "model_type" not in config:
             config['model_type'] = config.get("model_maker", 'tabpfn')
         if config['model_type'] != "additive":
             raise ValueError(f"Incompatible model_type: {config['model_type']}")
         model.to(self.device)
-        w, b, bin_edges = extract_additive_model(model, X, y, device=self.device, inference_device=self.inference_device)
+        self.classes_ = le.classes_
+        if self.low_rank:
+            if self.inference_device != "cpu":
+                raise ValueError("Low-rank prediction is only supported with inference_device='cpu'")
+            coefficients, basis, b, bin_edges = extract_low_rank_additive_model(
+                model, X, y, device=self.device, attention_block_size=self.attention_block_size)
+            self.predictor_ = LowRankAdditivePredictor(coefficients, basis, b, bin_edges)
+            return self
+        w, b, bin_edges = extract_additive_model(model, X, y, device=self.device, inference_device=self.inference_device,
+                                                 attention_block_size=self.attention_block_size)
         self.w_ = w
         self.b_ = b
         self.bin_edges_ = bin_edges
-        self.classes_ = le.classes_
+        # the lookup table is built once, for prediction on cpu and for save_artifact
+        self.predictor_ = AdditivePredictor(*(torch.as_tensor(x).cpu().numpy() for x in (w, b, bin_edges)))
         return self
 
     def predict_proba(self, X):
+        if self.low_rank or self.inference_device == "cpu":
+            return self.predictor_.predict_proba(X)
         return predict_with_additive_model(self.X_train_, X, self.w_, self.b_, self.bin_edges_, inference_device=self.inference_device)
 
     def predict(self, X):
         return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+    def save_artifact(self, path):
+        """
+        Writes the bin edges, lookup tables and classes of the extracted additive model to an .npz file at path, which
+        mothernet.artifact.load_artifact loads into a classifier that only needs numpy.
+        """
+        save_artifact(path, self.predictor_, self.classes_)
@@ -3,18 +3,25 @@ import pathlib
 import random
 from pathlib import Path
 import itertools
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
 from sklearn.base import BaseEstimator, ClassifierMixin
-from sklearn.preprocessing import LabelEncoder, PowerTransformer, QuantileTransformer, RobustScaler
+from sklearn.cluster import KMeans
+from sklearn.neighbors import NearestNeighbors
+from sklearn.preprocessing import LabelEncoder
 from sklearn.utils import column_or_1d
 from sklearn.utils.multiclass import check_classification_targets
 from sklearn.utils.validation import check_array, check_is_fitted, check_X_y
 from torch.utils.checkpoint import checkpoint
 
 from mothernet.model_builder import load_model
-from mothernet.utils import NOP, normalize_by_used_features_f, normalize_data, remove_outliers
+from mothernet.model_registry import model_registry
+from mothernet.nan_statistics import constant_columns, nan_mean_std
+from mothernet.preprocessing import TorchPowerTransformer, TorchQuantileTransformer, TorchRobustScaler, fit_power_transformers
+from mothernet.utils import NOP, clip_outliers, get_outlier_bounds, normalize_by_used_features_f
 
 
 def _get_file(e, base_path, add_name, eval_addition):
@@ -48,7 +55,7 @@ def _check_file(e, base_path, add_name, eval_addition, verbose):
     return model_path, results_file
 
 
-def load_model_workflow(e, add_name, base_path, device='cpu', eval_addition='', verbose=0):
+def load_model_workflow(e, add_name, base_path, device='cpu', eval_addition='', verbose=0, low_precision=None):
     """
     Workflow for loading a model and setting appropriate parameters for diffable hparam tuning.
     """
@@ -66,19 +73,19 @@ def load_model_workflow(e, add_name, base_path, device='cpu', eval_addition='',
     if model_path is None:
         model_path, results_file = _get_file(e, base_path, add_name, eval_addition)
         raise Exception('No checkpoint found at '+str(model_path))
-    model, c = load_model(model_path, device, verbose=False)
+    model, c = load_model(model_path, device, verbose=False, low_precision=low_precision)
 
     return model, c, results_file
 
 
 class TabPFNClassifier(BaseEstimator, ClassifierMixin):
 
-    models_in_memory = {}
-
     def __init__(self, device='cpu', base_path=pathlib.Path(__file__).parent.parent.resolve(), model_string='download',
                  N_ensemble_configurations=3, no_preprocess_mode=False, multiclass_decoder='permutation',
                  feature_shift_decoder=True, seed=0, no_grad=True, batch_size_inference=32,
-                 subsample_features=False, verbose=False, scale=True, epoch=-1):
+                 subsample_features=False, verbose=False, scale=True, epoch=-1, cache_context=False, test_chunk_size=None,
+                 memory_budget=None, low_precision=None, subsample_size=None, n_subsamples=None, retrieval_neighbors=None,
+                 n_prototypes=None):
         """
         Initializes the classifier and loads the model.
         Depending on the arguments, the model is either loaded from memory, from a file, or downloaded from the
@@ -109,6 +116,40 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
                For this to correctly function no_preprocessing_mode must be set to true.
         :param subsample_features: If set to true and the number of features in the dataset exceeds self.max_features (100),
                 the features are subsampled to self.max_features.
+        :param cache_context: If set to true, the attention keys and values of the training set are computed once in fit,
+               and predict_proba only runs the test points through the transformer. This makes repeated predictions
+               on the same training set much cheaper, at the cost of storing the keys and values of every layer.
+               Requires no_grad to be true.
+        :param test_chunk_size: If set, predict_proba passes at most this many test points through the model at a time,
+               so that peak memory depends on the chunk size and not on the number of test points.
+        :param memory_budget: Approximate number of bytes the activations of one inference batch may use. Used to derive
+               the test chunk size if test_chunk_size is not given.
+        :param low_precision: If set to 'int8' or 'bf16', the linear layers of the transformer are run with dynamically
+               quantized int8 or bfloat16 weights, which reduces the memory traffic of inference on cpu at a small
+               cost in accuracy. See mothernet.evaluation.low_precision for measuring the difference.
+        :param subsample_size: If set, training sets with more than this many points are split into stratified subsets
+               of at most subsample_size points. Each subset is used as the training set of its own ensemble, the
+               subsets are passed through the model together along the batch dimension (one subset per batch if
+               memory_budget is set), and their predicted probabilities are averaged. This makes memory use independent of the training set size and the
+               prediction time linear in it. Can be 'auto' to use the largest size that fits memory_budget, which
+               is at most 1024; larger explicit sizes need overwrite_warning=True in fit. Requires no_grad to be
+               true and can not be combined with cache_context.
+        :param n_subsamples: The number of subsets for subsample_size. By default, the training set is split into as
+               many disjoint subsets as needed to use every training point once.
+        :param retrieval_neighbors: If set, fit builds a nearest neighbor index over the standardized training points,
+               and each chunk of test points is predicted using only the union of the retrieval_neighbors nearest
+               training points of the test points in the chunk as training set. This bounds the training set size
+               for arbitrarily large training sets while keeping the local structure. The chunk size is given by
+               test_chunk_size, or derived from memory_budget, and defaults to 1024 // retrieval_neighbors; neighbors
+               of the next chunk are retrieved while the current chunk is passed through the model. Classes that don't occur among the neighbors get
+               probability zero. Requires no_grad to be true and can not be combined with cache_context or
+               subsample_size.
+        :param n_prototypes: If set, the training points of each class are clustered into at most n_prototypes
+               clusters with k-means, and the cluster means are used as training set instead. The log of the cluster
+               size is added to the attention logits of each prototype, so that it receives the attention of all
+               points in its cluster. The cost of attention then depends on the number of prototypes instead of the
+               number of training points. Requires no_grad to be true and can not be combined with cache_context,
+               subsample_size or retrieval_neighbors.
         """
 
         self.verbose = verbose
@@ -126,6 +167,14 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
         self.epoch = epoch
         self.temperature = None
         self.scale = scale
+        self.cache_context = cache_context
+        self.test_chunk_size = test_chunk_size
+        self.memory_budget = memory_budget
+        self.low_precision = low_precision
+        self.subsample_size = subsample_size
+        self.n_subsamples = n_subsamples
+        self.retrieval_neighbors = retrieval_neighbors
+        self.n_prototypes = n_prototypes
 
         assert self.no_preprocess_mode if not self.no_grad else True, \
             "If no_grad is false, no_preprocess_mode must be true, because otherwise no gradient can be computed."
@@ -133,7 +182,9 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
         self.batch_size_inference = batch_size_inference
 
     def remove_models_from_memory(self):
-        self.models_in_memory = {}
+        # only the model of this estimator is evicted, other estimators might share the rest of the registry
+        if getattr(self, "model", None) is not None:
+            model_registry.evict_model(self.model)
 
     def _validate_targets(self, y):
         y_ = column_or_1d(y, warn=True)
@@ -148,19 +199,10 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
         self.classes_ = cls
         return np.asarray(y, dtype=np.float64, order="C")
 
-    def fit(self, X, y, overwrite_warning=False):
-
-        model_key = self.model_string+'|'+str(self.device) + '|' + str(self.epoch)
-        if model_key in self.models_in_memory:
-            if self.verbose:
-                print(f"using model {model_key}")
-            model, c, results_file = self.models_in_memory[model_key]
-        else:
-            model, c, results_file = load_model_workflow(self.epoch, add_name=self.model_string, base_path=self.base_path, device=self.device,
-                                                         eval_addition='')
-            self.models_in_memory[model_key] = (model, c, results_file)
-            # if len(self.models_in_memory) == 2:
-            #    print('Multiple models in memory. This might lead to memory issues. Consider calling remove_models_from_memory()')
+    def _load_model(self):
+        # loaded models are shared through the model registry
+        model, c, results_file = load_model_workflow(self.epoch, add_name=self.model_string, base_path=self.base_path, device=self.device,
+                                                     eval_addition='', low_precision=self.low_precision)
         if c.get("model_type", "tabpfn") != "tabpfn":
             raise ValueError(f"Cannot load {c['model_type']} weights into TabPFNClassifier.")
         self.c = c
@@ -172,6 +214,9 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
             self.max_num_classes = c['max_num_classes']
 
         self.model = model
+
+    def fit(self, X, y, overwrite_warning=False):
+        self._load_model()
         if self.no_grad:
             # Check that X and y have correct shape
             X, y = check_X_y(X, y, force_all_finite=False)
@@ -180,6 +225,14 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
         self.label_encoder = LabelEncoder()
         y = self.label_encoder.fit_transform(y)
 
+        self.train_log_weights_ = None
+        if self.n_prototypes is not None:
+            if not self.no_grad or self.cache_context or self.subsample_size is not None or self.retrieval_neighbors is not None:
+                raise ValueError("n_prototypes requires no_grad=True and can not be combined with cache_context, subsample_size "
+                                 "or retrieval_neighbors.")
+            X, y, counts = get_class_prototypes(X, y, self.n_prototypes, random_state=self.seed)
+            self.train_log_weights_ = np.log(counts)
+
         self.X_ = X
         self.y_ = y
 
@@ -190,15 +243,73 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
                 raise ValueError("The number of features for this classifier is restricted to ", self.max_num_features)
         if len(np.unique(y)) > self.max_num_classes:
             raise ValueError("The number of classes for this classifier is restricted to ", self.max_num_classes)
-        if X.shape[0] > 1024 and not overwrite_warning:
+
+        self.subsets_ = None
+        if self.subsample_size is not None:
+            if not self.no_grad or self.cache_context:
+                raise ValueError("subsample_size requires no_grad=True and cache_context=False.")
+            if self.subsample_size == 'auto':
+                if self.memory_budget is None:
+                    raise ValueError("subsample_size='auto' requires memory_budget to be set.")
+                subsample_size = get_subsample_size(self.model, self.N_ensemble_configurations, self.memory_budget)
+            else:
+                subsample_size = self.subsample_size
+                if subsample_size > 1024 and not overwrite_warning:
+                    raise ValueError(f"subsample_size={subsample_size} is larger than the training size of 1024 that TabPFN "
+                                     "is made for. Please confirm you want to run by passing overwrite_warning=True to the fit "
+                                     "function.")
+            if X.shape[0] > subsample_size:
+                self.subsets_ = get_stratified_subsets(y, subsample_size, self.n_subsamples, random_state=self.seed)
+
+        self.retrieval_index_ = None
+        if self.retrieval_neighbors is not None:
+            if not self.no_grad or self.cache_context or self.subsample_size is not None:
+                raise ValueError("retrieval_neighbors requires no_grad=True, cache_context=False and subsample_size=None.")
+            mean, std = nan_mean_std(torch.tensor(X, dtype=torch.float64), dim=0)
+            self.retrieval_mean_, self.retrieval_std_ = mean.numpy(), std.numpy() + .000001
+            self.retrieval_index_ = NearestNeighbors(n_neighbors=min(self.retrieval_neighbors, X.shape[0]))
+            self.retrieval_index_.fit(self._retrieval_features(X))
+
+        if X.shape[0] > 1024 and not overwrite_warning and self.subsets_ is None and self.retrieval_index_ is None:
             raise ValueError("⚠️ WARNING: TabPFN is not made for datasets with a trainingsize > 1024. Prediction might take a while, be less reliable."
                              "We advise not to run datasets > 10k samples, which might lead to your machine crashing "
                              "(due to quadratic memory scaling of TabPFN)."
                              "Please confirm you want to run by passing overwrite_warning=True to the fit function.")
 
+        # prepares the model once, so predict_proba doesn't need to
+        self.session_ = InferenceSession(self.model, device=self.device) if self.no_grad else None
+
+        # subsampling features is random per call, so neither preprocessing nor the training context can be reused then
+        self.preprocessors_ = None
+        if self.no_grad and X.shape[1] <= self.max_num_features and self.retrieval_index_ is None:
+            X_train = torch.tensor(X, device=self.device).float().unsqueeze(1)
+            if self.subsets_ is not None:
+                self.preprocessors_ = fit_preprocessors_many([X_train[subset] for subset in self.subsets_], **self._get_ensemble_params())
+            else:
+                self.preprocessors_ = fit_preprocessors(X_train, **self._get_ensemble_params())
+
+        self.context_ = None
+        if self.cache_context:
+            if not self.no_grad:
+                raise ValueError("cache_context requires no_grad=True.")
+            if X.shape[1] <= self.max_num_features:
+                self.context_ = transformer_encode_context(self.model, torch.tensor(X, device=self.device).float().unsqueeze(1),
+                                                           torch.tensor(y, device=self.device).float().unsqueeze(1),
+                                                           preprocessors=self.preprocessors_, **self._get_ensemble_params())
+
         # Return the classifier
         return self
 
+    def _get_ensemble_params(self):
+        return dict(device=self.device,
+                    preprocess_transform='none' if self.no_preprocess_mode else 'mix',
+                    N_ensemble_configurations=self.N_ensemble_configurations,
+                    multiclass_decoder=self.multiclass_decoder,
+                    feature_shift_decoder=self.feature_shift_decoder,
+                    seed=self.seed,
+                    batch_size_inference=self.batch_size_inference, scale=self.scale,
+                    max_features=self.max_num_features)
+
     def predict_proba(self, X, normalize_with_test=False, return_logits=False):
         """
         Predict the probabilities for the input X depending on the training set previously passed in the method fit.
@@ -209,6 +320,88 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
         # Check is fit had been called
         check_is_fitted(self)
 
+        if self._get_test_chunk_size() is not None:
+            predictions = list(self.predict_proba_iter(X, normalize_with_test=normalize_with_test, return_logits=return_logits))
+            return np.concatenate(predictions, axis=0) if self.no_grad else torch.cat(predictions, dim=0)
+        return self._predict_proba(X, normalize_with_test=normalize_with_test, return_logits=return_logits)
+
+    def predict_proba_iter(self, X, normalize_with_test=False, return_logits=False):
+        """
+        Yields the predicted probabilities for consecutive chunks of the rows of X.
+
+        The chunk size is given by test_chunk_size, or derived from memory_budget. If neither is set, a single chunk
+        containing all of X is produced. Test points do not attend to each other, so the result does not depend on
+        the chunking, unless normalize_with_test is true, in which case each chunk is normalized separately.
+        Only the current chunk of X is converted and passed through the model, so X can be a memory-mapped array.
+        """
+        check_is_fitted(self)
+        if self.no_grad and not hasattr(X, "shape"):
+            X = check_array(X, force_all_finite=False)
+        n_samples = X.shape[0]
+        chunk_size = self._get_test_chunk_size() or max(n_samples, 1)
+        if self.retrieval_index_ is not None:
+            yield from self._predict_proba_retrieval_iter(X, chunk_size, normalize_with_test=normalize_with_test,
+                                                          return_logits=return_logits)
+            return
+        for start in range(0, n_samples, chunk_size):
+            yield self._predict_proba(X[start:start + chunk_size], normalize_with_test=normalize_with_test, return_logits=return_logits)
+
+    def _retrieval_features(self, X):
+        # missing values are placed at the mean of the feature
+        return np.nan_to_num((X - self.retrieval_mean_) / self.retrieval_std_, nan=0.)
+
+    def _predict_proba_retrieval_iter(self, X, chunk_size, normalize_with_test=False, return_logits=False):
+        def retrieve(start):
+            chunk = check_array(X[start:start + chunk_size], force_all_finite=False)
+            neighbors = self.retrieval_index_.kneighbors(self._retrieval_features(chunk), return_distance=False)
+            return chunk, np.unique(neighbors)
+
+        # the neighbors of the next chunk are retrieved in the background while the model runs on the current one
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            starts = range(0, X.shape[0], chunk_size)
+            future = executor.submit(retrieve, 0) if len(starts) else None
+            for start in starts:
+                chunk, context = future.result()
+                if start + chunk_size < X.shape[0]:
+                    future = executor.submit(retrieve, start + chunk_size)
+                yield self._predict_proba_with_training_subset(chunk, context, normalize_with_test=normalize_with_test,
+                                                               return_logits=return_logits)
+
+    def _predict_proba_with_training_subset(self, X, subset, normalize_with_test=False, return_logits=False):
+        # the labels of the subset are encoded again, so that the model only sees the classes that are present
+        subset_classes, y_subset = np.unique(self.y_[subset], return_inverse=True)
+        prediction = np.full((X.shape[0], len(self.classes_)), -np.inf if return_logits else 0.)
+        if len(subset_classes) == 1:
+            prediction[:, subset_classes[0]] = 0. if return_logits else 1.
+            return prediction
+        X_full = torch.tensor(np.concatenate([self.X_[subset], X], axis=0), device=self.device).float().unsqueeze(1)
+        y_full = torch.tensor(np.concatenate([y_subset, np.zeros(X.shape[0])]), device=self.device).float().unsqueeze(1)
+        subset_prediction = transformer_predict(self.model, X_full, y_full, len(subset), inference_mode=True,
+                                                normalize_with_test=normalize_with_test, softmax_temperature=self.temperature,
+                                                return_logits=return_logits, no_grad=True, session=self.session_,
+                                                **self._get_ensemble_params())
+        prediction[:, subset_classes] = subset_prediction.squeeze(0).cpu().numpy()
+        return prediction
+
+    def _get_test_chunk_size(self):
+        if self.test_chunk_size is not None:
+            return self.test_chunk_size
+        batch_size = min(self.N_ensemble_configurations, self.batch_size_inference)
+        if self.retrieval_index_ is not None:
+            if self.memory_budget is None:
+                return max(1, 1024 // self.retrieval_neighbors)
+            return get_retrieval_chunk_size(self.model, self.retrieval_neighbors, self.X_.shape[0], batch_size, self.memory_budget)
+        if self.memory_budget is not None:
+            n_train = self.X_.shape[0]
+            if self.subsets_ is not None:
+                n_train = max(len(subset) for subset in self.subsets_)
+                batch_size = self.N_ensemble_configurations
+            return get_test_chunk_size(self.model, n_train, batch_size, self.memory_budget, cached_context=self.context_ is not None)
+        return None
+
+    def _predict_proba(self, X, normalize_with_test=False, return_logits=False):
+        if self.subsets_ is not None:
+            return self._predict_proba_subsets(X, normalize_with_test=normalize_with_test, return_logits=return_logits)
         # Input validation
         if self.no_grad:
             X = check_array(X, force_all_finite=False)
@@ -227,24 +420,71 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
 
         eval_pos = self.X_.shape[0]
 
+        # the cached preprocessing and context are computed without looking at the test points
+        context = None if normalize_with_test else self.context_
+        preprocessors = None if normalize_with_test else self.preprocessors_
+
         prediction = transformer_predict(self.model, X_full, y_full, eval_pos,
-                                         device=self.device,
+                                         train_log_weights=self.train_log_weights_,
                                          inference_mode=True,
-                                         preprocess_transform='none' if self.no_preprocess_mode else 'mix',
                                          normalize_with_test=normalize_with_test,
-                                         N_ensemble_configurations=self.N_ensemble_configurations,
                                          softmax_temperature=self.temperature,
-                                         multiclass_decoder=self.multiclass_decoder,
-                                         feature_shift_decoder=self.feature_shift_decoder,
-                                         seed=self.seed,
                                          return_logits=return_logits,
                                          no_grad=self.no_grad,
-                                         batch_size_inference=self.batch_size_inference, scale=self.scale,
-                                         max_features=self.max_num_features)
+                                         context=context,
+                                         session=self.session_,
+                                         preprocessors=preprocessors,
+                                         **self._get_ensemble_params())
         prediction_ = prediction.squeeze(0)
 
         return prediction_.detach().cpu().numpy() if self.no_grad else prediction_
 
+    def _predict_proba_subsets(self, X, normalize_with_test=False, return_logits=False):
+        if normalize_with_test:
+            raise ValueError("normalize_with_test is not supported with subsample_size.")
+        X = torch.tensor(check_array(X, force_all_finite=False), device=self.device).float()
+        X_train = torch.tensor(self.X_, device=self.device).float()
+        y_train = torch.tensor(self.y_, device=self.device).float()
+        tasks = [(X_train[subset], y_train[subset], X) for subset in self.subsets_]
+        params = self._get_ensemble_params()
+        if self.memory_budget is not None:
+            # all members of a subset always share a forward pass; with a budget, no other subset is added to it
+            params['batch_size_inference'] = self.N_ensemble_configurations
+        predictions = transformer_predict_many(self.model, tasks, num_classes=[len(self.classes_)] * len(tasks), return_logits=return_logits,
+                                               preprocessors=self.preprocessors_, session=self.session_, **params)
+        return torch.stack(predictions).mean(dim=0).cpu().numpy()
+
+    def predict_many(self, tasks):
+        """
+        Predicts the probabilities for many independent small tasks at once.
+
+        Each task is a tuple (X_train, y_train, X_test) of numpy arrays. The tasks are padded to common lengths and
+        passed through the model together along the batch dimension, instead of fitting a classifier per task.
+        Returns a list with an array of shape (len(X_test), n_classes) for each task, where the columns correspond
+        to the sorted unique values of y_train. Does not require fit to be called; the model is loaded if necessary.
+        """
+        if not self.no_grad:
+            raise ValueError("predict_many requires no_grad=True.")
+        if not hasattr(self, "model"):
+            self._load_model()
+        tensor_tasks, classes = [], []
+        for X_train, y_train, X_test in tasks:
+            X_train, y_train = check_X_y(X_train, y_train, force_all_finite=False)
+            X_test = check_array(X_test, force_all_finite=False)
+            check_classification_targets(y_train)
+            task_classes, y_train = np.unique(y_train, return_inverse=True)
+            if len(task_classes) > self.max_num_classes:
+                raise ValueError("The number of classes for this classifier is restricted to ", self.max_num_classes)
+            if X_train.shape[1] > self.max_num_features and not self.subsample_features:
+                raise ValueError("The number of features for this classifier is restricted to ", self.max_num_features)
+            classes.append(task_classes)
+            tensor_tasks.append((torch.tensor(X_train, device=self.device).float(), torch.tensor(y_train, device=self.device).float(),
+                                 torch.tensor(X_test, device=self.device).float()))
+        # a fitted classifier has already prepared the model
+        predictions = transformer_predict_many(self.model, tensor_tasks, num_classes=[len(c) for c in classes],
+                                               session=getattr(self, "session_", None), **self._get_ensemble_params())
+        return [prediction.cpu().numpy() for prediction in predictions]
+
     def predict(self, X, return_winning_probability=False, normalize_with_test=False):
         p = self.predict_proba(X, normalize_with_test=normalize_with_test)
         y = np.argmax(p, axis=-1)
@@ -254,14 +494,21 @@ class TabPFNClassifier(BaseEstimator, ClassifierMixin):
         return y
 
 
-def predict(eval_xs, eval_ys, softmax_temperature, return_logits, model, eval_position, num_classes, inference_mode, no_grad):
+def predict(eval_xs, eval_ys, softmax_temperature, return_logits, model, eval_position, num_classes, inference_mode, no_grad,
+            context=None, key_bias=None):
     # Initialize results array size S, B, Classes
     # no_grad disables inference_mode, because otherwise the gradients are lost
     inference_mode_call = torch.inference_mode() if inference_mode and no_grad else NOP()
     with inference_mode_call:
-        output = model(
-            (eval_xs, eval_ys.float()),
-            single_eval_pos=eval_position)[:, :, 0:num_classes]
+        if context is not None:
+            # eval_xs only contains the test points, the training points are encoded in the context
+            output = model.forward_with_context(eval_xs, context)[:, :, 0:num_classes]
+        else:
+            # key_bias is added to the attention logits of each position, passed as a float key padding mask
+            key_padding_mask = key_bias.expand(eval_xs.shape[1], -1) if key_bias is not None else None
+            output = model(
+                (eval_xs, eval_ys.float()),
+                single_eval_pos=eval_position, src_key_padding_mask=key_padding_mask)[:, :, 0:num_classes]
 
         output = output[:, :, 0:num_classes] / torch.exp(softmax_temperature)
         if not return_logits:
@@ -272,73 +519,139 @@ def predict(eval_xs, eval_ys, softmax_temperature, return_logits, model, eval_po
 
 def preprocess_input(eval_xs, eval_ys, preprocess_transform, max_features, normalize_with_test, eval_position,
                      categorical_feats, device, scale):
-    import warnings
-
     if eval_xs.shape[1] > 1:
         raise Exception("Transforms only allow one batch dim - TODO")
 
     if eval_xs.shape[2] > max_features:
         eval_xs = eval_xs[:, :, sorted(np.random.choice(eval_xs.shape[2], max_features, replace=False))]
 
-    if preprocess_transform != 'none':
-        if preprocess_transform == 'power' or preprocess_transform == 'power_all':
-            pt = PowerTransformer(standardize=True)
-        elif preprocess_transform == 'quantile' or preprocess_transform == 'quantile_all':
-            pt = QuantileTransformer(output_distribution='normal')
-        elif preprocess_transform == 'robust' or preprocess_transform == 'robust_all':
-            pt = RobustScaler(unit_variance=True)
+    preprocessor = InputPreprocessor(preprocess_transform, max_features, categorical_feats=categorical_feats, scale=scale)
+    eval_xs = preprocessor.fit_transform(eval_xs, eval_position, normalize_positions=-1 if normalize_with_test else eval_position)
+    return eval_xs.to(device)
 
-    if scale:
-        eval_xs = normalize_data(eval_xs, normalize_positions=-1 if normalize_with_test else eval_position)
-    else:
-        eval_xs = torch.clip(eval_xs, min=-100, max=100)
-
-    # Removing empty features
-    eval_xs = eval_xs[:, 0, :]
-
-    def check_col_values(col_tensor):
-        return len(torch.unique(col_tensor[~col_tensor.isnan()])) > 1
-    sel = [check_col_values(eval_xs[0:eval_ys.shape[0], col]) for col in range(eval_xs.shape[1])]
-    # sel = eval_xs[0:eval_ys.shape[0]].var(dim=0) > 0
-    eval_xs = eval_xs[:, sel]
-
-    warnings.simplefilter('error')
-    if preprocess_transform != 'none':
-        eval_xs = eval_xs.cpu().numpy()
-        feats = set(range(eval_xs.shape[1])) if 'all' in preprocess_transform else set(
-            range(eval_xs.shape[1])) - set(categorical_feats)
-        for col in feats:
-            pt.fit(eval_xs[0:eval_position, col:col + 1])
-            trans = pt.transform(eval_xs[:, col:col + 1])
-            eval_xs[:, col:col + 1] = trans
-        eval_xs = torch.tensor(eval_xs).float()
-    warnings.simplefilter('default')
-
-    eval_xs = eval_xs.unsqueeze(1)
-
-    eval_xs = remove_outliers(eval_xs, normalize_positions=-1 if normalize_with_test else eval_position)
-    # Rescale X
-    eval_xs = normalize_by_used_features_f(eval_xs, eval_xs.shape[-1], max_features)
 
-    return eval_xs.to(device)
+class InputPreprocessor:
+    """
+    Scaling, removal of constant features, feature transform and outlier removal for one preprocessing configuration.
 
+    The statistics are computed from the training part of the input, so with normalize_with_test=False they can be
+    fit once on the training set and then applied to any number of test points.
+    """
 
-def transformer_predict(
-        model, eval_xs, eval_ys, eval_position, device='cpu', max_features=100, inference_mode=False,
-        num_classes=2, extend_features=True, normalize_with_test=False, softmax_temperature=0.0,
-        multiclass_decoder='permutation', preprocess_transform='mix', categorical_feats=[], feature_shift_decoder=False,
-        N_ensemble_configurations=10, batch_size_inference=16, average_logits=True,
-        fp16_inference=False, seed=0, no_grad=True, return_logits=False, scale=True, **kwargs):
+    def __init__(self, preprocess_transform, max_features, categorical_feats=[], scale=True):
+        self.preprocess_transform = preprocess_transform
+        self.max_features = max_features
+        self.categorical_feats = categorical_feats
+        self.scale = scale
 
-    num_classes = len(torch.unique(eval_ys))
+    def fit(self, train_xs):
+        """
+        Fits the preprocessing on the training points, of shape T, 1, H, and stores their transformed values in train_xs_.
+        """
+        self.train_xs_ = self.fit_transform(train_xs, train_xs.shape[0])
+        return self
 
-    eval_xs, eval_ys = eval_xs.to(device), eval_ys.to(device)
-    eval_ys = eval_ys[:eval_position]
+    def fit_transform(self, eval_xs, eval_position, normalize_positions=-1):
+        # Constant features and the feature transform are determined by the training points, i.e. the first eval_position
+        # points, while scaling and outlier removal use the first normalize_positions points, or all points for -1.
+        eval_xs = self._fit_scaling_and_selection(eval_xs, eval_position, normalize_positions)
+        return self._fit_transform_features_and_outliers(eval_xs, eval_position, normalize_positions)
+
+    def _fit_scaling_and_selection(self, eval_xs, eval_position, normalize_positions=-1):
+        if self.scale:
+            mean, std = nan_mean_std(eval_xs if normalize_positions == -1 else eval_xs[:normalize_positions], dim=0)
+            self.mean_, self.std_ = mean, std + .000001
+        eval_xs = self._scale(eval_xs)
+
+        # Removing empty features
+        self.sel_ = ~constant_columns(eval_xs[0:eval_position, 0], dim=0)
+        return eval_xs[:, :, self.sel_]
+
+    def _fit_transform_features_and_outliers(self, eval_xs, eval_position, normalize_positions=-1, transformer=None):
+        # transformer can be given if it was already fit on the features selected by _get_transformed_features
+        self.transformer_ = None
+        if self.preprocess_transform != 'none':
+            self.feats_ = self._get_transformed_features(eval_xs.shape[2])
+            if transformer is not None:
+                self.transformer_ = transformer
+            else:
+                if self.preprocess_transform == 'power' or self.preprocess_transform == 'power_all':
+                    self.transformer_ = TorchPowerTransformer()
+                elif self.preprocess_transform == 'quantile' or self.preprocess_transform == 'quantile_all':
+                    self.transformer_ = TorchQuantileTransformer()
+                elif self.preprocess_transform == 'robust' or self.preprocess_transform == 'robust_all':
+                    self.transformer_ = TorchRobustScaler(unit_variance=True)
+                self.transformer_.fit(eval_xs[0:eval_position, 0, self.feats_])
+        eval_xs = self._transform_features(eval_xs)
+
+        self.lower_, self.upper_ = get_outlier_bounds(eval_xs if normalize_positions == -1 else eval_xs[:normalize_positions])
+        return self._finalize(eval_xs)
+
+    def _get_transformed_features(self, n_features):
+        return sorted(set(range(n_features)) if 'all' in self.preprocess_transform else set(
+            range(n_features)) - set(self.categorical_feats))
+
+    def transform(self, eval_xs):
+        eval_xs = self._scale(eval_xs)[:, :, self.sel_]
+        return self._finalize(self._transform_features(eval_xs))
+
+    def _scale(self, eval_xs):
+        if self.scale:
+            eval_xs = torch.clip((eval_xs - self.mean_) / self.std_, min=-100, max=100)
+        else:
+            eval_xs = torch.clip(eval_xs, min=-100, max=100)
+        return eval_xs
 
-    model.to(device)
-    model.eval()
+    def _transform_features(self, eval_xs):
+        if self.transformer_ is not None:
+            # all columns are transformed at once, each with its own parameters
+            eval_xs[:, 0, self.feats_] = self.transformer_.transform(eval_xs[:, 0, self.feats_])
+        return eval_xs
 
-    softmax_temperature = torch.log(torch.tensor([0.8], device=eval_xs.device))
+    def _finalize(self, eval_xs):
+        eval_xs = clip_outliers(eval_xs, self.lower_, self.upper_)
+        # Rescale X
+        return normalize_by_used_features_f(eval_xs, eval_xs.shape[-1], self.max_features)
+
+
+def fit_preprocessors(train_xs, preprocess_transform='mix', max_features=100, categorical_feats=[], scale=True, **kwargs):
+    """
+    Fits an InputPreprocessor on the training points for each preprocessing configuration used by the ensemble.
+
+    The result can be passed as ``preprocessors`` to transformer_predict with the same ensemble parameters, so that the
+    training statistics are not recomputed for every prediction. Only valid for normalize_with_test=False.
+    """
+    preprocess_transform_configurations = ['none', 'power_all'] if preprocess_transform == 'mix' else [preprocess_transform]
+    with torch.no_grad():
+        return {configuration: InputPreprocessor(configuration, max_features, categorical_feats=categorical_feats, scale=scale).fit(train_xs)
+                for configuration in preprocess_transform_configurations}
+
+
+def fit_preprocessors_many(train_xs_list, preprocess_transform='mix', max_features=100, categorical_feats=[], scale=True, **kwargs):
+    """
+    Like fit_preprocessors for each training set in train_xs_list, but with the power transforms of all training sets
+    fit at once, which avoids running a separate optimization for each of them.
+    """
+    preprocess_transform_configurations = ['none', 'power_all'] if preprocess_transform == 'mix' else [preprocess_transform]
+    preprocessors = [{} for _ in train_xs_list]
+    with torch.no_grad():
+        for configuration in preprocess_transform_configurations:
+            configuration_preprocessors = [InputPreprocessor(configuration, max_features, categorical_feats=categorical_feats, scale=scale)
+                                           for _ in train_xs_list]
+            selected = [preprocessor._fit_scaling_and_selection(train_xs, train_xs.shape[0])
+                        for preprocessor, train_xs in zip(configuration_preprocessors, train_xs_list)]
+            transformers = [None] * len(train_xs_list)
+            if configuration in ['power', 'power_all']:
+                transformers = fit_power_transformers([xs[:, 0, preprocessor._get_transformed_features(xs.shape[2])]
+                                                       for preprocessor, xs in zip(configuration_preprocessors, selected)])
+            for i, (preprocessor, xs, transformer) in enumerate(zip(configuration_preprocessors, selected, transformers)):
+                preprocessor.train_xs_ = preprocessor._fit_transform_features_and_outliers(xs, xs.shape[0], transformer=transformer)
+                preprocessors[i][configuration] = preprocessor
+    return preprocessors
+
+
+def get_ensemble_configurations(eval_xs, eval_ys, preprocess_transform='mix', multiclass_decoder='permutation',
+                                feature_shift_decoder=False, N_ensemble_configurations=10, seed=0):
     preprocess_transform_configurations = ['none', 'power_all'] if preprocess_transform == 'mix' else [preprocess_transform]
 
     if seed is not None:
@@ -353,9 +666,13 @@ def transformer_predict(
     rng = random.Random(seed)
     rng.shuffle(ensemble_configurations)
     ensemble_configurations = list(itertools.product(ensemble_configurations, preprocess_transform_configurations))
-    ensemble_configurations = ensemble_configurations[0:N_ensemble_configurations]
+    return ensemble_configurations[0:N_ensemble_configurations]
 
-    output = None
+
+def build_ensemble_inputs(eval_xs, eval_ys, eval_position, ensemble_configurations, num_classes, device='cpu', max_features=100,
+                          extend_features=True, normalize_with_test=False, categorical_feats=[], scale=True, no_grad=True,
+                          preprocessors=None):
+    # stacks the preprocessed, shifted and padded inputs of all ensemble members along the batch dimension
     eval_xs_transformed = {}
     inputs, labels = [], []
     for ensemble_configuration in ensemble_configurations:
@@ -365,6 +682,11 @@ def transformer_predict(
 
         if preprocess_transform_configuration in eval_xs_transformed:
             eval_xs_ = eval_xs_transformed[preprocess_transform_configuration].clone()
+        elif preprocessors is not None and not normalize_with_test:
+            # the preprocessing was fit on the training points before, only the test points need to be transformed
+            preprocessor = preprocessors[preprocess_transform_configuration]
+            eval_xs_ = torch.cat([preprocessor.train_xs_, preprocessor.transform(eval_xs_[eval_position:])], dim=0).to(device)
+            eval_xs_transformed[preprocess_transform_configuration] = eval_xs_
         else:
             eval_xs_ = preprocess_input(eval_xs_, eval_ys, preprocess_transform=preprocess_transform_configuration, max_features=max_features,
                                         normalize_with_test=normalize_with_test, eval_position=eval_position, categorical_feats=categorical_feats,
@@ -385,29 +707,11 @@ def transformer_predict(
         inputs += [eval_xs_]
         labels += [eval_ys_]
 
-    inputs = torch.cat(inputs, 1)
-    inputs = torch.split(inputs, batch_size_inference, dim=1)
-    labels = torch.cat(labels, 1)
-    labels = torch.split(labels, batch_size_inference, dim=1)
-    outputs = []
-    for batch_input, batch_label in zip(inputs, labels):
-        import warnings
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore",
-                                    message="None of the inputs have requires_grad=True. Gradients will be None")
-            warnings.filterwarnings("ignore",
-                                    message="torch.cuda.amp.autocast only affects CUDA ops, but CUDA is not available.  Disabling.")
-            if device == 'cpu':
-                output_batch = checkpoint(predict, batch_input, batch_label, softmax_temperature,
-                                          True,  model, eval_position, num_classes, inference_mode, no_grad)
+    return torch.cat(inputs, 1), torch.cat(labels, 1)
 
-            else:
-                with torch.cuda.amp.autocast(enabled=fp16_inference):
-                    output_batch = checkpoint(predict, batch_input, batch_label, softmax_temperature,
-                                              True, model, eval_position, num_classes, inference_mode, no_grad)
-        outputs += [output_batch]
 
-    outputs = torch.cat(outputs, 1)
+def aggregate_ensemble_outputs(outputs, ensemble_configurations, average_logits=True, return_logits=False):
+    output = None
     for i, ensemble_configuration in enumerate(ensemble_configurations):
         (class_shift_configuration, feature_shift_configuration), preprocess_transform_configuration = ensemble_configuration
         output_ = outputs[:, i:i+1, :]
@@ -422,6 +726,384 @@ def transformer_predict(
     if average_logits and not return_logits:
         output = torch.nn.functional.softmax(output, dim=-1)
 
-    output = torch.transpose(output, 0, 1)
+    return torch.transpose(output, 0, 1)
 
-    return output
\ No newline at end of file
+
+def transformer_encode_context(
+        model, train_xs, train_ys, device='cpu', max_features=100, extend_features=True, multiclass_decoder='permutation',
+        preprocess_transform='mix', categorical_feats=[], feature_shift_decoder=False, N_ensemble_configurations=10,
+        batch_size_inference=16, seed=0, scale=True, preprocessors=None, **kwargs):
+    """
+    Computes the per-layer attention keys and values of the training set for every ensemble configuration.
+
+    The result can be passed as ``context`` to transformer_predict with the same ensemble parameters, so that only the
+    test points need to be pushed through the transformer. Returns None if the model can not cache the context for
+    this data. Only valid for normalize_with_test=False, as the training part of the input must not depend on the test
+    points.
+    """
+    eval_position = train_xs.shape[0]
+    train_xs, train_ys = train_xs.to(device), train_ys.to(device)
+    num_classes = len(torch.unique(train_ys))
+
+    model.to(device)
+    model.eval()
+
+    ensemble_configurations = get_ensemble_configurations(
+        train_xs, train_ys, preprocess_transform=preprocess_transform, multiclass_decoder=multiclass_decoder,
+        feature_shift_decoder=feature_shift_decoder, N_ensemble_configurations=N_ensemble_configurations, seed=seed)
+    inputs, labels = build_ensemble_inputs(train_xs, train_ys, eval_position, ensemble_configurations, num_classes, device=device,
+                                           max_features=max_features, extend_features=extend_features, categorical_feats=categorical_feats,
+                                           scale=scale, preprocessors=preprocessors)
+    if not model.context_is_cacheable(inputs):
+        return None
+    with torch.inference_mode():
+        return [model.encode_context(batch_input, batch_label)
+                for batch_input, batch_label in zip(torch.split(inputs, batch_size_inference, dim=1),
+                                                    torch.split(labels, batch_size_inference, dim=1))]
+
+
+def _autocast(device, fp16_inference):
+    return torch.cuda.amp.autocast(enabled=fp16_inference) if device != 'cpu' else NOP()
+
+
+class InferenceSession:
+    """
+    A model prepared once for repeated gradient-free prediction with transformer_predict.
+
+    The model is moved to the device and put into eval mode when the session is created, and batches are run under
+    inference_mode without checkpointing, so none of this overhead is paid on every prediction call.
+    """
+
+    def __init__(self, model, device='cpu', fp16_inference=False):
+        self.model = model
+        self.device = device
+        self.fp16_inference = fp16_inference
+        model.to(device)
+        model.eval()
+        self.softmax_temperature = torch.log(torch.tensor([0.8], device=device))
+
+    def predict(self, eval_xs, eval_ys, eval_position, num_classes, context=None, key_bias=None):
+        with torch.inference_mode(), _autocast(self.device, self.fp16_inference):
+            return predict(eval_xs, eval_ys, self.softmax_temperature, True, self.model, eval_position, num_classes,
+                           inference_mode=True, no_grad=True, context=context, key_bias=key_bias)
+
+    def forward(self, eval_xs, eval_ys, eval_position, src_key_padding_mask=None):
+        # the raw model output, for callers that mask the sequence themselves
+        with torch.inference_mode(), _autocast(self.device, self.fp16_inference):
+            return self.model((eval_xs, eval_ys.float()), single_eval_pos=eval_position, src_key_padding_mask=src_key_padding_mask)
+
+
+def _bytes_per_token(model, n_train, batch_size):
+    nhead = model.transformer_encoder.layers[0].self_attn.num_heads
+    # residual stream, attention projections and the feed-forward hidden layer, plus attention scores to all training points
+    floats_per_token = 4 * model.emsize + model.nhid + nhead * n_train
+    return batch_size * floats_per_token * 4
+
+
+def get_subsample_size(model, batch_size, memory_budget, max_size=1024):
+    """
+    Returns the largest training set size, at most max_size, for which the training points of one inference batch of
+    batch_size ensemble members use at most half of memory_budget bytes, leaving the rest for test points.
+
+    Uses the same estimate as get_test_chunk_size.
+    """
+    def fits(n_train):
+        return n_train * _bytes_per_token(model, n_train, batch_size) <= memory_budget / 2
+    if not fits(1):
+        raise ValueError(f"memory_budget of {memory_budget} bytes is too small, need at least "
+                         f"{2 * _bytes_per_token(model, 1, batch_size)} bytes.")
+    low, high = 1, max_size
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def get_stratified_subsets(y, subsample_size, n_subsets=None, random_state=None):
+    """
+    Returns a list of index arrays of subsets of the training set with labels y, each with the class proportions of y.
+
+    Subsets are drawn in rounds, each of which splits a random permutation of the whole training set into
+    ceil(len(y) / subsample_size) disjoint subsets of at most subsample_size points. n_subsets defaults to one round, so
+    that every training point is used exactly once. A class that would be missing from a subset because it has too few
+    points is added with one random point, so all subsets contain all classes.
+    """
+    rng = np.random.RandomState(random_state)
+    n_per_round = int(np.ceil(len(y) / subsample_size))
+    n_subsets = n_per_round if n_subsets is None else n_subsets
+    subsets = []
+    while len(subsets) < n_subsets:
+        # grouping a random permutation by class and dealing it out spreads every class evenly over the subsets
+        order = rng.permutation(len(y))
+        order = order[np.argsort(y[order], kind='stable')]
+        subsets.extend(order[i::n_per_round] for i in range(n_per_round))
+    subsets = subsets[:n_subsets]
+    classes = np.unique(y)
+    for i, subset in enumerate(subsets):
+        missing = np.setdiff1d(classes, y[subset])
+        if len(missing):
+            subsets[i] = np.concatenate([subset, [rng.choice(np.flatnonzero(y == c)) for c in missing]])
+    return subsets
+
+
+def get_class_prototypes(X, y, n_prototypes, random_state=None):
+    """
+    Clusters the points of each class into at most n_prototypes clusters with k-means and returns the cluster means,
+    their labels and the number of points in each cluster.
+
+    Clustering uses standardized features with missing values at the mean; the prototypes are the means of the
+    original features, ignoring missing values. Classes with at most n_prototypes points are kept as they are.
+    """
+    mean, std = nan_mean_std(torch.tensor(X, dtype=torch.float64), dim=0)
+    X_scaled = np.nan_to_num((X - mean.numpy()) / (std.numpy() + .000001), nan=0.)
+    prototypes, labels, counts = [], [], []
+    for label in np.unique(y):
+        X_class, X_class_scaled = X[y == label], X_scaled[y == label]
+        if len(X_class) <= n_prototypes:
+            cluster_means, cluster_sizes = X_class, np.ones(len(X_class))
+        else:
+            clusters = KMeans(n_clusters=n_prototypes, n_init=1, random_state=random_state).fit_predict(X_class_scaled)
+            cluster_sizes = np.bincount(clusters, minlength=n_prototypes)
+            with warnings.catch_warnings():
+                # features that are missing for a whole cluster stay missing
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                cluster_means = np.stack([np.nanmean(X_class[clusters == i], axis=0) for i in np.flatnonzero(cluster_sizes)])
+            cluster_sizes = cluster_sizes[cluster_sizes > 0]
+        prototypes.append(cluster_means)
+        labels.append(np.full(len(cluster_means), label))
+        counts.append(cluster_sizes)
+    return np.concatenate(prototypes), np.concatenate(labels), np.concatenate(counts).astype(np.float64)
+
+
+def get_test_chunk_size(model, n_train, batch_size, memory_budget, cached_context=False):
+    """
+    Returns the largest number of test points per chunk for which the activations of one inference batch of
+    batch_size ensemble members fit in memory_budget bytes.
+
+    This is a rough estimate based on the attention scores and the feed-forward activations of a single layer.
+    """
+    bytes_per_token = _bytes_per_token(model, n_train, batch_size)
+    # without a cached context, the training points are passed through the model with every chunk
+    fixed_bytes = 0 if cached_context else n_train * bytes_per_token
+    chunk_size = int((memory_budget - fixed_bytes) // bytes_per_token)
+    if chunk_size < 1:
+        raise ValueError(f"memory_budget of {memory_budget} bytes is too small for a training set of size {n_train}, "
+                         f"need at least {fixed_bytes + bytes_per_token} bytes.")
+    return chunk_size
+
+
+def get_retrieval_chunk_size(model, n_neighbors, n_train, batch_size, memory_budget):
+    """
+    Returns the largest number of test points per chunk for retrieval contexts, for which the activations of one
+    inference batch of batch_size ensemble members fit in memory_budget bytes.
+
+    The context of a chunk of c test points contains at most min(c * n_neighbors, n_train) training points. Uses the
+    same estimate as get_test_chunk_size.
+    """
+    def fits(chunk_size):
+        n_context = min(chunk_size * n_neighbors, n_train)
+        return (n_context + chunk_size) * _bytes_per_token(model, n_context, batch_size) <= memory_budget
+    if not fits(1):
+        n_context = min(n_neighbors, n_train)
+        raise ValueError(f"memory_budget of {memory_budget} bytes is too small for a retrieval context of size {n_context}, "
+                         f"need at least {(n_context + 1) * _bytes_per_token(model, n_context, batch_size)} bytes.")
+    low, high = 1, max(1, int(memory_budget // _bytes_per_token(model, 1, batch_size)))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def transformer_predict_iter(model, eval_xs, eval_ys, eval_position, test_chunk_size=None, **kwargs):
+    """
+    Yields the output of transformer_predict for consecutive chunks of at most test_chunk_size test points.
+
+    Test points only attend to the training points, so the concatenated outputs are the same as for a single call,
+    unless the normalization uses the test points.
+    """
+    n_total = eval_xs.shape[0]
+    test_chunk_size = test_chunk_size or max(n_total - eval_position, 1)
+    for start in range(eval_position, n_total, test_chunk_size):
+        stop = min(start + test_chunk_size, n_total)
+        chunk_xs = torch.cat([eval_xs[:eval_position], eval_xs[start:stop]], dim=0)
+        chunk_ys = torch.cat([eval_ys[:eval_position], eval_ys[start:stop]], dim=0)
+        yield transformer_predict(model, chunk_xs, chunk_ys, eval_position, **kwargs)
+
+
+def transformer_predict_many(
+        model, tasks, num_classes, device='cpu', max_features=100, extend_features=True, multiclass_decoder='permutation',
+        preprocess_transform='mix', categorical_feats=[], feature_shift_decoder=False, N_ensemble_configurations=10,
+        batch_size_inference=16, average_logits=True, seed=0, scale=True, return_logits=False, preprocessors=None, session=None,
+        **kwargs):
+    """
+    Predicts many independent tasks, each a tuple of tensors (train_xs, train_ys, test_xs) with label-encoded train_ys,
+    by stacking the ensemble members of several tasks along the batch dimension of one forward pass.
+
+    Tasks are sorted by size and batched so that a forward pass contains at most batch_size_inference ensemble members
+    (but always all members of a task). Within a batch, the training points of all tasks are padded to the same
+    length and masked in the attention, the test points are padded and their outputs dropped. Features are padded with
+    zeros as for a single task. The result for each task is the same as from transformer_predict, up to numerical
+    differences, as long as there are no missing values; the missing value indicators of the NanHandlingEncoder are
+    normalized over the whole padded sequence.
+    preprocessors can be a list with the result of fit_preprocessors_many (or None) for each task, otherwise the
+    preprocessing is fit here.
+    session can be an InferenceSession for model, as for transformer_predict, otherwise the model is prepared here.
+    Returns a list with one (n_test, num_classes) tensor per task.
+    """
+    if session is None:
+        session = InferenceSession(model, device=device)
+
+    if preprocessors is None:
+        # the preprocessing of all tasks is fit together; tasks with too many features are subsampled randomly instead
+        cacheable = [i for i, (train_xs, _, _) in enumerate(tasks) if train_xs.shape[1] <= max_features]
+        preprocessors = [None] * len(tasks)
+        fitted = fit_preprocessors_many([tasks[i][0].unsqueeze(1).to(device) for i in cacheable], preprocess_transform=preprocess_transform,
+                                        max_features=max_features, categorical_feats=categorical_feats, scale=scale)
+        for i, task_preprocessors in zip(cacheable, fitted):
+            preprocessors[i] = task_preprocessors
+
+    def get_configurations(train_xs, train_ys):
+        return get_ensemble_configurations(
+            train_xs.unsqueeze(1), train_ys.unsqueeze(1), preprocess_transform=preprocess_transform, multiclass_decoder=multiclass_decoder,
+            feature_shift_decoder=feature_shift_decoder, N_ensemble_configurations=N_ensemble_configurations, seed=seed)
+
+    def build_members(i):
+        train_xs, train_ys, test_xs = tasks[i]
+        eval_xs = torch.cat([train_xs, test_xs], dim=0).unsqueeze(1).to(device)
+        eval_ys = train_ys.unsqueeze(1).to(device)
+        ensemble_configurations = get_configurations(train_xs, train_ys)
+        inputs, labels = build_ensemble_inputs(eval_xs, eval_ys, len(train_xs), ensemble_configurations, len(torch.unique(train_ys)),
+                                               device=device, max_features=max_features, extend_features=extend_features,
+                                               categorical_feats=categorical_feats, scale=scale, preprocessors=preprocessors[i])
+        return inputs, labels, ensemble_configurations
+
+    # sorting by size keeps the padding within a batch small
+    order = sorted(range(len(tasks)), key=lambda i: (len(tasks[i][0]), len(tasks[i][2])))
+    batches, batch, batch_size = [], [], 0
+    for i in order:
+        n_members = len(get_configurations(tasks[i][0], tasks[i][1]))
+        if batch and batch_size + n_members > batch_size_inference:
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(i)
+        batch_size += n_members
+    if batch:
+        batches.append(batch)
+
+    results = [None] * len(tasks)
+    for batch in batches:
+        n_train = max(len(tasks[i][0]) for i in batch)
+        n_test = max(len(tasks[i][2]) for i in batch)
+        # the inputs are only built for the current batch, so the inputs of all tasks are never in memory at once
+        members = {i: build_members(i) for i in batch}
+        batch_inputs, batch_labels, padding_masks = [], [], []
+        for i in batch:
+            inputs, labels, _ = members[i]
+            task_train, task_test = len(tasks[i][0]), len(tasks[i][2])
+            padded = inputs.new_zeros((n_train + n_test, inputs.shape[1], inputs.shape[2]))
+            padded[:task_train] = inputs[:task_train]
+            padded[n_train:n_train + task_test] = inputs[task_train:]
+            padded_labels = labels.new_zeros((n_train, labels.shape[1]))
+            padded_labels[:task_train] = labels
+            padding_mask = torch.ones((inputs.shape[1], n_train + n_test), dtype=torch.bool, device=device)
+            padding_mask[:, :task_train] = False
+            padding_mask[:, n_train:n_train + task_test] = False
+            batch_inputs.append(padded)
+            batch_labels.append(padded_labels)
+            padding_masks.append(padding_mask)
+
+        output = session.forward(torch.cat(batch_inputs, 1), torch.cat(batch_labels, 1), n_train,
+                                 src_key_padding_mask=torch.cat(padding_masks, 0))
+
+        start = 0
+        for i in batch:
+            inputs, _, ensemble_configurations = members[i]
+            task_output = output[:len(tasks[i][2]), start:start + inputs.shape[1], :num_classes[i]] / torch.exp(session.softmax_temperature)
+            results[i] = aggregate_ensemble_outputs(task_output, ensemble_configurations, average_logits=average_logits,
+                                                    return_logits=return_logits).squeeze(0)
+            start += inputs.shape[1]
+    return results
+
+
+def transformer_predict(
+        model, eval_xs, eval_ys, eval_position, device='cpu', max_features=100, inference_mode=False,
+        num_classes=2, extend_features=True, normalize_with_test=False, softmax_temperature=0.0,
+        multiclass_decoder='permutation', preprocess_transform='mix', categorical_feats=[], feature_shift_decoder=False,
+        N_ensemble_configurations=10, batch_size_inference=16, average_logits=True,
+        fp16_inference=False, seed=0, no_grad=True, return_logits=False, scale=True, context=None, test_chunk_size=None,
+        session=None, preprocessors=None, train_log_weights=None, **kwargs):
+    """
+    train_log_weights can be a tensor with one value per training point, which is added to the attention logits of
+    that point, so that a training point with log weight log(c) receives the attention of c identical copies.
+    """
+    if test_chunk_size is not None and eval_xs.shape[0] - eval_position > test_chunk_size:
+        return torch.cat(list(transformer_predict_iter(
+            model, eval_xs, eval_ys, eval_position, test_chunk_size=test_chunk_size, device=device, max_features=max_features,
+            inference_mode=inference_mode, extend_features=extend_features, normalize_with_test=normalize_with_test,
+            multiclass_decoder=multiclass_decoder, preprocess_transform=preprocess_transform, categorical_feats=categorical_feats,
+            feature_shift_decoder=feature_shift_decoder, N_ensemble_configurations=N_ensemble_configurations,
+            batch_size_inference=batch_size_inference, average_logits=average_logits, fp16_inference=fp16_inference, seed=seed,
+            no_grad=no_grad, return_logits=return_logits, scale=scale, context=context, session=session,
+            preprocessors=preprocessors, train_log_weights=train_log_weights)), dim=1)
+
+    num_classes = len(torch.unique(eval_ys))
+
+    eval_xs, eval_ys = eval_xs.to(device), eval_ys.to(device)
+    eval_ys = eval_ys[:eval_position]
+
+    if session is None:
+        model.to(device)
+        model.eval()
+    elif not no_grad:
+        raise ValueError("An InferenceSession can only be used with no_grad=True.")
+
+    softmax_temperature = torch.log(torch.tensor([0.8], device=eval_xs.device))
+
+    key_bias = None
+    if train_log_weights is not None:
+        if context is not None:
+            raise ValueError("train_log_weights can not be used with a cached context.")
+        key_bias = torch.zeros(eval_xs.shape[0], device=device)
+        key_bias[:eval_position] = torch.as_tensor(train_log_weights, device=device)
+
+    ensemble_configurations = get_ensemble_configurations(
+        eval_xs, eval_ys, preprocess_transform=preprocess_transform, multiclass_decoder=multiclass_decoder,
+        feature_shift_decoder=feature_shift_decoder, N_ensemble_configurations=N_ensemble_configurations, seed=seed)
+
+    inputs, labels = build_ensemble_inputs(eval_xs, eval_ys, eval_position, ensemble_configurations, num_classes, device=device,
+                                           max_features=max_features, extend_features=extend_features,
+                                           normalize_with_test=normalize_with_test, categorical_feats=categorical_feats, scale=scale,
+                                           no_grad=no_grad, preprocessors=preprocessors)
+    inputs = torch.split(inputs, batch_size_inference, dim=1)
+    labels = torch.split(labels, batch_size_inference, dim=1)
+    outputs = []
+    for i, (batch_input, batch_label) in enumerate(zip(inputs, labels)):
+        batch_context = None
+        if context is not None and model.context_is_cacheable(batch_input[eval_position:]):
+            # the training part of the sequence has already been encoded, only the test points are needed
+            batch_input, batch_context = batch_input[eval_position:], context[i]
+        if session is not None:
+            output_batch = session.predict(batch_input, batch_label, eval_position, num_classes, context=batch_context, key_bias=key_bias)
+        elif no_grad:
+            # nothing to backpropagate, so checkpointing would only add overhead
+            with torch.inference_mode() if inference_mode else torch.no_grad():
+                with _autocast(device, fp16_inference):
+                    output_batch = predict(batch_input, batch_label, softmax_temperature, True, model, eval_position, num_classes,
+                                           inference_mode, no_grad, batch_context, key_bias)
+        else:
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore",
+                                        message="None of the inputs have requires_grad=True. Gradients will be None")
+                with _autocast(device, fp16_inference):
+                    output_batch = checkpoint(predict, batch_input, batch_label, softmax_temperature,
+                                              True, model, eval_position, num_classes, inference_mode, no_grad, batch_context, key_bias)
+        outputs += [output_batch]
+
+    outputs = torch.cat(outputs, 1)
+    return aggregate_ensemble_outputs(outputs, ensemble_configurations, average_logits=average_logits, return_logits=return_logits)
@@ -0,0 +1,270 @@
+"""
+Torch versions of the sklearn feature transforms used for TabPFN ensembles.
+
+The sklearn transformers are fit one column at a time on numpy arrays, which dominates the cost of predicting on
+small datasets. The transformers here fit all columns of a (samples, features) tensor at once and follow the
+semantics of PowerTransformer(standardize=True), QuantileTransformer(output_distribution='normal') and
+RobustScaler(unit_variance=True), including ignoring NaNs during fitting and passing them through in transform.
+Fitting is done in float64, the output has the dtype of the input.
+"""
+import math
+from functools import partial
+
+import numpy as np
+import torch
+
+BOUNDS_THRESHOLD = 1e-7  # same as sklearn.preprocessing._data.BOUNDS_THRESHOLD
+GOLDEN_SECTION = (3 - math.sqrt(5)) / 2
+
+
+def _handle_zeros_in_scale(scale):
+    # constant features are not scaled, see sklearn.preprocessing._data._handle_zeros_in_scale
+    return torch.where(scale < 10 * torch.finfo(scale.dtype).eps, torch.ones_like(scale), scale)
+
+
+def _nanvar(x, mask, num):
+    mean = torch.where(mask, x, 0).sum(dim=0) / num
+    return torch.where(mask, x - mean, 0).square().sum(dim=0) / num
+
+
+def yeo_johnson(x, lmbda):
+    """
+    Applies the Yeo-Johnson transform with one lambda per column of x (broadcast over the last dimension).
+    """
+    return _yeo_johnson_from_log1p(torch.log1p(x.abs()), x >= 0, lmbda)
+
+
+def _yeo_johnson_from_log1p(log1p_abs, positive, lmbda):
+    # ((x + 1)^l - 1) / l for positive x and -((1 - x)^(2 - l) - 1) / (2 - l) for negative x, written in terms of
+    # log1p(|x|) so that it can be precomputed when evaluating many lambdas.
+    # Replacing a power of zero by machine epsilon gives the limit log1p(|x|) up to rounding.
+    power = torch.where(positive, lmbda, 2 - lmbda)
+    power = torch.where(power.abs() < np.spacing(1.), np.spacing(1.), power)
+    transformed = torch.expm1(power * log1p_abs) / power
+    return torch.where(positive, transformed, -transformed)
+
+
+def fit_yeo_johnson_lambdas(X, max_expansions=10):
+    """
+    Maximum likelihood estimate of the Yeo-Johnson lambda of every column of X, ignoring NaNs.
+
+    Like sklearn, lambda is found with Brent's method, but the search runs on all columns at once.
+    The search starts on [-2, 2] like sklearn and is repeated on a wider interval for the columns whose optimum
+    lies on the boundary. Constant columns get lambda=1, the identity transform.
+    """
+    mask = ~torch.isnan(X)
+    num = mask.sum(dim=0)
+    x = torch.where(mask, X, 0)
+    # same criterion as sklearn.preprocessing._data._is_constant_feature
+    var, mean, eps = _nanvar(x, mask, num), x.sum(dim=0) / num, torch.finfo(torch.float64).eps
+    is_constant = var <= num * eps * var + (num * mean * eps).square()
+
+    # NaNs were replaced by zero, which the transform maps to zero for any lambda
+    log1p_abs, positive = torch.log1p(x.abs()), x >= 0
+    log_term = torch.where(positive, log1p_abs, -log1p_abs).sum(dim=0)
+    mask = mask.to(X.dtype)
+
+    lmbda = torch.ones_like(log_term)
+    lower = torch.full_like(log_term, -2.)
+    upper = torch.full_like(log_term, 2.)
+    todo = ~is_constant
+    for _ in range(max_expansions):
+        cols = todo.nonzero().squeeze(1)
+        if len(cols) == 0:
+            break
+
+        neg_log_likelihood = partial(_yeo_johnson_nll, log1p_abs=log1p_abs[:, cols], positive=positive[:, cols], mask=mask[:, cols],
+                                     num=num[cols], log_term=log_term[cols])
+        lmbda[cols] = _brent_minimize(neg_log_likelihood, lower[cols], upper[cols])
+        at_lower = lmbda[cols] - lower[cols] < 1e-6
+        at_upper = upper[cols] - lmbda[cols] < 1e-6
+        width = upper[cols] - lower[cols]
+        lower[cols] = torch.where(at_lower, lower[cols] - width, lower[cols])
+        upper[cols] = torch.where(at_upper, upper[cols] + width, upper[cols])
+        todo[cols] = at_lower | at_upper
+    return lmbda
+
+
+def _yeo_johnson_nll(lmbda, log1p_abs, positive, mask, num, log_term):
+    X_trans = _yeo_johnson_from_log1p(log1p_abs, positive, lmbda)
+    mean = X_trans.sum(dim=0) / num
+    var = ((X_trans - mean) * mask).square().sum(dim=0) / num
+    nll = num / 2 * torch.log(var) - (lmbda - 1) * log_term
+    return torch.where(var < torch.finfo(var.dtype).tiny, math.inf, nll)
+
+
+def _brent_minimize(f, lower, upper, tol=1.48e-8, max_iter=500):
+    # Brent's method as in scipy.optimize.brent (parabolic interpolation with golden section steps as fallback),
+    # run for all entries of lower and upper at once; f is evaluated elementwise.
+    # Assumes f is unimodal on [lower, upper]; entries that have converged are not updated any more.
+    x = w = v = lower + GOLDEN_SECTION * (upper - lower)
+    fx = fw = fv = f(x)
+    d = e = torch.zeros_like(x)
+    for _ in range(max_iter):
+        midpoint = (lower + upper) / 2
+        tol1 = tol * x.abs() + 1e-11
+        tol2 = 2 * tol1
+        active = (x - midpoint).abs() > tol2 - (upper - lower) / 2
+        if not active.any():
+            break
+        # parabola through x, w and v
+        r = (x - w) * (fx - fv)
+        q = (x - v) * (fx - fw)
+        p = (x - v) * q - (x - w) * r
+        q = 2 * (q - r)
+        p = torch.where(q > 0, -p, p)
+        q = q.abs()
+        use_parabola = ((e.abs() > tol1) & (p.abs() < (0.5 * q * e).abs())
+                        & (p > q * (lower - x)) & (p < q * (upper - x)))
+        golden_e = torch.where(x >= midpoint, lower - x, upper - x)
+        parabola_d = p / q
+        parabola_u = x + parabola_d
+        parabola_d = torch.where((parabola_u - lower < tol2) | (upper - parabola_u < tol2),
+                                 torch.where(midpoint >= x, tol1, -tol1), parabola_d)
+        e = torch.where(use_parabola, d, golden_e)
+        d = torch.where(use_parabola, parabola_d, GOLDEN_SECTION * golden_e)
+        u = x + torch.where(d.abs() >= tol1, d, torch.where(d >= 0, tol1, -tol1))
+        fu = f(u)
+
+        improved = fu <= fx
+        new_lower = torch.where(improved, torch.where(u >= x, x, lower), torch.where(u < x, u, lower))
+        new_upper = torch.where(improved, torch.where(u >= x, upper, x), torch.where(u < x, upper, u))
+        replace_w = ~improved & ((fu <= fw) | (w == x))
+        replace_v = ~improved & ~replace_w & ((fu <= fv) | (v == x) | (v == w))
+        new_v = torch.where(improved | replace_w, w, torch.where(replace_v, u, v))
+        new_fv = torch.where(improved | replace_w, fw, torch.where(replace_v, fu, fv))
+        new_w = torch.where(improved, x, torch.where(replace_w, u, w))
+        new_fw = torch.where(improved, fx, torch.where(replace_w, fu, fw))
+        new_x = torch.where(improved, u, x)
+        new_fx = torch.where(improved, fu, fx)
+
+        lower, upper = torch.where(active, new_lower, lower), torch.where(active, new_upper, upper)
+        v, fv = torch.where(active, new_v, v), torch.where(active, new_fv, fv)
+        w, fw = torch.where(active, new_w, w), torch.where(active, new_fw, fw)
+        x, fx = torch.where(active, new_x, x), torch.where(active, new_fx, fx)
+    return x
+
+
+def _interp(x, xp, fp):
+    # np.interp for every column: x is (samples, features), xp is (points, features) sorted along dim 0, fp is (points,)
+    xp_t = xp.T.contiguous()
+    idx = torch.searchsorted(xp_t, x.T.contiguous(), right=True).T - 1
+    idx = idx.clamp(0, xp.shape[0] - 2)
+    x_left, x_right = xp.gather(0, idx), xp.gather(0, idx + 1)
+    f_left, f_right = fp[idx], fp[idx + 1]
+    result = f_left + (f_right - f_left) / (x_right - x_left) * (x - x_left)
+    # exact hits (including repeated xp values) and values outside of the range are handled as in numpy
+    result = torch.where(x == x_left, f_left, result)
+    result = torch.where(x >= xp[-1], fp[-1], result)
+    return torch.where(x < xp[0], fp[0], result)
+
+
+class TorchPowerTransformer:
+    """
+    Yeo-Johnson power transform followed by standardization, like sklearn's PowerTransformer(standardize=True).
+    """
+
+    def fit(self, X):
+        X = X.double()
+        self.lambdas_ = fit_yeo_johnson_lambdas(X)
+        X_trans = yeo_johnson(X, self.lambdas_)
+        mask = ~torch.isnan(X_trans)
+        num = mask.sum(dim=0)
+        self.mean_ = torch.where(mask, X_trans, 0).sum(dim=0) / num
+        self.scale_ = _handle_zeros_in_scale(_nanvar(X_trans, mask, num).sqrt())
+        return self
+
+    def transform(self, X):
+        return ((yeo_johnson(X.double(), self.lambdas_) - self.mean_) / self.scale_).to(X.dtype)
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
+
+
+def fit_power_transformers(Xs):
+    """
+    Fits a TorchPowerTransformer on each of the matrices in Xs, which can have different numbers of rows and columns.
+
+    The columns of all matrices are fit together, padded with NaNs, which are ignored, so this gives the same result
+    as fitting each matrix separately, but without running the lambda search once per matrix.
+    """
+    n_rows = max([X.shape[0] for X in Xs], default=0)
+    n_columns = [X.shape[1] for X in Xs]
+    if sum(n_columns) == 0:
+        return [TorchPowerTransformer().fit(X) for X in Xs]
+    padded = torch.full((n_rows, sum(n_columns)), np.nan, dtype=torch.float64, device=Xs[0].device)
+    start = 0
+    for X in Xs:
+        padded[:X.shape[0], start:start + X.shape[1]] = X
+        start += X.shape[1]
+    combined = TorchPowerTransformer().fit(padded)
+
+    transformers = []
+    for lambdas, mean, scale in zip(*[torch.split(values, n_columns) for values in
+                                      (combined.lambdas_, combined.mean_, combined.scale_)]):
+        transformer = TorchPowerTransformer()
+        transformer.lambdas_, transformer.mean_, transformer.scale_ = lambdas, mean, scale
+        transformers.append(transformer)
+    return transformers
+
+
+class TorchQuantileTransformer:
+    """
+    Maps features to a standard normal distribution using their quantiles,
+    like sklearn's QuantileTransformer(output_distribution='normal').
+
+    Unlike sklearn, the training data is not subsampled.
+    """
+
+    def __init__(self, n_quantiles=1000):
+        self.n_quantiles = n_quantiles
+
+    def fit(self, X):
+        X = X.double()
+        n_quantiles = min(self.n_quantiles, X.shape[0])
+        self.references_ = torch.linspace(0, 1, n_quantiles, dtype=X.dtype, device=X.device)
+        # make the quantiles monotonic to deal with floating point errors, like sklearn
+        self.quantiles_ = torch.nanquantile(X, self.references_, dim=0).cummax(dim=0).values
+        return self
+
+    def transform(self, X):
+        x = X.double()
+        lower_bound, upper_bound = self.quantiles_[0], self.quantiles_[-1]
+        # interpolating forward and backward and averaging handles repeated quantiles
+        result = 0.5 * (_interp(x, self.quantiles_, self.references_)
+                        - _interp(-x, -self.quantiles_.flip(0), -self.references_.flip(0)))
+        result = torch.where(x + BOUNDS_THRESHOLD > upper_bound, 1., result)
+        result = torch.where(x - BOUNDS_THRESHOLD < lower_bound, 0., result)
+        result = torch.special.ndtri(result)
+        clip = float(torch.special.ndtri(torch.tensor(BOUNDS_THRESHOLD - np.spacing(1), dtype=torch.float64)))
+        result = torch.clip(result, clip, -clip)
+        return torch.where(torch.isnan(x), x, result).to(X.dtype)
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
+
+
+class TorchRobustScaler:
+    """
+    Centers by the median and scales by the interquartile range, like sklearn's RobustScaler.
+    """
+
+    def __init__(self, unit_variance=True):
+        self.unit_variance = unit_variance
+
+    def fit(self, X):
+        X = X.double()
+        quantiles = torch.nanquantile(X, torch.tensor([0.25, 0.5, 0.75], dtype=X.dtype, device=X.device), dim=0)
+        self.center_ = quantiles[1]
+        scale = _handle_zeros_in_scale(quantiles[2] - quantiles[0])
+        if self.unit_variance:
+            # the interquartile range of the standard normal distribution
+            scale = scale / (2 * float(torch.special.ndtri(torch.tensor(0.75, dtype=torch.float64))))
+        self.scale_ = scale
+        return self
+
+    def transform(self, X):
+        return ((X.double() - self.center_) / self.scale_).to(X.dtype)
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
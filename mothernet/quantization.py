@@ -0,0 +1,77 @@
+"""
+Low-precision copies of models for CPU inference.
+
+Only the linear layers of the transformer encoder layers and of the decoders are converted, which hold most of the
+weights of TabPFN, MotherNet and additive models. The attention projections and the input encoders stay in float32.
+"""
+import copy
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from mothernet.models.layer import TransformerEncoderLayer
+
+LOW_PRECISION_MODES = ('int8', 'bf16')
+
+
+class BFloat16Linear(nn.Module):
+    """
+    Linear layer with bfloat16 weights. Inputs are cast to bfloat16 for the matrix multiplication, outputs are cast
+    back to the dtype of the input, so the layer can replace a float32 nn.Linear.
+    """
+
+    def __init__(self, linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.weight = nn.Parameter(linear.weight.detach().to(torch.bfloat16), requires_grad=False)
+        self.bias = nn.Parameter(linear.bias.detach().to(torch.bfloat16), requires_grad=False) if linear.bias is not None else None
+
+    def forward(self, input):
+        return F.linear(input.to(torch.bfloat16), self.weight, self.bias).to(input.dtype)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}'
+
+
+def _quantized_modules(model):
+    modules = []
+    if hasattr(model, 'transformer_encoder'):
+        # TabPFN, MotherNet and additive models all use mothernet.models.layer.TransformerEncoderLayer. Other layer
+        # types are skipped, as torch.nn.TransformerEncoderLayer accesses the weights of its linear layers directly.
+        modules.extend(layer for layer in model.transformer_encoder.layers if isinstance(layer, TransformerEncoderLayer))
+    if hasattr(model, 'decoder'):
+        modules.append(model.decoder)
+    return modules
+
+
+def _replace_linear_with_bf16(module):
+    for name, child in module.named_children():
+        # the output projection of nn.MultiheadAttention is a subclass of Linear that is used through its weight
+        if type(child) is nn.Linear:
+            setattr(module, name, BFloat16Linear(child))
+        elif not isinstance(child, nn.MultiheadAttention):
+            _replace_linear_with_bf16(child)
+
+
+def quantize_model(model, mode):
+    """
+    Returns a copy of model with the linear layers of the transformer layers and decoders in low precision.
+
+    mode 'int8' uses dynamic int8 quantization, which stores weights in int8 and quantizes activations on the fly.
+    mode 'bf16' stores the weights in bfloat16 and runs the matrix multiplications in bfloat16.
+    Both are meant for inference on CPU; the original model is not modified.
+    """
+    if mode not in LOW_PRECISION_MODES:
+        raise ValueError(f"Unknown low precision mode {mode}, must be one of {LOW_PRECISION_MODES}.")
+    if any(p.device.type != 'cpu' for p in model.parameters()):
+        raise ValueError("Low precision inference is only supported for models on cpu.")
+    model = copy.deepcopy(model)
+    model.eval()
+    for module in _quantized_modules(model):
+        if mode == 'int8':
+            torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        else:
+            _replace_linear_with_bf16(module)
+    return model
@@ -1,3 +1,6 @@
+import os
+
+import numpy as np
 from sklearn.datasets import load_iris
 from sklearn.model_selection import train_test_split
 
@@ -25,4 +28,38 @@ def check_predict_iris(clf):
     X_train, X_test, y_train, y_test = train_test_split(iris.data, iris.target, random_state=42)
     clf.fit(X_train, y_train)
     y_pred = clf.predict(X_test)
-    assert y_pred.shape[0] == X_test.shape[0]
\ No newline at end of file
+    assert y_pred.shape[0] == X_test.shape[0]
+
+
+def check_artifact_iris(clf, tmpdir):
+    # the fitted clf exported with save_artifact and loaded again predicts the same
+    from mothernet.artifact import load_artifact
+    iris = load_iris()
+    X_train, X_test, y_train, y_test = train_test_split(iris.data, iris.target, random_state=42)
+    clf.fit(X_train, y_train)
+    path = os.path.join(tmpdir, "artifact.npz")
+    clf.save_artifact(path)
+    loaded = load_artifact(path)
+    np.testing.assert_allclose(loaded.predict_proba(X_test), clf.predict_proba(X_test), atol=1e-6)
+    np.testing.assert_array_equal(loaded.predict(X_test), clf.predict(X_test))
+
+
+def check_fused_ensemble_iris(clf):
+    # the fused ensemble predicts the same as the VotingClassifier of clones
+    from mothernet.prediction import EnsembleMeta
+    iris = load_iris()
+    X_train, X_test, y_train, y_test = train_test_split(iris.data, iris.target, random_state=42)
+    ensemble = EnsembleMeta(clf, n_estimators=8, random_state=0, n_jobs=1).fit(X_train, y_train)
+    fused = EnsembleMeta(clf, n_estimators=8, random_state=0, fused=True).fit(X_train, y_train)
+    np.testing.assert_allclose(fused.predict_proba(X_test), ensemble.predict_proba(X_test), atol=1e-5)
+    np.testing.assert_array_equal(fused.classes_, ensemble.classes_)
+
+
+def check_low_rank_iris(clf):
+    # extracting the factors of a factorized additive model predicts the same as the dense lookup tables
+    from sklearn.base import clone
+    iris = load_iris()
+    X_train, X_test, y_train, y_test = train_test_split(iris.data, iris.target, random_state=42)
+    clf.fit(X_train, y_train)
+    low_rank = clone(clf).set_params(low_rank=True).fit(X_train, y_train)
+    np.testing.assert_allclose(low_rank.predict_proba(X_test), clf.predict_proba(X_test), atol=1e-5)
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+import torch
+
+from mothernet.artifact import AdditivePredictor, LowRankAdditivePredictor, load_artifact, save_artifact
+from mothernet.models.decoders import FactorizedAdditiveModelDecoder
+from mothernet.models.encoders import Linear
+from mothernet.models.mothernet_additive import (MotherNetAdditive, bin_data, bin_data_indices, quantile_bin_edges,
+                                                searchsorted_columns, sum_bins)
+from mothernet.prediction.mothernet_additive import predict_with_additive_model, torch_additive_decision_function
+
+
+def reference_decision_function(X_test, weights, biases, bin_edges):
+    # the computation of predict_with_additive_model before it was vectorized
+    X_test = np.nan_to_num(X_test, 0)
+    out = np.zeros((X_test.shape[0], weights.shape[-1]))
+    for col, bins, w in zip(X_test.T, bin_edges, weights):
+        binned = np.searchsorted(bins, col)
+        out += w[binned]
+    return out + biases
+
+
+@pytest.mark.parametrize("ragged", [False, True])
+def test_additive_backends(ragged):
+    rng = np.random.RandomState(0)
+    weights = rng.normal(size=(6, 16, 3)).astype(np.float32)
+    biases = rng.normal(size=3).astype(np.float32)
+    bin_edges = np.sort(rng.normal(size=(6, 15)), axis=1).astype(np.float32)
+    X_test = rng.normal(size=(1000, 6))
+    X_test[rng.uniform(size=X_test.shape) < 0.1] = np.nan
+    # values on the edges
+    X_test[:10, 0] = bin_edges[0, :10]
+    if ragged:
+        bin_edges = [edges[:15 - i] for i, edges in enumerate(bin_edges)]
+    expected = reference_decision_function(X_test, weights, biases, bin_edges)
+
+    np.testing.assert_allclose(AdditivePredictor(weights, biases, bin_edges, block_size=64).decision_function(X_test), expected, atol=1e-10)
+    np.testing.assert_allclose(torch_additive_decision_function(X_test, weights, biases, bin_edges, block_size=64).numpy(), expected,
+                               atol=1e-10)
+    assert predict_with_additive_model(None, X_test, weights, biases, bin_edges).shape == (1000, 3)
+
+
+@pytest.mark.parametrize("input_bin_embedding", ["linear", "nonlinear", "none"])
+def test_bin_indices_match_onehot(input_bin_embedding):
+    torch.manual_seed(0)
+    model = MotherNetAdditive(n_features=6, n_out=3, emsize=16, nhead=2, nhid_factor=2, nlayers=1, n_bins=8,
+                              y_encoder_layer=Linear(1, 16), input_bin_embedding=input_bin_embedding, bin_embedding_rank=4,
+                              decoder_type="average", decoder_hidden_size=32, decoder_embed_dim=32)
+    X = torch.randn(30, 2, 6)
+    # zero padded features
+    X[:, 0, 4:] = 0
+    X_onehot, _ = bin_data(X, n_bins=8, single_eval_pos=20)
+    X_binned, zero_padding, _ = bin_data_indices(X, n_bins=8, single_eval_pos=20)
+    assert zero_padding.tolist() == [[False] * 4 + [True] * 2, [False] * 6]
+    with torch.no_grad():
+        torch.testing.assert_close(model.encode_bins(X_binned, zero_padding), model.encoder(X_onehot.float()))
+        weights = torch.randn(2, 6, 8, 3)
+        torch.testing.assert_close(sum_bins(X_binned, zero_padding, torch.nn.functional.pad(weights, (0, 0, 0, 1))),
+                                   torch.einsum("nbkd,bkdo->nbo", X_onehot.float(), weights))
+        # a table shared by the batch is the same as repeating it for every batch element
+        shared = torch.randn(6, 9, 3)
+        torch.testing.assert_close(sum_bins(X_binned, zero_padding, shared),
+                                   sum_bins(X_binned, zero_padding, shared.unsqueeze(0).expand(2, -1, -1, -1)))
+        assert model((None, X, torch.randint(3, (30, 2)).float()), single_eval_pos=20).shape == (10, 2, 3)
+
+
+def test_quantile_binning():
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(301, 3, 10)).astype(np.float32)
+    # ties
+    X[:, :, :3] = rng.randint(4, size=(301, 3, 3))
+    edges = quantile_bin_edges(torch.tensor(X), 16)
+    np.testing.assert_allclose(edges.numpy(), np.quantile(X, np.arange(1, 16) / 16, axis=0), rtol=1e-6)
+    expected = np.stack([[np.searchsorted(edges[:, b, k].numpy(), X[:, b, k]) for k in range(10)] for b in range(3)]).transpose(2, 0, 1)
+    assert (searchsorted_columns(edges, torch.tensor(X), block_size=100).numpy() == expected).all()
+
+
+@pytest.mark.parametrize("per_class_coefficients", [True, False])
+def test_low_rank_additive_predictor(per_class_coefficients, tmp_path):
+    rng = np.random.RandomState(0)
+    if per_class_coefficients:
+        coefficients, basis = rng.normal(size=(6, 4, 3)), rng.normal(size=(4, 16))
+        weights = np.einsum('kro,rd->kdo', coefficients, basis)
+    else:
+        coefficients, basis = rng.normal(size=(6, 4)), rng.normal(size=(4, 16, 3))
+        weights = np.einsum('kr,rdo->kdo', coefficients, basis)
+    biases = rng.normal(size=3)
+    bin_edges = np.sort(rng.normal(size=(6, 15)), axis=1)
+    X_test = rng.normal(size=(1000, 6))
+    X_test[rng.uniform(size=X_test.shape) < 0.1] = np.nan
+    predictor = LowRankAdditivePredictor(coefficients, basis, biases, bin_edges, block_size=64)
+    expected = AdditivePredictor(weights, biases, bin_edges).decision_function(X_test)
+    np.testing.assert_allclose(predictor.decision_function(X_test), expected, rtol=1e-6, atol=1e-10)
+    save_artifact(tmp_path / "low_rank.npz", predictor, np.array([0, 1, 2]))
+    np.testing.assert_allclose(load_artifact(tmp_path / "low_rank.npz").predict_proba(X_test), predictor.predict_proba(X_test))
+
+
+@pytest.mark.parametrize("decoder_args", [dict(decoder_type="average"), dict(decoder_type="class_average"),
+                                          dict(decoder_type="class_average", shape_attention=True, shape_attention_heads=2)])
+def test_low_rank_decoder(decoder_args):
+    torch.manual_seed(0)
+    decoder = FactorizedAdditiveModelDecoder(emsize=16, n_features=6, n_bins=8, n_out=3, hidden_size=32, embed_dim=32,
+                                             nhead=2, rank=4, n_shape_functions=5, **decoder_args)
+    x, y = torch.randn(20, 2, 16), torch.randint(3, (20, 2)).float()
+    with torch.no_grad():
+        weights, biases = decoder(x, y)
+        coefficients, basis, low_rank_biases = decoder.low_rank_forward(x, y)
+    if coefficients.dim() == 4:
+        torch.testing.assert_close(torch.einsum('bkro,rd->bkdo', coefficients, basis), weights)
+    else:
+        torch.testing.assert_close(torch.einsum('bkr,rdo->bkdo', coefficients, basis), weights)
+    assert low_rank_biases is biases
@@ -4,6 +4,7 @@ from mothernet.priors import BagPrior, ClassificationAdapterPrior
 from mothernet.distributions import LogUniformHyperparameter
 
 import lightning as L
+import torch
 
 import pytest
 
@@ -114,3 +115,35 @@ def test_get_dataloader_uninformative_mlp(batch_size=16, n_samples=256, n_featur
         (_, x, y), target_y, single_eval_pos = dataloader.gbm()
     assert x.shape == (n_samples, batch_size, n_features)
     assert y.shape == (n_samples, batch_size)
+
+
+def test_dataloader_workers(batch_size=4, n_samples=64, n_features=100):
+    config = get_base_config()
+    prior_config = config['prior']
+    dataloader_config = config['dataloader']
+    dataloader_config['num_steps'] = 5
+    dataloader_config['batch_size'] = batch_size
+    dataloader_config['max_eval_pos'] = 32
+    dataloader_config['num_workers'] = 2
+    prior_config['n_samples'] = n_samples
+    prior_config['num_features'] = n_features
+
+    def sample_epochs():
+        L.seed_everything(42)
+        dataloader = get_dataloader(prior_config=prior_config, dataloader_config=dataloader_config, device="cpu")
+        return [list(dataloader) for _ in range(2)]
+
+    epochs = sample_epochs()
+    for batches in epochs:
+        assert len(batches) == 5
+        for (_, x, y), target_y, single_eval_pos in batches:
+            assert x.shape == (n_samples, batch_size, n_features)
+            assert y.shape == target_y.shape == (n_samples, batch_size)
+            assert 2 <= single_eval_pos < 32
+    # workers and epochs have different seeds, but the same seed gives the same batches
+    assert not torch.equal(epochs[0][0][0][1], epochs[0][1][0][1])
+    assert not torch.equal(epochs[0][0][0][1], epochs[1][0][0][1])
+    for batches, batches_again in zip(epochs, sample_epochs()):
+        for batch, batch_again in zip(batches, batches_again):
+            torch.testing.assert_close(batch[0][1], batch_again[0][1], equal_nan=True)
+            assert batch[2] == batch_again[2]
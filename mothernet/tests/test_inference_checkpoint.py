@@ -0,0 +1,43 @@
+import lightning as L
+import numpy as np
+import torch
+from sklearn.datasets import load_iris
+
+from mothernet.fit_model import main
+from mothernet.inference_checkpoint import is_inference_checkpoint, load_inference_checkpoint, save_inference_checkpoint
+from mothernet.model_builder import _load_model, convert_checkpoint
+from mothernet.prediction import MotherNetClassifier
+from mothernet.testing_utils import TESTING_DEFAULTS_SHORT, get_model_path
+
+
+def test_save_load_roundtrip(tmp_path):
+    tensors = {'a': torch.randn(3, 5), 'b': torch.arange(7), 'c': torch.randn(4).bfloat16(), 'd': torch.tensor(1.5), 'e': torch.zeros(0, 3)}
+    config = {'nested': {'activations': [torch.nn.ReLU, torch.nn.Tanh], 'value': 1.5}, 'name': 'test'}
+    save_inference_checkpoint(tmp_path / "model.mninf", tensors, config)
+    assert is_inference_checkpoint(tmp_path / "model.mninf")
+    loaded, loaded_config = load_inference_checkpoint(tmp_path / "model.mninf")
+    assert loaded_config == config
+    assert loaded.keys() == tensors.keys()
+    for name, tensor in tensors.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)
+
+
+def test_convert_checkpoint(tmp_path):
+    L.seed_everything(42)
+    results = main(TESTING_DEFAULTS_SHORT + ['-B', str(tmp_path)])
+    path = get_model_path(results)
+    assert not is_inference_checkpoint(path)
+    convert_checkpoint(path, tmp_path / "model.mninf")
+
+    model, _ = _load_model(path, 'cpu')
+    inference_model, config = _load_model(tmp_path / "model.mninf", 'cpu')
+    assert config['model_type'] == 'mothernet'
+    assert not inference_model.training
+    state, inference_state = model.state_dict(), inference_model.state_dict()
+    assert state.keys() == inference_state.keys()
+    assert all(torch.equal(state[name], inference_state[name]) for name in state)
+
+    X, y = load_iris(return_X_y=True)
+    prob = MotherNetClassifier(path=path).fit(X, y).predict_proba(X)
+    np.testing.assert_array_equal(MotherNetClassifier(path=tmp_path / "model.mninf").fit(X, y).predict_proba(X), prob)
@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+import torch
+
+from mothernet.models.layer import TransformerEncoderLayer, chunked_attention
+
+
+@pytest.fixture
+def layer():
+    torch.manual_seed(0)
+    return TransformerEncoderLayer(16, 4, 32, dropout=0.0).eval()
+
+
+def attention(layer, q, kv, **kwargs):
+    # reference: nn.MultiheadAttention with the same parameters
+    return layer.self_attn(q, kv, kv, need_weights=False, **kwargs)[0]
+
+
+def test_matches_multihead_attention(layer):
+    src = torch.randn(10, 3, 16)
+    padding_mask = torch.zeros(3, 10, dtype=torch.bool)
+    padding_mask[1, 5:] = True
+    attn_mask = torch.triu(torch.ones(10, 10, dtype=torch.bool), diagonal=1)
+    float_mask = torch.zeros(10, 10).masked_fill(attn_mask, float('-inf'))
+    for kwargs in [{}, dict(attn_mask=attn_mask), dict(attn_mask=float_mask), dict(key_padding_mask=padding_mask),
+                   dict(attn_mask=attn_mask, key_padding_mask=padding_mask)]:
+        expected = layer._residual_and_feedforward(src, attention(layer, src, src, **kwargs))
+        result = layer(src, src_mask=kwargs.get('attn_mask'), src_key_padding_mask=kwargs.get('key_padding_mask'))
+        torch.testing.assert_close(result, expected)
+
+
+def test_single_eval_position(layer):
+    src = torch.randn(10, 3, 16)
+    padding_mask = torch.zeros(3, 10, dtype=torch.bool)
+    padding_mask[1, 4:6] = True
+    src2 = torch.cat([attention(layer, src[:6], src[:6], key_padding_mask=padding_mask[:, :6]),
+                      attention(layer, src[6:], src[:6], key_padding_mask=padding_mask[:, :6])])
+    expected = layer._residual_and_feedforward(src, src2)
+    torch.testing.assert_close(layer(src, src_mask=6, src_key_padding_mask=padding_mask), expected)
+
+
+def test_global_attention_masks(layer):
+    src = torch.randn(10, 3, 16)
+    global_mask = torch.zeros(2, 6)
+    trainset_mask = torch.zeros(4, 2)
+    valset_mask = torch.zeros(4, 10)
+    valset_mask[:, 6:] = float('-inf')
+    src2 = torch.cat([attention(layer, src[:2], src[:6], attn_mask=global_mask),
+                      attention(layer, src[2:6], src[:2], attn_mask=trainset_mask),
+                      attention(layer, src[6:], src, attn_mask=valset_mask)])
+    expected = layer._residual_and_feedforward(src, src2)
+    torch.testing.assert_close(layer(src, src_mask=(global_mask, trainset_mask, valset_mask)), expected)
+
+
+def test_state_dict_compatible(layer):
+    assert {'self_attn.in_proj_weight', 'self_attn.in_proj_bias', 'self_attn.out_proj.weight', 'self_attn.out_proj.bias'} <= \
+        set(layer.state_dict())
+
+
+def test_chunked_attention(layer):
+    src = torch.randn(10, 3, 16)
+    padding_mask = torch.zeros(3, 10, dtype=torch.bool)
+    padding_mask[1, 5:] = True
+    attn_mask = torch.triu(torch.ones(10, 10, dtype=torch.bool), diagonal=1)
+    valset_mask = torch.zeros(4, 10)
+    valset_mask[:, 6:] = float('-inf')
+    tuple_mask = (torch.zeros(2, 6), torch.zeros(4, 2), valset_mask)
+    for kwargs in [{}, dict(src_mask=attn_mask, src_key_padding_mask=padding_mask), dict(src_mask=6), dict(src_mask=tuple_mask)]:
+        expected = layer(src, **kwargs)
+        with chunked_attention(layer, 3):
+            assert layer.attention_block_size == 3
+            torch.testing.assert_close(layer(src, **kwargs), expected)
+        assert layer.attention_block_size is None
+
+
+def test_chunked_attention_is_thread_local(layer):
+    # a model shared between threads keeps the block size of each thread
+    entered, done = threading.Event(), threading.Event()
+    seen = []
+
+    def other_thread():
+        with chunked_attention(layer, 5):
+            entered.set()
+            done.wait()
+            seen.append(layer.attention_block_size)
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    entered.wait()
+    with chunked_attention(layer, 3):
+        assert layer.attention_block_size == 3
+    assert layer.attention_block_size is None
+    done.set()
+    thread.join()
+    assert seen == [5]
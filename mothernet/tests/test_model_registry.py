@@ -0,0 +1,73 @@
+import threading
+import time
+
+from torch import nn
+
+from mothernet.model_registry import ModelRegistry, get_nbytes
+
+
+def make_model(n_features):
+    # 4 * (n_features * 10 + 10) bytes
+    return nn.Linear(n_features, 10), {}
+
+
+def test_get_nbytes():
+    model, config = make_model(5)
+    assert get_nbytes((model, config)) == 4 * 60
+    assert get_nbytes(model) == 4 * 60
+    assert get_nbytes(config) == 0
+
+
+def test_lru_eviction_by_size():
+    registry = ModelRegistry(max_bytes=4 * 60 * 2)
+    a = registry.get("a", lambda: make_model(5))
+    assert registry.get("a", lambda: make_model(5)) is a
+    registry.get("b", lambda: make_model(5))
+    # a was used more recently than b
+    registry.get("a", lambda: make_model(5))
+    registry.get("c", lambda: make_model(5))
+    assert "a" in registry and "c" in registry and "b" not in registry
+    assert registry.stats() == dict(hits=2, misses=3, evictions=1, n_models=2, nbytes=4 * 60 * 2, max_bytes=4 * 60 * 2,
+                                    max_models=None)
+    # models larger than the budget are not cached
+    registry.get("large", lambda: make_model(100))
+    assert "large" not in registry
+    assert registry.evictions == 2
+
+    registry.max_bytes = 4 * 60
+    assert len(registry) == 1
+    registry.max_bytes = None
+    registry.max_models = 1
+    registry.get("d", lambda: make_model(5))
+    assert len(registry) == 1 and "d" in registry
+
+
+def test_concurrent_loading():
+    registry = ModelRegistry()
+    n_loads = []
+
+    def loader():
+        n_loads.append(1)
+        time.sleep(0.1)
+        return make_model(5)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("a", loader))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(n_loads) == 1
+    assert all(result is results[0] for result in results)
+    assert registry.hits == 7 and registry.misses == 1
+
+
+def test_evict_model():
+    registry = ModelRegistry()
+    a, _ = registry.get("a", lambda: make_model(5))
+    b = registry.get("b", lambda: make_model(5))
+    registry.put("c", b[0])
+    assert registry.evict_model(b[0]) == 2
+    assert "a" in registry and "b" not in registry and "c" not in registry
+    assert registry.evict_model(b[0]) == 0
+    assert registry.get("a", lambda: make_model(5))[0] is a
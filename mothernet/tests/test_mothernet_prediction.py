@@ -0,0 +1,154 @@
+import pickle
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from scipy.special import softmax
+
+from mothernet.artifact import AdditivePredictor, load_artifact, save_artifact
+from sklearn.preprocessing import StandardScaler
+
+from mothernet.prediction.mothernet import (FusedMLPEnsemble, MergedMLPEnsemble, MLPPredictor, _unshift_predictor,
+                                           predict_with_mlp_model, shift_features)
+
+
+def reference_logits(X_train, X_test, layers, scale=True):
+    # the computation of predict_with_mlp_model before it used MLPPredictor, in float64
+    mean = np.nanmean(X_train, axis=0)
+    std = np.nanstd(X_train, axis=0, ddof=1) + .000001
+    std[np.isnan(std)] = 1
+    X_test = np.nan_to_num(X_test, 0)
+    out = np.clip((X_test - mean) / std if scale else X_test, a_min=-100, a_max=100)
+    for i, (b, w) in enumerate(layers):
+        out = np.dot(out, w.astype(np.float64)) + b
+        if i != len(layers) - 1:
+            out = np.maximum(out, 0)
+    return out
+
+
+def reference_predict(X_train, X_test, layers, scale=True):
+    return softmax(reference_logits(X_train, X_test, layers, scale=scale) / .8, axis=1)
+
+
+def make_constant_column_data(rng):
+    X_train = rng.normal(size=(100, 10)) * 3 + 2
+    X_test = rng.normal(size=(300, 10)) * 3 + 2
+    # a constant training column, with test values that are equal to it or not, and a column with a large offset
+    X_train[:, 0] = 1000
+    X_test[:, 0] = np.where(rng.uniform(size=300) < 0.5, 1000, 1000 + rng.normal(size=300))
+    X_train[:, 1] += 1e6
+    X_test[:, 1] += 1e6
+    return X_train, X_test
+
+
+def make_layers(rng):
+    layers = [(rng.normal(size=32), rng.normal(size=(10, 32)) / 3), (rng.normal(size=32), rng.normal(size=(32, 32)) / 5),
+              (rng.normal(size=3), rng.normal(size=(32, 3)) / 5)]
+    return [(b.astype(np.float32), w.astype(np.float32)) for b, w in layers]
+
+
+@pytest.mark.parametrize("scale", [True, False])
+def test_mlp_predictor(scale):
+    rng = np.random.RandomState(0)
+    layers = make_layers(rng)
+    X_train = rng.normal(size=(100, 10)) * 3 + 2
+    X_test = rng.normal(size=(1000, 10)) * 3 + 2
+    X_test[rng.uniform(size=X_test.shape) < 0.1] = np.nan
+    # outliers that are clipped
+    X_test[:10, 0] = 1e6
+    expected = reference_predict(X_train, X_test, layers, scale=scale)
+
+    predictor = MLPPredictor.from_training_data(X_train, layers, scale=scale, block_size=64)
+    np.testing.assert_allclose(predictor.predict_proba(X_test), expected, atol=1e-5)
+    # buffers are reused for a smaller input
+    np.testing.assert_allclose(predictor.predict_proba(X_test[:10]), expected[:10], atol=1e-5)
+    np.testing.assert_allclose(pickle.loads(pickle.dumps(predictor)).predict_proba(X_test), expected, atol=1e-5)
+
+
+def test_mlp_predictor_constant_column():
+    rng = np.random.RandomState(0)
+    layers = make_layers(rng)
+    X_train, X_test = make_constant_column_data(rng)
+    expected = reference_logits(X_train, X_test, layers)
+    predictor = MLPPredictor.from_training_data(X_train, layers)
+    np.testing.assert_allclose(predictor.decision_function(X_test), expected, rtol=1e-4, atol=1e-3)
+    np.testing.assert_allclose(predict_with_mlp_model(X_train, X_test, layers), softmax(expected / .8, axis=1), atol=1e-5)
+
+
+def test_mlp_artifact(tmp_path):
+    rng = np.random.RandomState(0)
+    layers = make_layers(rng)
+    X_train, X_test = make_constant_column_data(rng)
+    predictor = MLPPredictor.from_training_data(X_train, layers)
+    classes = np.array(["a", "b", "c"], dtype=object)
+    save_artifact(tmp_path / "mlp.npz", predictor, classes)
+    loaded = load_artifact(tmp_path / "mlp.npz")
+    np.testing.assert_allclose(loaded.predict_proba(X_test), predictor.predict_proba(X_test), atol=1e-6)
+    np.testing.assert_allclose(loaded.predict_proba(X_test), predict_with_mlp_model(X_train, X_test, layers), atol=1e-6)
+    assert loaded.classes_.tolist() == ["a", "b", "c"]
+    assert set(loaded.predict(X_test)) <= {"a", "b", "c"}
+
+
+def test_additive_artifact(tmp_path):
+    rng = np.random.RandomState(0)
+    bin_edges = np.sort(rng.normal(size=(4, 63)), axis=1)
+    predictor = AdditivePredictor(rng.normal(size=(4, 64, 3)), rng.normal(size=3), bin_edges)
+    X_test = rng.normal(size=(100, 4))
+    X_test[0, 0] = np.nan
+    save_artifact(tmp_path / "additive.npz", predictor, np.array([2, 4, 8]))
+    loaded = load_artifact(tmp_path / "additive.npz")
+    np.testing.assert_allclose(loaded.predict_proba(X_test), predictor.predict_proba(X_test))
+    assert loaded.classes_.tolist() == [2, 4, 8]
+
+
+def test_artifact_does_not_import_torch():
+    code = "import sys; import mothernet.artifact; assert 'torch' not in sys.modules and 'sklearn' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_fused_mlp_ensemble_constant_column():
+    # members that see a constant column and a column with a large offset, with and without feature and label shifts
+    rng = np.random.RandomState(0)
+    X_train, X_test = make_constant_column_data(rng)
+    transformer = StandardScaler().fit(X_train)
+    inputs_train = {False: X_train, True: transformer.transform(X_train)}
+    inputs_test = {False: X_test, True: transformer.transform(X_test)}
+    members, probas = [], []
+    for use_power, feature_shift, label_shift in [(False, 0, 0), (True, 3, 1), (False, 7, 2), (True, 0, 1)]:
+        class_indices = np.mod(np.arange(3) + label_shift, 3)
+        layers = make_layers(rng)
+        shifted_train = shift_features(inputs_train[use_power], feature_shift)
+        predictor = MLPPredictor.from_training_data(shifted_train, layers)
+        members.append((use_power, _unshift_predictor(predictor, feature_shift, class_indices)))
+        probas.append(reference_predict(shifted_train, shift_features(inputs_test[use_power], feature_shift), layers)[:, class_indices])
+    fused = FusedMLPEnsemble(members, transformer, np.array(["a", "b", "c"]))
+    np.testing.assert_allclose(fused.predict_proba(X_test), np.mean(probas, axis=0), atol=1e-5)
+
+
+@pytest.mark.parametrize("constant_column", [False, True])
+def test_merged_mlp_ensemble(constant_column):
+    rng = np.random.RandomState(0)
+    if constant_column:
+        X_train, X_test = make_constant_column_data(rng)
+    else:
+        X_train = rng.normal(size=(100, 10)) * 3 + 2
+        X_test = rng.normal(size=(300, 10)) * 3 + 2
+        X_test[rng.uniform(size=X_test.shape) < 0.1] = np.nan
+    transformer = StandardScaler().fit(X_train)
+    inputs_train = {False: X_train, True: transformer.transform(X_train)}
+    inputs_test = {False: X_test, True: transformer.transform(X_test)}
+    members, logits = [], []
+    for use_power, feature_shift, label_shift in [(False, 0, 0), (True, 3, 1), (False, 7, 2), (True, 0, 1)]:
+        class_indices = np.mod(np.arange(3) + label_shift, 3)
+        layers = make_layers(rng)
+        shifted_train, shifted_test = shift_features(inputs_train[use_power], feature_shift), shift_features(inputs_test[use_power], feature_shift)
+        predictor = MLPPredictor.from_training_data(shifted_train, layers)
+        logits.append(reference_logits(shifted_train, shifted_test, layers)[:, class_indices])
+        unshifted = _unshift_predictor(predictor, feature_shift, class_indices)
+        np.testing.assert_allclose(unshifted.decision_function(inputs_test[use_power]), logits[-1], rtol=1e-5, atol=1e-4)
+        members.append((use_power, unshifted))
+    merged = MergedMLPEnsemble(members, transformer, np.array(["a", "b", "c"]), block_size=64)
+    expected = softmax(np.mean(logits, axis=0) / .8, axis=1)
+    np.testing.assert_allclose(merged.predict_proba(X_test), expected, atol=1e-5)
+    assert set(merged.predict(X_test)) <= {"a", "b", "c"}
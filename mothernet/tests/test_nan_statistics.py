@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+
+from mothernet.nan_statistics import constant_columns, nan_mean_std, nan_statistics
+from mothernet.utils import get_outlier_bounds, normalize_data
+
+
+def make_data():
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(50, 3, 8))
+    X[rng.uniform(size=X.shape) < 0.2] = np.nan
+    X[:, :, 0] = 2.
+    X[:, :, 1] = np.nan
+    X[::2, :, 2] = np.nan
+    X[1::2, :, 2] = 5.
+    return torch.tensor(X, dtype=torch.float)
+
+
+def old_masked_std(x, mask, dim=0):
+    num = torch.where(mask, torch.full_like(x, 1), torch.full_like(x, 0)).sum(dim=dim)
+    value = torch.where(mask, x, torch.full_like(x, 0)).sum(dim=dim)
+    mean = value / num
+    mean_broadcast = torch.repeat_interleave(mean.unsqueeze(dim), x.shape[dim], dim=dim)
+    quadratic_difference_from_mean = torch.square(torch.where(mask, mean_broadcast - x, torch.full_like(x, 0)))
+    return mean, torch.sqrt(torch.sum(quadratic_difference_from_mean, dim=dim) / (num - 1))
+
+
+def test_nan_statistics():
+    X = make_data()
+    stats = nan_statistics(X, dim=0)
+    with np.errstate(all='ignore'), torch.no_grad():
+        np.testing.assert_array_equal(stats.count.numpy(), (~np.isnan(X.numpy())).sum(axis=0))
+        np.testing.assert_allclose(stats.mean.numpy(), np.nanmean(X.numpy(), axis=0), rtol=1e-5)
+        np.testing.assert_allclose(stats.var.numpy(), np.nanvar(X.numpy(), axis=0, ddof=1), rtol=1e-5)
+        np.testing.assert_array_equal(stats.min.numpy(), np.nanmin(X.numpy(), axis=0))
+        np.testing.assert_array_equal(stats.max.numpy(), np.nanmax(X.numpy(), axis=0))
+
+
+def test_mean_std_match_previous_helpers():
+    X = make_data()
+    mask = ~torch.isnan(X) & (X < 1)
+    for m in [~torch.isnan(X), mask]:
+        expected_mean, expected_std = old_masked_std(X, m)
+        mean, std = nan_mean_std(X, mask=m)
+        torch.testing.assert_close(mean, expected_mean, rtol=0, atol=0, equal_nan=True)
+        torch.testing.assert_close(std, expected_std, rtol=0, atol=0, equal_nan=True)
+
+    expected_mean, expected_std = old_masked_std(X, ~torch.isnan(X))
+    torch.testing.assert_close(normalize_data(X), torch.clip((X - expected_mean) / (expected_std + .000001), -100, 100),
+                               rtol=0, atol=0, equal_nan=True)
+    lower, upper = get_outlier_bounds(X)
+    assert lower.shape == upper.shape == (3, 8)
+
+
+def test_constant_columns():
+    X = make_data()[:, 0]
+    expected = [len(torch.unique(col[~col.isnan()])) <= 1 for col in X.T]
+    assert constant_columns(X).tolist() == expected
+    assert expected[:3] == [True, True, True] and not any(expected[3:])
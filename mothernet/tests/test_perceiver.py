@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+from torch import nn
+
+from mothernet.models.perceiver import TabPerceiver
+from mothernet.prediction.mothernet import extract_mlp_model, extract_mlp_model_streaming, scan_training_chunks
+
+
+def make_perceiver():
+    torch.manual_seed(0)
+    return TabPerceiver(nlayers=2, emsize=16, num_latents=8, nhead=2, cross_dim_head=8, latent_dim_head=8, n_out=3,
+                        decoder_hidden_size=32, predicted_hidden_layer_size=8, decoder_embed_dim=16,
+                        encoder_layer=nn.Linear(100, 16), y_encoder_layer=nn.Linear(1, 16)).eval()
+
+
+def make_data():
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(103, 5)) * 3 + 1
+    y = rng.randint(3, size=103)
+    return X, y
+
+
+def chunker(X, y, chunk_size):
+    def make_chunks():
+        for start in range(0, X.shape[0], chunk_size):
+            yield X[start:start + chunk_size], y[start:start + chunk_size]
+    return make_chunks
+
+
+def test_inner_forward_streaming():
+    model = make_perceiver()
+    data = torch.randn(50, 2, 16)
+    with torch.no_grad():
+        expected = model.inner_forward(data)
+        result = model.inner_forward_streaming(lambda: iter(data.split(7)), batch_size=2)
+    torch.testing.assert_close(result, expected)
+
+
+def test_scan_training_chunks():
+    X, y = make_data()
+    X[::3, 1] = np.nan
+    X[:, 2] = np.nan
+    X[1:, 3] = np.nan
+    mean, std, classes = scan_training_chunks(chunker(X, y, 10)())
+    with np.errstate(all='ignore'):
+        np.testing.assert_allclose(mean, np.nanmean(X, axis=0))
+        np.testing.assert_allclose(std, np.nanstd(X, axis=0, ddof=1))
+    np.testing.assert_array_equal(classes, [0, 1, 2])
+
+
+def test_extract_mlp_model_streaming(tmp_path):
+    model = make_perceiver()
+    X, y = make_data()
+    expected = extract_mlp_model(model, X, y)
+    X_memmap = np.lib.format.open_memmap(tmp_path / "X.npy", mode="w+", dtype=X.dtype, shape=X.shape)
+    X_memmap[:] = X
+    mean, std, _ = scan_training_chunks(chunker(X_memmap, y, 10)())
+    result = extract_mlp_model_streaming(model, chunker(X_memmap, y, 10), n_features=5, n_classes=3, mean=mean, std=std)
+    for (b_expected, w_expected), (b, w) in zip(expected, result):
+        np.testing.assert_allclose(b, b_expected, atol=1e-5)
+        np.testing.assert_allclose(w, w_expected, atol=1e-5)
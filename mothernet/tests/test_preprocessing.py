@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.preprocessing import PowerTransformer, QuantileTransformer, RobustScaler
+
+from mothernet.preprocessing import TorchPowerTransformer, TorchQuantileTransformer, TorchRobustScaler, fit_power_transformers
+
+
+@pytest.fixture
+def X():
+    rng = np.random.RandomState(0)
+    # skewed in both directions, symmetric, discrete and constant columns; lambdas of the negative exponential columns are > 2
+    X = np.hstack([rng.lognormal(size=(300, 10)), -rng.exponential(size=(300, 10)), rng.normal(size=(300, 10)),
+                   rng.randint(0, 3, size=(300, 5)), np.ones((300, 1))])
+    X[rng.uniform(size=X.shape) < 0.05] = np.nan
+    X[:, -1] = 1
+    return X
+
+
+@pytest.mark.parametrize("sklearn_transformer, torch_transformer", [
+    (PowerTransformer(standardize=True), TorchPowerTransformer()),
+    (QuantileTransformer(output_distribution='normal'), TorchQuantileTransformer()),
+    (RobustScaler(unit_variance=True), TorchRobustScaler(unit_variance=True))])
+def test_matches_sklearn(X, sklearn_transformer, torch_transformer):
+    # sklearn is fit column by column, as was done in TabPFN preprocessing
+    expected = np.hstack([sklearn_transformer.fit(X[:200, i:i + 1]).transform(X[:, i:i + 1]) for i in range(X.shape[1])])
+    result = torch_transformer.fit(torch.tensor(X[:200])).transform(torch.tensor(X))
+    assert result.dtype == torch.float64
+    np.testing.assert_allclose(result.numpy(), expected, atol=1e-6)
+    if isinstance(torch_transformer, TorchPowerTransformer):
+        np.testing.assert_allclose(torch_transformer.lambdas_.numpy(), sklearn_transformer.fit(X[:200]).lambdas_, atol=1e-6)
+
+
+def test_keeps_dtype(X):
+    X_float = torch.tensor(X, dtype=torch.float)
+    result = TorchPowerTransformer().fit_transform(X_float)
+    assert result.dtype == torch.float
+    assert torch.equal(torch.isnan(result), torch.isnan(X_float))
+
+
+def test_fit_power_transformers(X):
+    Xs = [torch.tensor(X[:200]), torch.tensor(X[:50, :7]), torch.tensor(X[:100, 20:])]
+    for X_part, transformer in zip(Xs, fit_power_transformers(Xs)):
+        expected = TorchPowerTransformer().fit(X_part)
+        np.testing.assert_allclose(transformer.lambdas_.numpy(), expected.lambdas_.numpy(), atol=1e-6)
+        np.testing.assert_allclose(transformer.transform(X_part).numpy(), expected.transform(X_part).numpy(), atol=1e-6)
@@ -0,0 +1,235 @@
+import lightning as L
+import numpy as np
+import pytest
+import torch
+from sklearn.datasets import load_breast_cancer, load_iris
+
+from mothernet.evaluation.low_precision import low_precision_report
+from mothernet.evaluation.prototype_context import prototype_accuracy_curve
+from mothernet.fit_model import main
+from mothernet.prediction import TabPFNClassifier
+from mothernet.prediction.tabpfn import (InferenceSession, InputPreprocessor, _bytes_per_token, get_class_prototypes,
+                                         get_stratified_subsets, transformer_predict)
+from mothernet.testing_utils import TESTING_DEFAULTS_SHORT
+
+
+@pytest.fixture(scope="module")
+def tabpfn_model(tmp_path_factory):
+    # tiny, barely trained model; we only check that different inference paths agree
+    L.seed_everything(42)
+    tmpdir = tmp_path_factory.mktemp("tabpfn")
+    results = main(TESTING_DEFAULTS_SHORT + ['-B', str(tmpdir), '-m', 'tabpfn'])
+    return dict(device='cpu', model_string=results['model_string'], epoch=results['epoch'], base_path=results['base_path'])
+
+
+@pytest.fixture(scope="module")
+def data():
+    X, y = load_breast_cancer(return_X_y=True)
+    return X[:200], y[:200], X[200:300]
+
+
+@pytest.mark.parametrize("params", [{}, {'no_preprocess_mode': True}, {'N_ensemble_configurations': 5, 'batch_size_inference': 2}])
+def test_cache_context(tabpfn_model, data, params):
+    X_train, y_train, X_test = data
+    clf = TabPFNClassifier(**tabpfn_model, **params).fit(X_train, y_train)
+    clf_cached = TabPFNClassifier(cache_context=True, **tabpfn_model, **params).fit(X_train, y_train)
+    assert clf_cached.context_ is not None
+    np.testing.assert_allclose(clf.predict_proba(X_test), clf_cached.predict_proba(X_test), atol=1e-5)
+    # prediction with test normalization falls back to the full sequence
+    np.testing.assert_allclose(clf.predict_proba(X_test, normalize_with_test=True),
+                               clf_cached.predict_proba(X_test, normalize_with_test=True), atol=1e-5)
+
+
+@pytest.mark.parametrize("params", [{'test_chunk_size': 30}, {'test_chunk_size': 30, 'cache_context': True},
+                                    {'memory_budget': 1_000_000, 'cache_context': True}])
+def test_chunked_prediction(tabpfn_model, data, params):
+    X_train, y_train, X_test = data
+    prob = TabPFNClassifier(**tabpfn_model).fit(X_train, y_train).predict_proba(X_test)
+    clf_chunked = TabPFNClassifier(**tabpfn_model, **params).fit(X_train, y_train)
+    chunks = list(clf_chunked.predict_proba_iter(X_test))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= clf_chunked._get_test_chunk_size() for chunk in chunks)
+    np.testing.assert_allclose(np.concatenate(chunks), prob, atol=1e-5)
+    np.testing.assert_allclose(clf_chunked.predict_proba(X_test), prob, atol=1e-5)
+
+
+def test_memory_budget_too_small(tabpfn_model, data):
+    X_train, y_train, X_test = data
+    clf = TabPFNClassifier(memory_budget=1000, **tabpfn_model).fit(X_train, y_train)
+    with pytest.raises(ValueError, match="memory_budget"):
+        clf.predict_proba(X_test)
+
+
+def test_inference_session(tabpfn_model, data):
+    X_train, y_train, X_test = data
+    clf = TabPFNClassifier(**tabpfn_model).fit(X_train, y_train)
+    assert isinstance(clf.session_, InferenceSession)
+    prob = clf.predict_proba(X_test)
+    # without a session, the model is prepared on every call
+    clf.session_ = None
+    np.testing.assert_allclose(clf.predict_proba(X_test), prob, atol=1e-6)
+    X_full = torch.tensor(np.concatenate([X_train, X_test]), dtype=torch.float).unsqueeze(1)
+    y_full = torch.tensor(np.concatenate([y_train, np.zeros(len(X_test))]), dtype=torch.float).unsqueeze(1)
+    with pytest.raises(ValueError, match="no_grad"):
+        transformer_predict(clf.model, X_full, y_full, len(X_train), no_grad=False, session=InferenceSession(clf.model))
+
+
+@pytest.mark.parametrize("params", [{}, {'no_preprocess_mode': True}, {'scale': False}])
+def test_cached_preprocessing(tabpfn_model, data, params, monkeypatch):
+    X_train, y_train, X_test = data
+    clf = TabPFNClassifier(**tabpfn_model, **params).fit(X_train, y_train)
+    assert clf.preprocessors_ is not None
+    prob = clf.predict_proba(X_test)
+
+    # the training statistics are not recomputed when predicting
+    def fail(*args, **kwargs):
+        raise AssertionError("preprocessing was fit during prediction")
+    with monkeypatch.context() as m:
+        m.setattr(InputPreprocessor, "fit_transform", fail)
+        np.testing.assert_allclose(clf.predict_proba(X_test), prob)
+
+    clf.preprocessors_ = None
+    np.testing.assert_allclose(clf.predict_proba(X_test), prob, atol=1e-6)
+
+
+def test_predict_many(tabpfn_model, monkeypatch):
+    X, y = load_breast_cancer(return_X_y=True)
+    rng = np.random.RandomState(0)
+    tasks = []
+    for n_train, n_test, n_features in [(20, 5, 30), (50, 17, 10), (35, 1, 30), (10, 30, 5)]:
+        rows = rng.permutation(len(X))[:n_train + n_test]
+        tasks.append((X[rows[:n_train], :n_features], y[rows[:n_train]], X[rows[n_train:], :n_features]))
+    # a task with string labels and three classes
+    tasks.append((X[:40, :8], np.array(['a', 'b', 'c', 'b'] * 10), X[40:50, :8]))
+    # batch_size_inference=4 puts the members of several, but not all, tasks in one forward pass
+    clf = TabPFNClassifier(batch_size_inference=4, N_ensemble_configurations=2, **tabpfn_model)
+    predictions = clf.predict_many(tasks)
+    assert len(predictions) == len(tasks)
+    for (X_train, y_train, X_test), prediction in zip(tasks, predictions):
+        expected = TabPFNClassifier(batch_size_inference=4, N_ensemble_configurations=2, **tabpfn_model).fit(X_train, y_train).predict_proba(X_test)
+        assert prediction.shape == (len(X_test), len(np.unique(y_train)))
+        np.testing.assert_allclose(prediction, expected, atol=1e-5)
+
+    # a fitted classifier reuses its InferenceSession instead of moving the shared model again
+    clf.fit(*tasks[0][:2])
+
+    def fail(*args, **kwargs):
+        raise AssertionError("model was prepared during prediction")
+    with monkeypatch.context() as m:
+        m.setattr(clf.model, "to", fail)
+        for prediction, expected in zip(clf.predict_many(tasks), predictions):
+            np.testing.assert_allclose(prediction, expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("low_precision", ['int8', 'bf16'])
+def test_low_precision(tabpfn_model, data, low_precision):
+    X_train, y_train, X_test = data
+    clf = TabPFNClassifier(**tabpfn_model).fit(X_train, y_train)
+    clf_low = TabPFNClassifier(low_precision=low_precision, **tabpfn_model).fit(X_train, y_train)
+    assert clf_low.model is not clf.model
+    assert isinstance(clf.model.transformer_encoder.layers[0].linear1, torch.nn.Linear)
+    assert not isinstance(clf_low.model.transformer_encoder.layers[0].linear1, torch.nn.Linear)
+    np.testing.assert_allclose(clf.predict_proba(X_test), clf_low.predict_proba(X_test), atol=0.05)
+
+    report = low_precision_report(TabPFNClassifier(**tabpfn_model), modes=[low_precision],
+                                  datasets=[('breast_cancer', X_train, X_train, y_train, y_train)])
+    assert [row['low_precision'] for row in report] == ['float32', low_precision]
+    assert abs(report[1]['accuracy_delta']) <= 0.02
+    assert report[1]['max_proba_delta'] <= 0.05
+    assert report[1]['prediction_changes'] <= 0.02
+
+
+def test_get_stratified_subsets():
+    y = np.array([0] * 50 + [1] * 48 + [2] * 2)
+    subsets = get_stratified_subsets(y, 30, random_state=0)
+    assert len(subsets) == 4
+    # disjoint and covering, apart from the added points of the rare class
+    assert set(np.concatenate(subsets)) == set(range(100))
+    assert sum(len(subset) for subset in subsets) == 102
+    for subset in subsets:
+        assert len(subset) <= 26 and set(y[subset]) == {0, 1, 2}
+        assert abs(np.mean(y[subset] == 0) - 0.5) < 0.1
+    assert len(get_stratified_subsets(y, 30, n_subsets=6, random_state=0)) == 6
+
+
+def test_subsample_bagging(tabpfn_model):
+    X, y = load_breast_cancer(return_X_y=True)
+    X_train, y_train, X_test = X[:300], y[:300], X[300:350]
+    clf = TabPFNClassifier(subsample_size=100, **tabpfn_model).fit(X_train, y_train)
+    assert len(clf.subsets_) == 3
+    expected = np.mean([TabPFNClassifier(**tabpfn_model).fit(X_train[subset], y_train[subset]).predict_proba(X_test)
+                        for subset in clf.subsets_], axis=0)
+    np.testing.assert_allclose(clf.predict_proba(X_test), expected, atol=1e-5)
+
+    clf = TabPFNClassifier(subsample_size='auto', memory_budget=200_000, **tabpfn_model).fit(X_train, y_train)
+    assert clf.subsets_ is not None and max(len(subset) for subset in clf.subsets_) < 300
+    assert clf.predict_proba(X_test).shape == (50, 2)
+
+    with pytest.raises(ValueError, match="subsample_size=2000"):
+        TabPFNClassifier(subsample_size=2000, **tabpfn_model).fit(X_train, y_train)
+    clf = TabPFNClassifier(subsample_size=2000, **tabpfn_model).fit(X_train, y_train, overwrite_warning=True)
+    assert clf.subsets_ is None
+
+
+def test_retrieval_context(tabpfn_model, data):
+    X_train, y_train, X_test = data
+    # with as many neighbors as training points, every chunk uses the whole training set
+    clf = TabPFNClassifier(retrieval_neighbors=len(X_train), **tabpfn_model).fit(X_train, y_train)
+    np.testing.assert_allclose(clf.predict_proba(X_test), TabPFNClassifier(**tabpfn_model).fit(X_train, y_train).predict_proba(X_test),
+                               atol=1e-5)
+
+    X, y = load_iris(return_X_y=True)
+    clf = TabPFNClassifier(retrieval_neighbors=5, test_chunk_size=4, **tabpfn_model).fit(X[::2], y[::2])
+    contexts = []
+    original = clf._predict_proba_with_training_subset
+
+    def record_context(X, subset, **kwargs):
+        contexts.append(subset)
+        return original(X, subset, **kwargs)
+    clf._predict_proba_with_training_subset = record_context
+    prob = clf.predict_proba(X[1::2])
+    assert len(contexts) == 19 and max(len(context) for context in contexts) <= 20
+    np.testing.assert_allclose(prob.sum(axis=1), 1, rtol=1e-5)
+    # neighborhoods in iris are mostly pure, so some classes get probability zero
+    assert (prob == 0).any()
+
+    # with a memory budget, the chunk size is chosen so that each chunk and its context fit
+    clf = TabPFNClassifier(retrieval_neighbors=5, memory_budget=300_000, **tabpfn_model).fit(X[::2], y[::2])
+    chunks = []
+    original = clf._predict_proba_with_training_subset
+
+    def record_chunk(X, subset, **kwargs):
+        chunks.append((len(X), len(subset)))
+        return original(X, subset, **kwargs)
+    clf._predict_proba_with_training_subset = record_chunk
+    clf.predict_proba(X[1::2])
+    assert len(chunks) > 1
+    assert all((n_test + n_context) * _bytes_per_token(clf.model, n_context, 3) <= 300_000 for n_test, n_context in chunks)
+
+
+def test_prototype_context(tabpfn_model, data):
+    X_train, y_train, X_test = data
+    X_prototypes, y_prototypes, counts = get_class_prototypes(X_train, y_train, 10, random_state=0)
+    assert len(X_prototypes) == 20 and counts.sum() == len(X_train)
+    for label in [0, 1]:
+        np.testing.assert_allclose((X_prototypes[y_prototypes == label] * counts[y_prototypes == label, None]).sum(axis=0),
+                                   X_train[y_train == label].sum(axis=0))
+
+    clf = TabPFNClassifier(n_prototypes=10, **tabpfn_model).fit(X_train, y_train)
+    assert clf.X_.shape == (20, X_train.shape[1])
+    assert clf.predict_proba(X_test).shape == (len(X_test), 2)
+
+    # a training point with log weight log(3) is attended to like three copies of the point
+    model = clf.model
+    x, y = torch.randn(30, 2, model.encoder.in_features), torch.randint(0, 2, (20, 2)).float()
+    duplicated = torch.tensor([0, 0, 0] + list(range(1, 30)))
+    key_bias = torch.zeros(2, 30)
+    key_bias[:, 0] = np.log(3)
+    with torch.no_grad():
+        expected = model((x[duplicated], y[duplicated[:22]]), single_eval_pos=22)
+        result = model((x, y), single_eval_pos=20, src_key_padding_mask=key_bias)
+    torch.testing.assert_close(result, expected, atol=1e-5, rtol=1e-5)
+
+    curve = prototype_accuracy_curve(TabPFNClassifier(**tabpfn_model), n_prototypes=[5],
+                                     datasets=[('breast_cancer', X_train, X_train, y_train, y_train)])
+    assert [row['context_size'] for row in curve] == [len(X_train), 10]
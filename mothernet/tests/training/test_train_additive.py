@@ -7,7 +7,8 @@ from mothernet.fit_model import main
 from mothernet.models.mothernet_additive import MotherNetAdditive
 from mothernet.prediction import MotherNetAdditiveClassifier
 
-from mothernet.testing_utils import TESTING_DEFAULTS, TESTING_DEFAULTS_SHORT, count_parameters, check_predict_iris, get_model_path
+from mothernet.testing_utils import (TESTING_DEFAULTS, TESTING_DEFAULTS_SHORT, count_parameters, check_predict_iris, check_artifact_iris,
+                                    check_low_rank_iris, get_model_path)
 
 
 def test_train_additive_defaults():
@@ -16,6 +17,8 @@ def test_train_additive_defaults():
         results = main(TESTING_DEFAULTS + ['-B', tmpdir, '-m', 'additive'])
         clf = MotherNetAdditiveClassifier(device='cpu', path=get_model_path(results))
         check_predict_iris(clf)
+        check_artifact_iris(clf, tmpdir)
+        check_predict_iris(MotherNetAdditiveClassifier(device='cpu', path=get_model_path(results), low_precision='int8'))
     assert isinstance(results['model'], MotherNetAdditive)
     assert count_parameters(results['model']) == 9690634
     assert results['loss'] == pytest.approx(0.7657004594802856, rel=1e-5)
@@ -143,6 +146,7 @@ def test_train_additive_factorized_output():
         results = main(TESTING_DEFAULTS_SHORT + ['-B', tmpdir, '-m', 'additive', '--factorized-output', 'True'])
         clf = MotherNetAdditiveClassifier(device='cpu', path=get_model_path(results))
         check_predict_iris(clf)
+        check_low_rank_iris(clf)
     assert isinstance(results['model'], MotherNetAdditive)
     assert results['model'].decoder.output_weights.shape == (16, 64, 10)
     assert count_parameters(results['model']) == 1649994
@@ -164,6 +168,7 @@ def test_train_additive_class_average_factorized():
     with tempfile.TemporaryDirectory() as tmpdir:
         results = main(TESTING_DEFAULTS_SHORT + ['-B', tmpdir, '-m', 'additive', '--factorized-output', 'True',
                                                  '--output-rank', '4', '--decoder-type', 'class_average'])
+        check_low_rank_iris(MotherNetAdditiveClassifier(device='cpu', path=get_model_path(results)))
     assert isinstance(results['model'], MotherNetAdditive)
     assert results['model'].decoder.output_weights.shape == (4, 64)
     assert count_parameters(results['model']) == 1419034
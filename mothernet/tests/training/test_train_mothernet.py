@@ -11,7 +11,8 @@ from mothernet.models.mothernet import MotherNet
 from mothernet.config_utils import compare_dicts
 from mothernet.prediction import MotherNetClassifier
 
-from mothernet.testing_utils import TESTING_DEFAULTS, TESTING_DEFAULTS_SHORT, count_parameters, check_predict_iris, get_model_path
+from mothernet.testing_utils import (TESTING_DEFAULTS, TESTING_DEFAULTS_SHORT, count_parameters, check_predict_iris, check_artifact_iris,
+                                    check_fused_ensemble_iris, get_model_path)
 
 DEFAULT_LOSS = pytest.approx(1.0794482231140137)
 
@@ -22,6 +23,8 @@ def test_train_defaults():
         results = main(TESTING_DEFAULTS + ['-B', tmpdir])
         clf = MotherNetClassifier(device='cpu', path=get_model_path(results))
         check_predict_iris(clf)
+        check_artifact_iris(clf, tmpdir)
+        check_fused_ensemble_iris(clf)
     assert results['loss'] == DEFAULT_LOSS
     assert results['model_string'].startswith("mn_AFalse_d128_H128_e128_E10_rFalse_N4_n1_P64_L1_tFalse_cpu_")
     assert count_parameters(results['model']) == 1544650
@@ -6,14 +6,17 @@ import pytest
 from mothernet.fit_model import main
 # from tabpfn.fit_tabpfn import main as tabpfn_main
 from mothernet.models.perceiver import TabPerceiver
+from mothernet.prediction import MotherNetClassifier
 
-from mothernet.testing_utils import TESTING_DEFAULTS, count_parameters
+from mothernet.testing_utils import TESTING_DEFAULTS, count_parameters, check_predict_iris, get_model_path
 
 
 def test_train_perceiver_defaults():
     L.seed_everything(42)
     with tempfile.TemporaryDirectory() as tmpdir:
         results = main(TESTING_DEFAULTS + ['-B', tmpdir, '-m', 'perceiver'])
+        clf = MotherNetClassifier(device='cpu', path=get_model_path(results))
+        check_predict_iris(clf)
     model = results['model']
     assert isinstance(model, TabPerceiver)
     assert model.ff_dropout == 0
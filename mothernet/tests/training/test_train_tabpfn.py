@@ -21,6 +21,15 @@ def test_train_tabpfn_basic():
     assert isinstance(results['model'], TabPFN)
 
 
+def test_train_tabpfn_num_workers():
+    L.seed_everything(42)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = main(TESTING_DEFAULTS_SHORT + ['-B', tmpdir, '-m', 'tabpfn', '--num-workers', '2'])
+    assert results['dataloader'].num_workers == 2
+    assert results['epoch'] == 2
+    assert isinstance(results['model'], TabPFN)
+
+
 def test_train_tabpfn_init_weights():
     L.seed_everything(42)
     with tempfile.TemporaryDirectory() as tmpdir:
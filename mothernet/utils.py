@@ -15,6 +15,7 @@ from torch.optim.lr_scheduler import LRScheduler
 from torch.optim.optimizer import Optimizer
 from mothernet.model_configs import get_base_config
 from mothernet.config_utils import flatten_dict
+from mothernet.nan_statistics import nan_mean_std
 
 
 class DownloadProgressBar(tqdm):
@@ -88,8 +89,8 @@ def torch_masked_mean(x, mask, dim=0, return_share_of_ignored_values=False):
     If return_share_of_ignored_values is true it returns a second tensor with the percentage of ignored values
     because of the mask.
     """
-    num = torch.where(mask, torch.full_like(x, 1), torch.full_like(x, 0)).sum(dim=dim)
-    value = torch.where(mask, x, torch.full_like(x, 0)).sum(dim=dim)
+    num = mask.sum(dim=dim).to(x.dtype)
+    value = torch.where(mask, x, torch.zeros((), dtype=x.dtype, device=x.device)).sum(dim=dim)
     if return_share_of_ignored_values:
         return value / num, 1.-num/x.shape[dim]
     return value / num
@@ -98,14 +99,8 @@ def torch_masked_mean(x, mask, dim=0, return_share_of_ignored_values=False):
 def torch_masked_std(x, mask, dim=0):
     """
     Returns the std of a torch tensor and only considers the elements, where the mask is true.
-    If get_mean is true it returns as a first Tensor the mean and as a second tensor the std.
     """
-    num = torch.where(mask, torch.full_like(x, 1), torch.full_like(x, 0)).sum(dim=dim)
-    value = torch.where(mask, x, torch.full_like(x, 0)).sum(dim=dim)
-    mean = value / num
-    mean_broadcast = torch.repeat_interleave(mean.unsqueeze(dim), x.shape[dim], dim=dim)
-    quadratic_difference_from_mean = torch.square(torch.where(mask, mean_broadcast - x, torch.full_like(x, 0)))
-    return torch.sqrt(torch.sum(quadratic_difference_from_mean, dim=dim) / (num - 1))
+    return nan_mean_std(x, dim=dim, mask=mask)[1]
 
 
 def torch_nanmean(x, dim=0, return_nanshare=False):
@@ -113,17 +108,12 @@ def torch_nanmean(x, dim=0, return_nanshare=False):
 
 
 def torch_nanstd(x, dim=0):
-    return torch_masked_std(x, ~torch.isnan(x), dim=dim)
+    return nan_mean_std(x, dim=dim)[1]
 
 
 def normalize_data(data, normalize_positions=-1):
-    if normalize_positions > 0:
-        mean = torch_nanmean(data[:normalize_positions], dim=0)
-        std = torch_nanstd(data[:normalize_positions], dim=0) + .000001
-    else:
-        mean = torch_nanmean(data, dim=0)
-        std = torch_nanstd(data, dim=0) + .000001
-    data = (data - mean) / std
+    mean, std = nan_mean_std(data[:normalize_positions] if normalize_positions > 0 else data, dim=0)
+    data = (data - mean) / (std + .000001)
     data = torch.clip(data, min=-100, max=100)
 
     return data
@@ -133,29 +123,39 @@ def remove_outliers(X, n_sigma=4, normalize_positions=-1, categorical_features=N
     # Expects T, B, H
     assert len(X.shape) == 3, "X must be T,B,H"
 
-    if categorical_features:
-        categorical_mask = torch.zeros(X.shape[2], dtype=torch.bool, device=X.device)
-        categorical_mask.scatter_(0, torch.tensor(categorical_features, device=X.device, dtype=int), 1.)
-
     data = X if normalize_positions == -1 else X[:normalize_positions]
+    lower, upper = get_outlier_bounds(data, n_sigma=n_sigma)
+    return clip_outliers(X, lower, upper, categorical_features=categorical_features)
+
 
-    data_mean, data_std = torch_nanmean(data, dim=0), torch_nanstd(data, dim=0)
+def get_outlier_bounds(data, n_sigma=4):
+    """
+    Returns the lower and upper bounds used by remove_outliers, computed from data of shape T, B, H.
+    """
+    data_mean, data_std = nan_mean_std(data, dim=0)
     cut_off = data_std * n_sigma
     lower, upper = data_mean - cut_off, data_mean + cut_off
 
-    mask = (data <= upper) & (data >= lower) & ~torch.isnan(data)
-    data_mean, data_std = torch_masked_mean(data, mask), torch_masked_std(data, mask)
+    # comparisons with NaN are False, so missing values are excluded as well
+    mask = (data <= upper) & (data >= lower)
+    data_mean, data_std = nan_mean_std(data, dim=0, mask=mask)
 
     cut_off = data_std * n_sigma
-    lower, upper = data_mean - cut_off, data_mean + cut_off
+    return data_mean - cut_off, data_mean + cut_off
 
+
+def clip_outliers(X, lower, upper, categorical_features=None):
+    """
+    Softly clips the values of X outside of [lower, upper], leaving categorical features unchanged.
+    """
     if categorical_features:
+        categorical_mask = torch.zeros(X.shape[2], dtype=torch.bool, device=X.device)
+        categorical_mask.scatter_(0, torch.tensor(categorical_features, device=X.device, dtype=int), 1.)
         X = torch.where(categorical_mask, X, torch.maximum(-torch.log(1+torch.abs(X)) + lower, X))
         X = torch.where(categorical_mask, X, torch.minimum(torch.log(1+torch.abs(X)) + upper, X))
     else:
         X = torch.maximum(-torch.log(1+torch.abs(X)) + lower, X)
         X = torch.minimum(torch.log(1+torch.abs(X)) + upper, X)
-    # print(ds[1][data < lower, col], ds[1][data > upper, col], ds[1][~np.isnan(data), col].shape, data_mean, data_std)
     return X
 
 
@@ -393,7 +393,7 @@ def get_model_string(config, num_gpus, device, parser):
     for k in sorted(config_flat.keys()):
         if k in ['st_checkpoint_dir', 'save_every', 'run_id', 'warm_start_from', 'use_cpu', 'continue_run', 'restart_scheduler',
                  'load_strict', 'gpu_id', 'help', 'base_path', 'create_new_run', 'experiment', 'model_type', 'extra_fast_test',
-                 'seed_everything', 'no_mlflow', 'num_gpus', 'device', 'nhead']:
+                 'seed_everything', 'no_mlflow', 'num_gpus', 'device', 'nhead', 'num_workers']:
             continue
         v = config_flat[k]
         if k not in default_config_flat: